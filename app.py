@@ -1,18 +1,48 @@
+import hmac
+import io
+import math
 import os
 import random
-import json
-import math
-import csv
-import requests
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from phone import send_sms_via_email
+import secrets
+import threading
+import time
+import uuid
+from collections import deque
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, g
+from phone import build_sms, send_sms_via_email
+from sms_dispatcher import get_dispatcher
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
+from sqlalchemy.orm import joinedload, selectinload
 from dotenv import load_dotenv
 from celery_app import celery
+from spatial import GridIndex, StopIndex, haversine
+from distances import StopCoordinates
+from prediction_cache import create_prediction_cache
+from cta_client import CTAClient, Prediction
+from cta_async import AsyncCTAClient
+from realtime_feed import PollerLimitError, RealtimeHub
+from payloads import FastJSONProvider, PrecomputedPayload
+from gtfs import SharedFeed
+from feed_manager import FeedManager, FeedWatcher, install_feed_archive
+from shapes import level_for_zoom
+from route_index import RouteIndex
+from delivery import AlertDelivery, DatabaseDedupStore, PipelineMetrics, alert_job, create_dedup_store
+from otp_store import DatabaseBackend, create_otp_store
+from identity import UserSnapshot, create_user_cache
+from db_config import bulk_update, configure_engine, database_uri, engine_options, instrument_engine
+from logs import get_logger
+from metrics import CONTENT_TYPE, FAST_BUCKETS, HistogramFamily, MetricsRegistry, serve_metrics
+from profiler import SamplingProfiler
+from subscriptions import DatabaseSubscriptions, Subscription, create_subscription_index, soonest_arrivals
 
 load_dotenv(override=True)
 
+log = get_logger("app")
+
 app = Flask(__name__)
+# orjson-backed jsonify for every API response; see payloads.
+app.json = FastJSONProvider(app)
 app.secret_key = os.urandom(24)
 
 # Configure mail settings (for OTPs)
@@ -26,13 +56,27 @@ app.config.update({
     "MAIL_DEFAULT_SENDER": os.getenv('MAIL_DEFAULT_SENDER')
 })
 
-# Configure SQLite database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///cta_tracker.db'
+# Configure the database: SQLite (WAL) by default, or DATABASE_URL for a
+# pooled server database; see db_config.
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
+# Query timings by SQL verb, exported at /metrics.
+db_latency = HistogramFamily(FAST_BUCKETS)
+with app.app_context():
+    configure_engine(db.engine)
+    instrument_engine(db.engine, db_latency)
+migrate = Migrate(app, db)
 
-# In-memory storage for OTPs.
-OTPS = {}
+def db_engine():
+    """The app's engine, for code that runs outside an app context (stores, delivery tasks)."""
+    with app.app_context():
+        return db.engine
+
+# Snapshots of signed-in users for read-only pages; see USER_CACHE_*
+# settings (USER_CACHE_URL to share them between workers).
+user_cache = create_user_cache()
 
 # ------------------------
 # Database Model
@@ -43,136 +87,128 @@ class User(db.Model):
     carrier = db.Column(db.String(20))
     home_lat = db.Column(db.Float)
     home_lng = db.Column(db.Float)
-    favorite_lines = db.Column(db.Text)  # Stored as JSON list
-    notification_settings = db.Column(db.Text)  # Stored as JSON object
+    # Minutes before an arrival to send an alert; None means the default.
+    notify_minutes = db.Column(db.Integer)
+    # Nearest GTFS stop to the home location, kept up to date by set_home and
+    # by reload_stops() so the notification sweep never has to search for it.
+    closest_stop_id = db.Column(db.String(20), index=True)
+    closest_stop_distance = db.Column(db.Float)  # miles
+    favorites = db.relationship('UserFavorite', order_by='UserFavorite.position',
+                                cascade='all, delete-orphan', back_populates='user')
 
     def get_favorites(self):
-        return json.loads(self.favorite_lines) if self.favorite_lines else []
+        return [favorite.route for favorite in self.favorites]
 
     def set_favorites(self, fav_list):
-        self.favorite_lines = json.dumps(fav_list)
+        # Rows for routes that stay are kept, so only real changes are written.
+        existing = {favorite.route: favorite for favorite in self.favorites}
+        favorites = []
+        for position, route in enumerate(dict.fromkeys(fav_list)):
+            favorite = existing.get(route) or UserFavorite(route=route)
+            favorite.position = position
+            favorites.append(favorite)
+        self.favorites = favorites
 
     def get_notification_settings(self):
-        return json.loads(self.notification_settings) if self.notification_settings else {}
+        return {"time": self.notify_minutes} if self.notify_minutes is not None else {}
 
     def set_notification_settings(self, settings):
-        self.notification_settings = json.dumps(settings)
+        """Raises ValueError for a time that isn't a whole number of minutes."""
+        time_val = settings.get("time")
+        self.notify_minutes = int(time_val) if time_val not in (None, "") else None
 
-# ------------------------
-# Helper Functions
-# ------------------------
-def generate_otp():
-    otp = str(random.randint(100000, 999999))
-    print("Generated OTP:", otp)
-    return otp
+class UserFavorite(db.Model):
+    __tablename__ = 'user_favorite'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    route = db.Column(db.String(20), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    user = db.relationship('User', back_populates='favorites')
+    # "Who follows this route?" without touching every user.
+    __table_args__ = (db.Index('ix_user_favorite_route_user_id', 'route', 'user_id'),)
 
-def get_current_user():
-    phone = session.get("phone_number")
-    if phone:
-        return User.query.filter_by(phone_number=phone).first()
-    return None
+class AlertClaim(db.Model):
+    """Delivery dedup keys shared by every worker; see delivery.DatabaseDedupStore."""
+    __tablename__ = 'alert_claim'
+    key = db.Column(db.String(80), primary_key=True)
+    owner = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # Unix time
 
-def haversine(lat1, lng1, lat2, lng2):
-    R = 3958.8  # Radius in miles
-    dLat = math.radians(lat2 - lat1)
-    dLng = math.radians(lng2 - lng1)
-    a = math.sin(dLat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dLng/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+class OTPCode(db.Model):
+    """Login codes and per-phone send counters; see otp_store.DatabaseBackend."""
+    __tablename__ = 'otp_code'
+    key = db.Column(db.String(40), primary_key=True)
+    digest = db.Column(db.String(64))  # None for a send counter
+    count = db.Column(db.Integer, nullable=False, default=0)
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # Unix time
+
+# One-time login codes, shared by every gunicorn worker through the
+# database (or Redis with OTP_STORE_URL); see the other OTP_* settings.
+otp_store = create_otp_store(DatabaseBackend(db_engine, OTPCode.__table__))
+# Development only: a fixed code that signs in any phone without an SMS.
+# Unset (the default) in production, where it would bypass the attempt cap.
+OTP_TEST_CODE = os.getenv("OTP_TEST_CODE")
 
 # ------------------------
-# Load GTFS Stops Data (used for drawing the route line and markers)
+# Helper Functions
 # ------------------------
-stops = {}
-with open('./google_transit/stops.txt', newline='') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        stops[row['stop_id']] = {
-            'stop_id': row['stop_id'],
-            'stop_code': row['stop_code'],
-            'stop_name': row['stop_name'],
-            'stop_desc': row['stop_desc'],
-            'stop_lat': float(row['stop_lat']),
-            'stop_lon': float(row['stop_lon']),
-            'location_type': row['location_type'],
-            'parent_station': row['parent_station'],
-            'wheelchair_boarding': row['wheelchair_boarding']
-        }
+def generate_otp():
+    return str(100000 + secrets.randbelow(900000))
 
-def get_closest_stop(home_lat, home_lng, stops_dict):
-    closest_stop = None
-    min_distance = float("inf")
-    for stop in stops_dict.values():
-        d = haversine(home_lat, home_lng, stop["stop_lat"], stop["stop_lon"])
-        if d < min_distance:
-            min_distance = d
-            closest_stop = stop
-    return closest_stop
+def valid_coordinates(lat, lng):
+    """True for a finite latitude/longitude pair within range."""
+    return math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180
 
-def get_cta_bus_data_for_stop(stop_id):
-    CTA_API_KEY = os.getenv("CTA_API_KEY")
-    if not CTA_API_KEY:
-        raise Exception("CTA_API_KEY not set")
-    url = "http://www.ctabustracker.com/bustime/api/v2/getpredictions"
-    params = {"key": CTA_API_KEY, "stpid": stop_id, "format": "json"}
-    r = requests.get(url, params=params)
-    data = r.json()
-    predictions = []
-    if "bustime-response" in data and "prd" in data["bustime-response"]:
-        for prd in data["bustime-response"]["prd"]:
-            predictions.append({
-                "line": prd.get("rt"),
-                "arrival": prd.get("prdctdn")
-            })
-    return predictions
+def session_user_id():
+    """The signed-in user's id; sessions from before ids were stored are resolved by phone once."""
+    user_id = session.get("user_id")
+    if user_id is None and session.get("phone_number"):
+        user_id = db.session.execute(
+            db.select(User.id).filter_by(phone_number=session["phone_number"])).scalar()
+        if user_id is not None:
+            session["user_id"] = user_id
+    return user_id
 
-def get_cta_train_data_for_stop(stop_id):
-    CTA_TRAIN_API_KEY = os.getenv("CTA_TRAIN_API_KEY")
-    if not CTA_TRAIN_API_KEY:
-        raise Exception("CTA_TRAIN_API_KEY not set")
-    stop_info = stops.get(stop_id)
-    if stop_info:
-        stop_lat = stop_info['stop_lat']
-        stop_lon = stop_info['stop_lon']
-        stop_name = stop_info['stop_name']
-    else:
-        stop_lat = 41.8781
-        stop_lon = -87.6298
-        stop_name = "Unknown Stop"
-    url = "http://www.transitchicago.com/traintracker/api/1.0/getpredictions"
-    params = {"key": CTA_TRAIN_API_KEY, "stpid": stop_id, "format": "json"}
-    try:
-        r = requests.get(url, params=params)
-        data = r.json()
-        predictions = []
-        if "traintracker-response" in data and "prd" in data["traintracker-response"]:
-            for prd in data["traintracker-response"]["prd"]:
-                predictions.append({
-                    "line": prd.get("rt"),
-                    "arrival": prd.get("prdctdn")
-                })
-            return predictions
-        else:
-            raise Exception("Unexpected train API response structure")
-    except Exception as e:
-        print("Error fetching train data:", e)
-        return [
-            {"line": "Red", "arrival": "3"},
-            {"line": "Blue", "arrival": "5"}
-        ]
+def get_current_user():
+    """The signed-in User row (with favorites), loaded at most once per request. For writes."""
+    if "user" not in g:
+        user_id = session_user_id()
+        g.user = (db.session.get(User, user_id, options=[joinedload(User.favorites)])
+                  if user_id is not None else None)
+    return g.user
 
+def get_current_identity():
+    """A UserSnapshot of the signed-in user, from user_cache when fresh. For reads."""
+    if "identity" not in g:
+        user_id = session_user_id()
+        identity = user_cache.get(user_id) if user_id is not None and "user" not in g else None
+        if identity is None and user_id is not None:
+            user = get_current_user()
+            if user is not None:
+                identity = UserSnapshot.from_user(user)
+                user_cache.put(identity)
+        g.identity = identity
+    return g.identity
+
+def commit_user(user):
+    """Commit changes to user, drop its cached snapshot and re-sync its alerts."""
+    # Taken before the commit expires the row, so nothing is reloaded after it.
+    identity = UserSnapshot.from_user(user)
+    db.session.commit()
+    user_cache.invalidate(identity.id)
+    g.identity = identity
+    sync_subscription(identity)
 
 # ------------------------
-# API Endpoints for the Line and Stops (using stops.txt)
+# Load GTFS Stops Data (used for drawing the route line and markers)
 # ------------------------
+GTFS_DIR = './google_transit'
 
-@app.route('/api/line', methods=['GET'])
-def get_line():
+def build_line_geojson(stops_dict):
     # Sort stops by stop_id (converted to integer) to get a proper order.
-    sorted_stops = sorted(stops.values(), key=lambda s: int(s['stop_id']))
+    sorted_stops = sorted(stops_dict.values(), key=lambda s: int(s['stop_id']))
     # Build a list of coordinates in [longitude, latitude] order
     coordinates = [[s['stop_lon'], s['stop_lat']] for s in sorted_stops]
-    geojson_feature = {
+    return {
         "type": "Feature",
         "geometry": {
             "type": "LineString",
@@ -182,28 +218,386 @@ def get_line():
             "name": "Transit Route Line"
         }
     }
-    return jsonify(geojson_feature)
 
-@app.route('/api/stops', methods=['GET'])
-def get_stops():
+def stop_feature(s):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [s['stop_lon'], s['stop_lat']]
+        },
+        "properties": {
+            "stop_id": s['stop_id'],
+            "stop_name": s['stop_name']
+        }
+    }
+
+def build_stops_geojson(stops_dict):
+    features = [stop_feature(s) for s in stops_dict.values()]
+    return {
+        "type": "FeatureCollection",
+        "features": features
+    }
+
+# Detail level of the route lines drawn on the dashboard overview.
+GTFS_ROUTES_ZOOM = 13
+
+def build_gtfs_routes_geojson(new_feed, new_route_index, zoom=GTFS_ROUTES_ZOOM):
     features = []
-    for s in stops.values():
+    for summary in new_route_index.summaries():
+        shape_ids = [s for s in new_feed.route_shapes.get(summary["route_id"], ()) if s in new_feed.shapes]
+        if not shape_ids:
+            continue
         features.append({
             "type": "Feature",
             "geometry": {
-                "type": "Point",
-                "coordinates": [s['stop_lon'], s['stop_lat']]
+                "type": "MultiLineString",
+                "coordinates": [new_feed.shapes.coordinates(shape_id, zoom) for shape_id in shape_ids]
             },
             "properties": {
-                "stop_id": s['stop_id'],
-                "stop_name": s['stop_name']
+                "route": summary
             }
         })
-    geojson = {
+    return {
         "type": "FeatureCollection",
         "features": features
     }
-    return jsonify(geojson)
+
+# Source files each derived part depends on; a reload rebuilds a part only
+# when one of these changed.
+STOP_SOURCES = {"stops.txt"}
+ROUTE_SOURCES = {"stops.txt", "routes.txt", "trips.txt", "stop_times.txt"}
+ROUTE_SHAPE_SOURCES = ROUTE_SOURCES | {"shapes.txt"}
+
+def build_feed_state(new_feed, previous, changed):
+    """Parts of the FeedState for new_feed, reusing previous parts whose sources didn't change."""
+    parts = dict(previous.parts) if previous else {}
+    # Copied so the previous state's payloads are never touched.
+    payloads = dict(parts.get("payloads", {}))
+    rebuilt = []
+    last_modified = new_feed.last_modified
+    if previous is None or changed & STOP_SOURCES:
+        new_stops = new_feed.stops
+        parts["stops"] = new_stops
+        # Spatial index over the stops, built once so nearest-stop lookups
+        # don't scan every stop with haversine.
+        parts["stop_index"] = StopIndex(new_stops)
+        # The same stops as contiguous arrays, for resolving many origins at once.
+        parts["stop_coords"] = StopCoordinates(new_stops)
+        # Bucket grid for map viewport queries.
+        parts["stop_grid"] = GridIndex(new_stops)
+        payloads["line"] = PrecomputedPayload(build_line_geojson(new_stops), last_modified)
+        payloads["stops"] = PrecomputedPayload(build_stops_geojson(new_stops), last_modified)
+        rebuilt += ["stop_index", "stop_coords", "stop_grid", "line", "stops"]
+    if previous is None or changed & ROUTE_SOURCES:
+        # Route metadata, ordered stops and a per-route k-d tree.
+        parts["routes"] = new_feed.routes
+        parts["route_index"] = RouteIndex(new_feed)
+        payloads["routes"] = PrecomputedPayload(parts["route_index"].summaries(), last_modified)
+        rebuilt += ["route_index", "routes"]
+    if previous is None or changed & ROUTE_SHAPE_SOURCES:
+        payloads["gtfs_routes"] = PrecomputedPayload(build_gtfs_routes_geojson(new_feed, parts["route_index"]),
+                                                     last_modified)
+        rebuilt.append("gtfs_routes")
+    parts["payloads"] = payloads
+    return parts, rebuilt
+
+# Stops and routes are slotted records (stop['stop_lat'] still works). The
+# feed is published as a memory-mapped snapshot under google_transit/.snapshots
+# that every web and Celery process shares; each process follows the
+# published version and swaps in a new one without restarting.
+shared_feed = SharedFeed(GTFS_DIR, check_interval=float(os.getenv("GTFS_CHECK_INTERVAL", "5")))
+# The live FeedState. Request code reads feed_manager.state once and uses
+# that object throughout, so a concurrent swap can't mix two versions.
+feed_manager = FeedManager(shared_feed, build_feed_state)
+
+@feed_manager.on_swap
+def update_module_aliases(state):
+    # Convenience names for scripts and tests.
+    global feed, stops, routes
+    feed, stops, routes = state.feed, state.stops, state.routes
+
+update_module_aliases(feed_manager.state)
+
+@app.before_request
+def follow_published_feed():
+    shared_feed.refresh()
+
+def get_closest_stop(home_lat, home_lng, stops_dict):
+    state = feed_manager.state
+    index = state.stop_index if stops_dict is state.stops else StopIndex(stops_dict)
+    return index.closest(home_lat, home_lng)
+
+def assign_closest_stop(user):
+    """Store the stop nearest to the user's home on the user row."""
+    if user.home_lat is None or user.home_lng is None:
+        user.closest_stop_id = None
+        user.closest_stop_distance = None
+        return
+    stop = get_closest_stop(user.home_lat, user.home_lng, feed_manager.state.stops)
+    user.closest_stop_id = stop['stop_id'] if stop else None
+    user.closest_stop_distance = (haversine(user.home_lat, user.home_lng, stop['stop_lat'], stop['stop_lon'])
+                                  if stop else None)
+
+def refresh_closest_stops():
+    """Recompute the closest stop of every user with a home location; returns the count.
+
+    Written with a bulk UPDATE rather than by loading each row. The caller commits.
+    """
+    query = db.select(User.id, User.home_lat, User.home_lng).where(
+        User.home_lat.is_not(None), User.home_lng.is_not(None))
+    return len(reassign_closest_stops(query))
+
+def reassign_closest_stops(query):
+    """Closest stops for the (id, home_lat, home_lng) rows query selects, written in bulk.
+
+    Reads only those columns, so the sweep and web writers aren't held up
+    by a long ORM load. The caller commits. Returns the ids updated.
+    """
+    rows = db.session.execute(query).all()
+    if not rows:
+        return []
+    stop_coords = feed_manager.state.stop_coords
+    indices, distances = stop_coords.nearest([row.home_lat for row in rows], [row.home_lng for row in rows])
+    bulk_update(db.session, User, [
+        {"id": row.id,
+         "closest_stop_id": stop_coords.stop_ids[i] if i >= 0 else None,
+         "closest_stop_distance": float(d) if i >= 0 else None}
+        for row, i, d in zip(rows, indices, distances)
+    ])
+    return [row.id for row in rows]
+
+def reload_stops():
+    """Reload and publish the GTFS feed; if stops changed, reassign every user's stop.
+
+    Returns the reload's history entry, or None if the feed was unchanged.
+    Other processes pick up the published version on their next refresh.
+    """
+    entry = feed_manager.reload()
+    if entry is not None and STOP_SOURCES & set(entry["changed_files"]):
+        with app.app_context():
+            entry["users_reassigned"] = refresh_closest_stops()
+            db.session.commit()
+            user_cache.clear()
+            if subscription_index.ready and subscription_index.needs_sync:
+                rebuild_subscription_index()
+    return entry
+
+# Opt-in: set GTFS_WATCH on one process so edits to google_transit/ are
+# loaded and published; every other process follows through shared_feed.
+if os.getenv("GTFS_WATCH"):
+    FeedWatcher(GTFS_DIR, reload_stops, interval=float(os.getenv("GTFS_WATCH_INTERVAL", "30"))).start()
+
+# Pooled keep-alive client for Bus Tracker and Train Tracker (timeouts,
+# retries and a circuit breaker per endpoint); see CTA_* settings.
+cta_client = CTAClient.from_env()
+# Concurrent counterpart used when many stops/modes are needed at once.
+cta_async = AsyncCTAClient.from_client(cta_client)
+
+# Shared by the web routes and the Celery worker; see PREDICTION_CACHE_* settings.
+prediction_cache = create_prediction_cache()
+
+def get_cta_bus_data_for_stop(stop_id):
+    return prediction_cache.get_or_fetch("bus", stop_id, lambda: cta_client.bus_predictions([stop_id])[stop_id])
+
+def get_realtime_for_stops(stop_ids, modes=("bus", "train")):
+    """Cached predictions for every (mode, stop) pair, fetching all misses concurrently.
+
+    Pairs whose upstream call failed are missing from the result.
+    """
+    pairs = [(mode, stop_id) for stop_id in stop_ids for mode in modes]
+    return prediction_cache.get_multi(pairs, cta_async.fetch)
+
+# ------------------------
+# API Endpoints for the Line and Stops (using stops.txt)
+# ------------------------
+
+@app.route('/api/line', methods=['GET'])
+def get_line():
+    return feed_manager.state.payloads["line"].response(request)
+
+# At or above this zoom /api/stops?bbox= returns single stops; below it,
+# nearby stops are merged into clusters.
+STOP_CLUSTER_MAX_ZOOM = 15
+
+@app.route('/api/stops', methods=['GET'])
+def get_stops():
+    state = feed_manager.state
+    bbox = request.args.get("bbox")
+    if not bbox:
+        return state.payloads["stops"].response(request)
+    try:
+        min_lon, min_lat, max_lon, max_lat = [float(v) for v in bbox.split(",")]
+        zoom = int(request.args.get("zoom", STOP_CLUSTER_MAX_ZOOM))
+    except ValueError:
+        return jsonify({"error": "bbox must be minLon,minLat,maxLon,maxLat"}), 400
+    if (not all(math.isfinite(v) for v in (min_lon, min_lat, max_lon, max_lat))
+            or min_lon > max_lon or min_lat > max_lat or not 0 <= zoom <= 22):
+        return jsonify({"error": "bbox must be minLon,minLat,maxLon,maxLat"}), 400
+
+    if zoom >= STOP_CLUSTER_MAX_ZOOM:
+        features = [stop_feature(s) for s in state.stop_grid.within_bbox(min_lon, min_lat, max_lon, max_lat)]
+    else:
+        features = []
+        for members, lat, lng in state.stop_grid.clusters(min_lon, min_lat, max_lon, max_lat, zoom):
+            if len(members) == 1:
+                features.append(stop_feature(members[0]))
+            else:
+                features.append({
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [lng, lat]
+                    },
+                    "properties": {
+                        "cluster": True,
+                        "point_count": len(members)
+                    }
+                })
+    response = jsonify({"type": "FeatureCollection", "features": features})
+    response.add_etag()
+    response.headers["Cache-Control"] = "public, no-cache"
+    return response.make_conditional(request)
+
+# ------------------------
+# Route geometry (shapes.txt)
+# ------------------------
+
+def feed_cached_json(state, key, build):
+    """JSON response tagged with the feed version; a matching If-None-Match
+    gets a 304 without building the body."""
+    etag = f"{state.feed.version}-{key}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, no-cache"
+    return response
+
+def parse_zoom():
+    zoom = request.args.get("zoom")
+    if zoom is None:
+        return None
+    zoom = int(zoom)
+    if not 0 <= zoom <= 22:
+        raise ValueError("zoom out of range")
+    return zoom
+
+def shape_feature(shapes, shape_id, zoom):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": shapes.coordinates(shape_id, zoom)
+        },
+        "properties": {
+            "shape_id": shape_id
+        }
+    }
+
+@app.route('/api/shape/<shape_id>', methods=['GET'])
+def get_shape(shape_id):
+    try:
+        zoom = parse_zoom()
+    except ValueError:
+        return jsonify({"error": "zoom must be an integer between 0 and 22"}), 400
+    state = feed_manager.state
+    shapes = state.feed.shapes
+    if shape_id not in shapes:
+        return jsonify({"error": "Unknown shape."}), 404
+    level = level_for_zoom(zoom, shapes.levels)
+    return feed_cached_json(state, f"shape-{shape_id}-{level}", lambda: shape_feature(shapes, shape_id, zoom))
+
+@app.route('/api/route_shape', methods=['GET'])
+def get_route_shape():
+    route_id = request.args.get("route_id")
+    try:
+        zoom = parse_zoom()
+    except ValueError:
+        return jsonify({"error": "zoom must be an integer between 0 and 22"}), 400
+    state = feed_manager.state
+    shapes = state.feed.shapes
+    if route_id not in state.routes and route_id not in state.feed.route_shapes:
+        return jsonify({"error": "Unknown route."}), 404
+    shape_ids = [s for s in state.feed.route_shapes.get(route_id, ()) if s in shapes]
+    level = level_for_zoom(zoom, shapes.levels)
+    return feed_cached_json(state, f"route-{route_id}-{level}", lambda: {
+        "type": "FeatureCollection",
+        "features": [shape_feature(shapes, shape_id, zoom) for shape_id in shape_ids]
+    })
+
+# ------------------------
+# Routes (routes.txt, trips.txt, stop_times.txt)
+# ------------------------
+
+ROUTE_STOPS_LIMIT = 10
+
+@app.route('/api/routes', methods=['GET'])
+def get_routes():
+    return feed_manager.state.payloads["routes"].response(request)
+
+@app.route('/api/gtfs_routes', methods=['GET'])
+def get_gtfs_routes():
+    try:
+        zoom = parse_zoom()
+    except ValueError:
+        return jsonify({"error": "zoom must be an integer between 0 and 22"}), 400
+    state = feed_manager.state
+    levels = state.feed.shapes.levels
+    if zoom is None or level_for_zoom(zoom, levels) == level_for_zoom(GTFS_ROUTES_ZOOM, levels):
+        return state.payloads["gtfs_routes"].response(request)
+    return feed_cached_json(state, f"gtfs-routes-{level_for_zoom(zoom, levels)}",
+                            lambda: build_gtfs_routes_geojson(state.feed, state.route_index, zoom))
+
+@app.route('/api/route_stops', methods=['GET'])
+def get_route_stops():
+    route_index = feed_manager.state.route_index
+    route_id = request.args.get("route_id")
+    if route_id not in route_index.routes:
+        return jsonify({"error": "Unknown route."}), 404
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        limit = max(1, min(int(request.args.get("limit", ROUTE_STOPS_LIMIT)), 100))
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lng are required."}), 400
+    if not valid_coordinates(lat, lng):
+        return jsonify({"error": "Invalid coordinates."}), 400
+    if not route_index.has_stops(route_id):
+        return jsonify({"error": "No stop data for this route."}), 404
+    # Rounded to ~10 m so nearby callers share a cache entry.
+    lat, lng = round(lat, 4), round(lng, 4)
+    return feed_cached_json(feed_manager.state, f"route-stops-{route_id}-{lat}-{lng}-{limit}",
+                            lambda: route_index.stops_from(route_id, lat, lng, limit))
+
+# ------------------------
+# Feed administration (enabled by FEED_ADMIN_TOKEN)
+# ------------------------
+
+@app.route('/api/admin/feed', methods=['GET', 'POST'])
+def admin_feed():
+    token = os.getenv("FEED_ADMIN_TOKEN")
+    if not token:
+        return jsonify({"error": "Feed administration is disabled."}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify({"error": "Not authorized."}), 403
+    if request.method == 'POST':
+        # A multipart "feed" file or the zip as the raw request body.
+        upload = request.files.get("feed")
+        archive = upload.stream if upload else io.BytesIO(request.get_data())
+        try:
+            installed = install_feed_archive(archive, GTFS_DIR)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"installed": installed, "reload": reload_stops()})
+    state = feed_manager.state
+    return jsonify({
+        "version": state.feed.version,
+        "last_modified": state.feed.last_modified.isoformat(),
+        "files": state.feed.files,
+        "history": list(feed_manager.history),
+    })
 
 # ------------------------
 # (Other API Endpoints remain mostly the same)
@@ -214,14 +608,10 @@ def get_cta_bus_data():
     if not CTA_API_KEY:
         raise Exception("CTA_API_KEY not set")
     stop_id = request.args.get("stop_id", "4002")
-    url = "http://www.ctabustracker.com/bustime/api/v2/getpredictions"
-    params = {"key": CTA_API_KEY, "stpid": stop_id, "format": "json"}
-    r = requests.get(url, params=params)
-    data = r.json()
-    print("CTA Bus API Response:", data)
+    cached = get_cta_bus_data_for_stop(stop_id)
 
     # Use user's home coordinates if available; otherwise, default values.
-    user = get_current_user()
+    user = get_current_identity()
     if user and user.home_lat is not None and user.home_lng is not None:
         home_lat = user.home_lat
         home_lng = user.home_lng
@@ -230,14 +620,13 @@ def get_cta_bus_data():
         home_lng = -87.630
 
     predictions = []
-    if "bustime-response" in data and "prd" in data["bustime-response"]:
-        for prd in data["bustime-response"]["prd"]:
-            predictions.append({
-                "lat": home_lat,
-                "lng": home_lng,
-                "line": prd.get("rt"),
-                "arrival": prd.get("prdctdn")
-            })
+    for prd in cached:
+        predictions.append({
+            "lat": home_lat,
+            "lng": home_lng,
+            "line": prd.line,
+            "arrival": prd.arrival
+        })
     return predictions
 
 # Realtime Train Predictions (using stops.txt for accurate stop coordinates)
@@ -247,7 +636,7 @@ def get_cta_train_data():
         raise Exception("CTA_TRAIN_API_KEY not set")
 
     station_id = request.args.get("station_id", "1")
-    stop_info = stops.get(station_id)
+    stop_info = feed_manager.state.stops.get(station_id)
     if stop_info:
         stop_lat = stop_info['stop_lat']
         stop_lon = stop_info['stop_lon']
@@ -257,27 +646,20 @@ def get_cta_train_data():
         stop_lon = -87.6298
         stop_name = "Unknown Stop"
 
-    url = "http://www.transitchicago.com/traintracker/api/1.0/getpredictions"
-    params = {"key": CTA_TRAIN_API_KEY, "stpid": station_id, "format": "json"}
     try:
-        r = requests.get(url, params=params)
-        data = r.json()
-        print("CTA Train API Response:", data)
+        cached = prediction_cache.get_or_fetch("train", station_id, lambda: cta_client.train_predictions(station_id))
         predictions = []
-        if "traintracker-response" in data and "prd" in data["traintracker-response"]:
-            for prd in data["traintracker-response"]["prd"]:
-                predictions.append({
-                    "stop_name": stop_name,
-                    "lat": stop_lat,
-                    "lng": stop_lon,
-                    "line": prd.get("rt"),
-                    "arrival": prd.get("prdctdn")
-                })
-            return predictions
-        else:
-            raise Exception("Unexpected train API response structure")
+        for prd in cached:
+            predictions.append({
+                "stop_name": stop_name,
+                "lat": stop_lat,
+                "lng": stop_lon,
+                "line": prd.line,
+                "arrival": prd.arrival
+            })
+        return predictions
     except Exception as e:
-        print("Error fetching train data:", e)
+        log.warning("Error fetching train data: %s", e)
         return [
             {"stop_name": stop_name, "lat": stop_lat, "lng": stop_lon, "line": "Red", "arrival": "3 mins"},
             {"stop_name": stop_name, "lat": stop_lat, "lng": stop_lon, "line": "Blue", "arrival": "5 mins"}
@@ -299,6 +681,91 @@ def realtime():
     else:
         return jsonify({"error": "Invalid transit type"}), 400
 
+def realtime_entry(stop_id, modes, found):
+    stop_info = feed_manager.state.stops.get(stop_id)
+    entry = {
+        "stop_id": stop_id,
+        "stop_name": stop_info['stop_name'] if stop_info else "Unknown Stop",
+        "lat": stop_info['stop_lat'] if stop_info else None,
+        "lng": stop_info['stop_lon'] if stop_info else None,
+        "errors": []
+    }
+    for mode in modes:
+        if (mode, stop_id) in found:
+            entry[mode] = found[(mode, stop_id)]
+        else:
+            entry[mode] = []
+            entry["errors"].append(mode)
+    return entry
+
+# Upper bound on stops per /api/realtime/all request.
+MAX_REALTIME_STOPS = 25
+
+@app.route("/api/realtime/all")
+def realtime_all():
+    stop_ids = [s for s in request.args.get("stop_ids", "").split(",") if s]
+    modes = [m for m in request.args.get("types", "bus,train").split(",") if m]
+    if not stop_ids:
+        return jsonify({"error": "stop_ids required"}), 400
+    if len(stop_ids) > MAX_REALTIME_STOPS:
+        return jsonify({"error": f"At most {MAX_REALTIME_STOPS} stop_ids per request"}), 400
+    if not modes or any(m not in ("bus", "train") for m in modes):
+        return jsonify({"error": "Invalid transit type"}), 400
+    for mode, key in (("bus", "CTA_API_KEY"), ("train", "CTA_TRAIN_API_KEY")):
+        if mode in modes and not os.getenv(key):
+            return jsonify({"error": f"{key} not set"}), 500
+
+    found = get_realtime_for_stops(stop_ids, modes)
+    result = {stop_id: realtime_entry(stop_id, modes, found) for stop_id in stop_ids}
+    return jsonify(result)
+
+# ------------------------
+# Server-push realtime feed: one poller per watched stop, shared by every
+# open dashboard watching it.
+# ------------------------
+
+def fetch_stop_state(stop_id):
+    return realtime_entry(stop_id, ("bus", "train"), get_realtime_for_stops([stop_id]))
+
+realtime_hub = RealtimeHub(fetch_stop_state, interval=float(os.getenv("REALTIME_POLL_INTERVAL", "15")),
+                           max_pollers=int(os.getenv("REALTIME_MAX_POLLERS", "200")))
+# Comment lines sent while idle keep proxies from closing the stream and let
+# us notice disconnected clients.
+SSE_KEEPALIVE_SECONDS = 20
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+@app.route("/api/realtime/stream")
+def realtime_stream():
+    stop_id = request.args.get("stop_id")
+    if not stop_id:
+        return jsonify({"error": "stop_id required"}), 400
+    if stop_id not in feed_manager.state.stops:
+        return jsonify({"error": "Unknown stop."}), 404
+    for key in ("CTA_API_KEY", "CTA_TRAIN_API_KEY"):
+        if not os.getenv(key):
+            return jsonify({"error": f"{key} not set"}), 500
+    try:
+        sub = realtime_hub.subscribe(stop_id)
+    except PollerLimitError:
+        return jsonify({"error": "Too many stops are being watched; try again later."}), 429
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                message = sub.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield sse_message(*message)
+        finally:
+            realtime_hub.unsubscribe(sub)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # (Other endpoints like /api/routes, /api/set_home, /api/add_favorite, etc., remain unchanged)
 
 @app.route("/")
@@ -309,7 +776,7 @@ def index():
 
 @app.route("/dashboard")
 def dashboard():
-    user = get_current_user()
+    user = get_current_identity()
     if not user:
         return redirect(url_for("index"))
     # We now simply render the dashboard; the map will be built client‐side.
@@ -327,7 +794,10 @@ def send_otp():
     if not phone_number or not carrier:
         return jsonify({"status": "error", "message": "Phone number and carrier required."})
     otp = generate_otp()
-    OTPS[phone_number] = otp
+    retry_after = otp_store.issue(phone_number, otp)
+    if retry_after:
+        return jsonify({"status": "error",
+                        "message": f"Too many codes requested. Try again in {retry_after} seconds."}), 429
     try:
         send_sms_via_email(
             to_number=phone_number,
@@ -347,10 +817,18 @@ def verify_otp():
     otp = data.get("otp")
     if not phone_number or not otp:
         return jsonify({"status": "error", "message": "Phone number and OTP required."})
-    if OTPS.get(phone_number) == otp or otp == "123456":
+    if OTP_TEST_CODE and hmac.compare_digest(str(otp), OTP_TEST_CODE):
+        result = "ok"
+    else:
+        result = otp_store.verify(phone_number, otp)
+    if result == "ok":
         session["phone_number"] = phone_number
         session["authenticated"] = True
+        # Resolved from the phone number by the first request that needs it.
+        session.pop("user_id", None)
         return jsonify({"status": "success"})
+    if result == "locked":
+        return jsonify({"status": "error", "message": "Too many attempts. Request a new code."}), 429
     return jsonify({"status": "error", "message": "Invalid OTP."})
 
 @app.route("/api/set_home", methods=["POST"])
@@ -359,9 +837,18 @@ def set_home():
     if not user:
         return jsonify({"status": "error", "message": "Not authenticated."})
     data = request.get_json()
-    user.home_lat = data.get("lat")
-    user.home_lng = data.get("lng")
-    db.session.commit()
+    try:
+        lat = float(data["lat"]) if data.get("lat") is not None else None
+        lng = float(data["lng"]) if data.get("lng") is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Invalid coordinates."}), 400
+    if (lat is None) != (lng is None) or (lat is not None and not valid_coordinates(lat, lng)):
+        return jsonify({"status": "error", "message": "Invalid coordinates."}), 400
+    if lat != user.home_lat or lng != user.home_lng or user.closest_stop_id is None:
+        user.home_lat = lat
+        user.home_lng = lng
+        assign_closest_stop(user)
+    commit_user(user)
     return jsonify({"status": "success", "message": "Home location updated."})
 
 @app.route("/api/add_favorite", methods=["POST"])
@@ -381,7 +868,7 @@ def add_favorite():
         return jsonify({"status": "error", "message": "Route already in favorites."}), 400
     favorites.append(favorite)
     user.set_favorites(favorites)
-    db.session.commit()
+    commit_user(user)
     return jsonify({"status": "success", "message": "Route added to favorites."})
 
 @app.route("/api/remove_favorite", methods=["POST"])
@@ -395,7 +882,7 @@ def remove_favorite():
     if favorite in favorites:
         favorites.remove(favorite)
         user.set_favorites(favorites)
-        db.session.commit()
+        commit_user(user)
         return jsonify({"status": "success", "message": "Favorite removed."})
     return jsonify({"status": "error", "message": "Favorite not found."})
 
@@ -415,70 +902,379 @@ def set_notification():
         user.phone_number = phone
     if carrier:
         user.carrier = carrier
-    user.set_notification_settings(settings)
-    db.session.commit()
+    try:
+        user.set_notification_settings(settings)
+    except (TypeError, ValueError):
+        db.session.rollback()
+        return jsonify({"status": "error", "message": "Invalid notification time."})
+    commit_user(user)
     return jsonify({"status": "success", "message": "Notification settings updated."})
 
+# ------------------------
+# Instrumentation: request timing, /metrics and the opt-in profiler
+# ------------------------
+
+metrics = MetricsRegistry()
+http_latency = HistogramFamily()
+# Sweep timings: "shard" is one sweep_stops task, "run" a whole chord.
+sweep_latency = HistogramFamily()
+
+# Set PROFILE_TOKEN to profile single requests: send it in an X-Profile
+# header and the request's sampled stacks are written to PROFILE_DIR.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    profile = request.headers.get("X-Profile")
+    if PROFILE_TOKEN and profile and hmac.compare_digest(profile, PROFILE_TOKEN):
+        g.profiler = SamplingProfiler(threading.get_ident(), interval=PROFILE_INTERVAL).start()
+
+@app.after_request
+def record_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        # Streaming responses are timed to their first byte.
+        http_latency.observe(request.endpoint or "unmatched", time.perf_counter() - started)
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        path = profiler.stop().write(PROFILE_DIR, request.endpoint or "unmatched")
+        response.headers["X-Profile-File"] = os.path.basename(path)
+        log.info("Profiled %s %s: %d samples over %.3fs -> %s", request.method, request.path,
+                 profiler.samples, profiler.seconds, path)
+    return response
+
+def counters(stats, names, label="result"):
+    return [({label: name}, stats[name]) for name in names]
+
+metrics.histograms("http_request_seconds", "Time to respond, by Flask endpoint.", http_latency, "endpoint")
+metrics.histograms("cta_request_seconds", "CTA API call latency, by endpoint.", lambda: cta_client.latency, "endpoint")
+metrics.register("cta_circuit_open", "gauge", "1 while the endpoint's circuit breaker is open.",
+                 lambda: [({"endpoint": endpoint}, breaker.state == "open")
+                          for endpoint, breaker in cta_client.breakers.items()])
+metrics.register("prediction_cache_lookups_total", "counter", "Prediction cache lookups, by result.",
+                 lambda: counters(prediction_cache.stats(), ("hits", "misses", "coalesced")))
+metrics.register("user_cache_lookups_total", "counter", "Signed-in user cache lookups, by result.",
+                 lambda: counters(user_cache.stats(), ("hits", "misses")))
+metrics.histograms("db_query_seconds", "Database statement latency, by SQL verb.", db_latency, "statement")
+metrics.histograms("gtfs_feed_seconds", "GTFS feed load and state build times.", lambda: feed_manager.latency, "phase")
+metrics.histograms("smtp_seconds", "SMTP connect (TLS + login) and per-message send latency.",
+                   lambda: get_sms_dispatcher().pool.latency, "phase")
+metrics.register("sms_messages_total", "counter", "Texts handed to SMTP, by result.",
+                 lambda: counters(get_sms_dispatcher().stats(), ("sent", "failed")))
+metrics.register("smtp_connections_total", "counter", "SMTP connections opened.",
+                 lambda: [({}, get_sms_dispatcher().stats()["connections"])])
+metrics.histograms("notification_stage_seconds", "Notification pipeline stage run times.",
+                   lambda: {stage: pipeline_metrics.latency[stage] for stage in PipelineMetrics.STAGES}, "stage")
+metrics.register("notification_stage_items_total", "counter", "Items handled by each notification stage.",
+                 lambda: [({"stage": stage}, totals["items"])
+                          for stage, totals in pipeline_metrics.snapshot().items() if "items" in totals])
+metrics.histograms("notification_queue_wait_seconds", "Time from an alert being emitted to its text going out.",
+                   lambda: {"all": pipeline_metrics.latency["queue_wait"]}, "queue")
+metrics.histograms("notification_sweep_seconds", "Sweep shard and whole-run durations.", sweep_latency, "scope")
+metrics.register("realtime_watched_stops", "gauge", "Stops with a live poller feeding dashboards.",
+                 lambda: [({}, len(realtime_hub.watched_stops()))])
+metrics.register("realtime_streams", "gauge", "Open dashboard event streams.",
+                 lambda: [({}, sum(realtime_hub.watched_stops().values()))])
+
+@app.route("/metrics")
+def metrics_endpoint():
+    token = os.getenv("METRICS_TOKEN")
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify({"error": "Not authorized."}), 403
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
     app.run(debug=True)
 
 
+from celery import chord, group
+from celery.signals import worker_process_init
 from celery_app import celery
 
+@worker_process_init.connect
+def reset_db_pool(**kwargs):
+    """Prefork children must not reuse connections opened by the parent."""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+# Workers have no Flask server, so with WORKER_METRICS_PORT set each worker
+# process serves /metrics on the first free port from there up.
+WORKER_METRICS_PORT = os.getenv("WORKER_METRICS_PORT")
+
+@worker_process_init.connect
+def start_worker_metrics(**kwargs):
+    if not WORKER_METRICS_PORT:
+        return
+    base = int(WORKER_METRICS_PORT)
+    for port in range(base, base + 64):
+        try:
+            serve_metrics(metrics, port)
+        except OSError:
+            continue
+        log.info("Worker metrics on port %d", port)
+        return
+    log.warning("No free port for worker metrics from %d", base)
+
+# Texts go out from their own queue so a slow SMTP server never holds up
+# evaluation; see the "delivery" worker in the Procfile.
+DELIVERY_QUEUE = os.getenv("DELIVERY_QUEUE", "delivery")
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", "50"))
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "5"))
+DELIVERY_BACKOFF = float(os.getenv("DELIVERY_BACKOFF", "2"))
+
+# The sweep runs as a Celery chord: the subscribed stops are split into
+# shards of SWEEP_STOP_SHARD_SIZE that go out across however many workers
+# are up. Joining them for the run summary needs CELERY_RESULT_BACKEND;
+# without one the shards go out as a plain group. Users are read SWEEP_PAGE_SIZE rows at a time where they are
+# streamed at all.
+SWEEP_PAGE_SIZE = int(os.getenv("SWEEP_PAGE_SIZE", "1000"))
+SWEEP_STOP_SHARD_SIZE = int(os.getenv("SWEEP_STOP_SHARD_SIZE", "200"))
+
+def alertable_users():
+    """Users with a home location and at least one favorite."""
+    return db.select(User).where(User.home_lat.is_not(None), User.home_lng.is_not(None), User.favorites.any())
+
+def iter_cohort():
+    """Pages of (user, favorites) for every user who can get alerts."""
+    query = (alertable_users().options(selectinload(User.favorites))
+             .order_by(User.id).execution_options(yield_per=SWEEP_PAGE_SIZE))
+    for users in db.session.execute(query).scalars().partitions():
+        yield [(user, user.get_favorites()) for user in users]
+
+def subscribers_by_route(routes, stop_ids=None):
+    """route -> users following it, optionally only users at stop_ids, in one indexed query."""
+    routes = list(routes)
+    found = {route: [] for route in routes}
+    if not routes:
+        return found
+    query = (db.select(UserFavorite.route, User).join(User, User.id == UserFavorite.user_id)
+             .where(UserFavorite.route.in_(routes), User.home_lat.is_not(None), User.home_lng.is_not(None)))
+    if stop_ids is not None:
+        query = query.where(User.closest_stop_id.in_(list(stop_ids)))
+    for route, user in db.session.execute(query):
+        found[route].append(user)
+    return found
+
+def lookup_subscriptions(stop_ids, lines):
+    """(stop_id, line) -> Subscriptions, read from the user tables."""
+    found = {}
+    for line, users in subscribers_by_route(lines, stop_ids).items():
+        for user in users:
+            if user.phone_number and user.carrier:
+                found.setdefault((user.closest_stop_id, line), []).append(
+                    Subscription(user.id, user.phone_number, user.carrier, alert_threshold(user)))
+    return found
+
+def subscribed_stop_ids():
+    query = (db.select(User.closest_stop_id).distinct()
+             .where(User.closest_stop_id.is_not(None), User.home_lat.is_not(None), User.home_lng.is_not(None),
+                    User.favorites.any()))
+    return list(db.session.execute(query).scalars())
+
+def refresh_stale_closest_stops():
+    """Resolve closest stops missing from the current feed (or never set); returns the count."""
+    stops_dict = feed_manager.state.stops
+    stale_stops = [stop_id for stop_id in subscribed_stop_ids() if stop_id not in stops_dict]
+    query = (alertable_users().with_only_columns(User.id, User.home_lat, User.home_lng)
+             .where(User.closest_stop_id.is_(None) | User.closest_stop_id.in_(stale_stops)))
+    user_ids = reassign_closest_stops(query)
+    if user_ids:
+        db.session.commit()
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        resubscribe_users(user_ids)
+    return len(user_ids)
+
+def resubscribe_users(user_ids):
+    """Re-index users whose stop was changed by a bulk update rather than an endpoint.
+
+    Only a synced index that is already built needs this; an unbuilt one is
+    filled from the user tables by rebuild_subscription_index.
+    """
+    if not (subscription_index.ready and subscription_index.needs_sync):
+        return
+    for i in range(0, len(user_ids), SWEEP_PAGE_SIZE):
+        page = user_ids[i:i + SWEEP_PAGE_SIZE]
+        query = alertable_users().options(selectinload(User.favorites)).where(User.id.in_(page))
+        for user in db.session.execute(query).scalars():
+            subscribe_user(subscription_index, user, user.get_favorites())
+
 @celery.task
 def check_favorite_line_notifications():
+    """Start a sweep: one sweep_stops shard per run of subscribed stops, summarized by summarize_sweep."""
+    shared_feed.refresh()
     with app.app_context():
-        users = User.query.all()
-        for user in users:
-            # Skip users without a home location or favorites
-            if not user.home_lat or not user.home_lng:
-                continue
-            favorites = user.get_favorites()  # e.g., ["Red", "Blue"]
-            if not favorites:
-                continue
-            notification_settings = user.get_notification_settings()
-            try:
-                threshold = int(notification_settings.get("time", 5))
-            except ValueError:
-                threshold = 5
-
-            # Find the closest stop from our stops dictionary
-            closest_stop = get_closest_stop(user.home_lat, user.home_lng, stops)
-            if not closest_stop:
-                continue
-
-            stop_id = closest_stop['stop_id']
-
-            # Get realtime predictions for this stop (for both bus and train)
-            bus_predictions = get_cta_bus_data_for_stop(stop_id)
-            train_predictions = get_cta_train_data_for_stop(stop_id)
-            predictions = bus_predictions + train_predictions
-
-            for pred in predictions:
-                line = pred.get("line")
-                # Only consider if this prediction is for a favorite line.
-                if line in favorites:
-                    try:
-                        arrival = int(pred.get("arrival", "9999"))
-                    except ValueError:
-                        arrival = 9999
-                    if arrival <= threshold:
-                        message = (f"Alert: Your favorite line {line} is arriving in {arrival} minute(s) "
-                                   f"at {closest_stop.get('stop_name', 'your area')}.")
-                        # Send SMS if phone info is available.
-                        if user.phone_number and user.carrier:
-                            try:
-                                send_sms_via_email(
-                                    to_number=user.phone_number,
-                                    carrier=user.carrier,
-                                    subject="Transit Alert",
-                                    body=message,
-                                    app_config=app.config
-                                )
-                                print(f"Notification sent to {user.phone_number} for line {line}")
-                            except Exception as e:
-                                print(f"Failed to send SMS to {user.phone_number}: {e}")
-                        else:
-                            print(f"User {user.phone_number} has no phone details; cannot send notification.")
+        refresh_stale_closest_stops()
+        alert_dedup.prune()
+        if not subscription_index.ready:
+            rebuild_subscription_index()
+        stop_ids = sorted(subscription_index.stop_ids())
+    shards = [sweep_stops.s(stop_ids[i:i + SWEEP_STOP_SHARD_SIZE])
+              for i in range(0, len(stop_ids), SWEEP_STOP_SHARD_SIZE)]
+    run_id = uuid.uuid4().hex
+    summarized = bool(shards and celery.conf.result_backend)
+    if summarized:
+        chord(shards)(summarize_sweep.s(run_id, time.time()))
+    elif shards:
+        group(shards).apply_async()
+    log.info("Notification sweep %s: %d shard(s)%s", run_id, len(shards), "" if summarized else ", no summary",
+             extra={"run_id": run_id})
+    return {"run_id": run_id, "shards": len(shards), "summarized": summarized}
+
+@celery.task
+def sweep_stops(stop_ids):
+    """Evaluation stage for a run of subscribed stops: emit delivery jobs for every alert due this tick."""
+    # Workers don't serve requests, so follow feed swaps at the start of each shard.
+    shared_feed.refresh()
+    start = time.perf_counter()
+    result = {"stops": len(stop_ids), "queued": 0, "already_sent": 0, "batches": 0}
+    with app.app_context():
+        result.update(enqueue_deliveries(match_subscriptions(subscription_index, stop_ids)))
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    sweep_latency.observe("shard", result["seconds"])
+    return result
+
+sweep_history = deque(maxlen=20)
+
+@celery.task
+def summarize_sweep(results, run_id, started_at):
+    """Chord callback: one summary per run, from every shard's counts."""
+    summary = {"run_id": run_id, "shards": len(results)}
+    for name in ("stops", "queued", "already_sent", "batches"):
+        summary[name] = sum(r[name] for r in results)
+    summary["slowest_shard_seconds"] = max((r["seconds"] for r in results), default=0.0)
+    summary["seconds"] = round(time.time() - started_at, 3)
+    sweep_history.append(summary)
+    sweep_latency.observe("run", summary["seconds"])
+    log.info("Notification sweep %s: %d stops in %d shard(s), %d alerts queued in %.2fs", run_id,
+             summary["stops"], summary["shards"], summary["queued"], summary["seconds"], extra=summary)
+    return summary
+
+def enqueue_deliveries(jobs):
+    start = time.perf_counter()
+    # Arrivals already texted are dropped here rather than queued; the
+    # delivery task checks again, so this is only a shortcut.
+    seen = alert_dedup.seen(job["key"] for job in jobs)
+    jobs = [job for job in jobs if job["key"] not in seen]
+    batches = 0
+    for i in range(0, len(jobs), DELIVERY_BATCH_SIZE):
+        deliver_alerts.apply_async(args=[jobs[i:i + DELIVERY_BATCH_SIZE]], queue=DELIVERY_QUEUE)
+        batches += 1
+    pipeline_metrics.record("enqueue", len(jobs), time.perf_counter() - start)
+    return {"queued": len(jobs), "already_sent": len(seen), "batches": batches}
+
+def delivery_backoff(retries):
+    # Full jitter, as in CTAClient.
+    return random.uniform(0, DELIVERY_BACKOFF * 2 ** retries)
+
+# acks_late: a worker that dies mid-batch leaves it on the queue, and the
+# dedup claims keep the redelivered copy from texting anyone twice.
+@celery.task(bind=True, max_retries=DELIVERY_MAX_RETRIES, acks_late=True)
+def deliver_alerts(self, jobs):
+    """Delivery stage: send a batch of jobs; safe to run more than once."""
+    # The task id survives retries, so it identifies this batch's claims.
+    result = alert_delivery.deliver(jobs, owner=self.request.id)
+    retry = result.pop("retry")
+    result["failed"] = len(retry)
+    if retry:
+        if self.request.retries < self.max_retries:
+            raise self.retry(args=[retry], countdown=delivery_backoff(self.request.retries))
+        alert_delivery.give_up(retry, owner=self.request.id)
+    return result
+
+
+# ------------------------
+# Notification pipeline: subscriptions are indexed by (stop, line); a sweep
+# fetches each subscribed stop once and looks its arrivals up in the index,
+# so the work follows the predictions rather than the number of users.
+# ------------------------
+
+def fetch_predictions_for_stops(stop_ids):
+    stop_ids = list(stop_ids)
+    if not stop_ids:
+        return {}
+    for key in ("CTA_API_KEY", "CTA_TRAIN_API_KEY"):
+        if not os.getenv(key):
+            raise Exception(f"{key} not set")
+    # Bus and train for every stop go out in one concurrent round.
+    found = get_realtime_for_stops(stop_ids)
+    train_fallback = [Prediction("Red", "3"), Prediction("Blue", "5")]
+    return {stop_id: found.get(("bus", stop_id), []) + found.get(("train", stop_id), train_fallback)
+            for stop_id in stop_ids}
+
+def alert_threshold(user):
+    try:
+        return int(user.get_notification_settings().get("time", 5))
+    except (TypeError, ValueError):
+        return 5
+
+def alert_message(line, arrival, stop):
+    return (f"Alert: Your favorite line {line} is arriving in {arrival} minute(s) "
+            f"at {stop.get('stop_name', 'your area')}.")
+
+def subscribe_user(index, user, favorites):
+    """Point user's entries in index at their stop and favorites; returns True if subscribed."""
+    if not (user.closest_stop_id and favorites):
+        index.unsubscribe(user.id)
+        return False
+    if not (user.phone_number and user.carrier):
+        log.info("User %s has no phone details; cannot send notification.", user.phone_number)
+        index.unsubscribe(user.id)
+        return False
+    subscription = Subscription(user.id, user.phone_number, user.carrier, alert_threshold(user))
+    index.subscribe(subscription, user.closest_stop_id, favorites)
+    return True
+
+def sync_subscription(user):
+    """Called after every write that changes who a user is alerted for."""
+    has_home = user.home_lat is not None and user.home_lng is not None
+    subscribe_user(subscription_index, user, user.get_favorites() if has_home else [])
+
+def rebuild_subscription_index():
+    """Load every user into subscription_index; returns the number subscribed."""
+    if not subscription_index.needs_sync:
+        return 0
+    subscribed = 0
+    for cohort in iter_cohort():
+        for user, favorites in cohort:
+            subscribed += subscribe_user(subscription_index, user, favorites)
+    subscription_index.mark_ready()
+    log.info("Subscription index rebuilt: %d users", subscribed)
+    return subscribed
+
+def match_subscriptions(index, stop_ids):
+    """Delivery jobs for every subscriber an arrival at stop_ids is due for."""
+    start = time.perf_counter()
+    # One state for the whole run, so a feed swap mid-sweep can't drop stops.
+    stops_dict = feed_manager.state.stops
+    stop_ids = [stop_id for stop_id in stop_ids if stop_id in stops_dict]
+    predictions = fetch_predictions_for_stops(stop_ids)
+    pipeline_metrics.record("fetch", len(stop_ids), time.perf_counter() - start)
+    start = time.perf_counter()
+    arrivals_by_stop = {stop_id: soonest_arrivals(predictions[stop_id]) for stop_id in stop_ids}
+    matched = sum(len(arrivals) for arrivals in arrivals_by_stop.values())
+    now = time.time()
+    jobs = []
+    for stop_id, subscription, line, arrival in index.match_stops(arrivals_by_stop):
+        message = alert_message(line, arrival, stops_dict[stop_id])
+        jobs.append(alert_job(subscription, stop_id, line, arrival, message, now))
+    pipeline_metrics.record("evaluate", matched, time.perf_counter() - start)
+    return jobs
+
+def get_sms_dispatcher():
+    return get_dispatcher(app.config)
+
+pipeline_metrics = PipelineMetrics()
+# Shared by every delivery worker through the database, or through Redis
+# with DELIVERY_DEDUP_URL.
+alert_dedup = create_dedup_store(DatabaseDedupStore(db_engine, AlertClaim.__table__))
+alert_delivery = AlertDelivery(alert_dedup, lambda: get_sms_dispatcher(), build_sms, pipeline_metrics)
+# Read from the user tables by default; with SUBSCRIPTION_INDEX_URL it is a
+# Redis copy kept in sync by the endpoints that change a user's stop,
+# favorites or settings.
+subscription_index = create_subscription_index(DatabaseSubscriptions(lookup_subscriptions, subscribed_stop_ids))
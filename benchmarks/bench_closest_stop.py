@@ -0,0 +1,64 @@
+"""Compare the k-d tree behind get_closest_stop with the old linear scan.
+
+Run from the repository root:
+
+    python benchmarks/bench_closest_stop.py [num_queries]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import get_closest_stop, haversine, stops  # noqa: E402
+from spatial import StopIndex  # noqa: E402
+
+
+def linear_closest_stop(home_lat, home_lng, stops_dict):
+    # The original implementation of get_closest_stop.
+    closest_stop = None
+    min_distance = float("inf")
+    for stop in stops_dict.values():
+        d = haversine(home_lat, home_lng, stop["stop_lat"], stop["stop_lon"])
+        if d < min_distance:
+            min_distance = d
+            closest_stop = stop
+    return closest_stop
+
+
+def run(label, points):
+    start = time.perf_counter()
+    expected = [linear_closest_stop(lat, lng, stops) for lat, lng in points]
+    scan = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [get_closest_stop(lat, lng, stops) for lat, lng in points]
+    indexed = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(expected, actual) if a is not b)
+    print(f"{label}:")
+    print(f"  linear scan:  {scan / len(points) * 1e6:.1f} us/query")
+    print(f"  k-d tree:     {indexed / len(points) * 1e6:.1f} us/query ({scan / indexed:.0f}x faster)")
+    print(f"  mismatches:   {mismatches}")
+
+
+def main(num_queries=2000):
+    rng = random.Random(42)
+
+    start = time.perf_counter()
+    StopIndex(stops)
+    build = time.perf_counter() - start
+    print(f"stops: {len(stops)}  queries: {num_queries}  index build: {build * 1000:.1f} ms")
+
+    # Homes scattered within a few blocks of real stops.
+    sample = rng.sample(list(stops.values()), num_queries)
+    run("near stops", [(s['stop_lat'] + rng.uniform(-0.005, 0.005), s['stop_lon'] + rng.uniform(-0.005, 0.005))
+                       for s in sample])
+    # Uniform over the service area bounding box, lake included.
+    run("uniform bbox", [(rng.uniform(41.64, 42.07), rng.uniform(-87.94, -87.52)) for _ in range(num_queries)])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
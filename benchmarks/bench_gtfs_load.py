@@ -0,0 +1,64 @@
+"""Startup time and memory of loading google_transit/ three ways.
+
+Each loader runs in a fresh interpreter so memory is not shared between runs:
+the original csv.DictReader dict-of-dicts, gtfs.load_feed parsing CSV, and
+gtfs.load_feed reading the binary snapshot. Run from the repository root:
+
+    python benchmarks/bench_gtfs_load.py
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import csv, gc, resource, sys, time, tracemalloc
+sys.path.insert(0, {root!r})
+import numpy  # imported up front so every variant pays for it equally
+import gtfs
+if {traced!r}:
+    tracemalloc.start()
+start = time.perf_counter()
+if {mode!r} == "legacy":
+    stops = {{}}
+    with open("google_transit/stops.txt", newline="") as f:
+        for row in csv.DictReader(f):
+            row["stop_lat"] = float(row["stop_lat"])
+            row["stop_lon"] = float(row["stop_lon"])
+            stops[row["stop_id"]] = row
+else:
+    stops = gtfs.load_feed("google_transit", use_snapshot={mode!r} == "snapshot").stops
+elapsed = time.perf_counter() - start
+gc.collect()
+retained, peak = tracemalloc.get_traced_memory()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(len(stops), elapsed, retained / 2**20, peak / 2**20, rss)
+"""
+
+
+def child(mode, traced):
+    out = subprocess.run([sys.executable, "-c", CHILD.format(root=ROOT, mode=mode, traced=traced)], cwd=ROOT,
+                         capture_output=True, text=True, check=True).stdout.splitlines()
+    return [float(v) for v in out[-1].split()]
+
+
+def measure(mode, repeat=5):
+    # Timing runs go without tracemalloc, which slows allocation down a lot.
+    elapsed = min(child(mode, False)[1] for _ in range(repeat))
+    count, _, retained, peak, rss = child(mode, True)
+    print(f"{mode:>9}: {int(count)} stops  {elapsed * 1000:6.1f} ms  "
+          f"retained {retained:5.1f} MiB  peak {peak:5.1f} MiB  max RSS {rss:6.1f} MiB")
+
+
+def main():
+    # Make sure a fresh snapshot exists before timing it.
+    subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {ROOT!r}); "
+                    "from gtfs import load_feed; load_feed('google_transit')"],
+                   cwd=ROOT, capture_output=True, check=True)
+    for mode in ("legacy", "csv", "snapshot"):
+        measure(mode)
+
+
+if __name__ == "__main__":
+    main()
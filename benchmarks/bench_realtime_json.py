@@ -0,0 +1,116 @@
+"""Per-request CPU time and allocations for a /api/realtime/all response.
+
+Compares the old path with the current one:
+
+- before: a dict per prediction, with the countdown int()-parsed in the
+  sweep, serialized by Flask's default JSON provider;
+- after: cta_client.Prediction records, serialized by FastJSONProvider.
+
+Each request parses a Bus Tracker response for the stops, builds the
+per-stop entries, serializes them and works out the soonest arrival per
+line, as the sweep does. Run from the repository root:
+
+    python benchmarks/bench_realtime_json.py [num_stops] [predictions_per_stop] [iterations]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from cta_client import parse_bus_response  # noqa: E402
+from payloads import FastJSONProvider, orjson  # noqa: E402
+from subscriptions import soonest_arrivals  # noqa: E402
+
+
+def old_parse_bus_response(data, stop_ids):
+    # The dict-per-prediction parser this replaced.
+    results = {stop_id: [] for stop_id in stop_ids}
+    for prd in data["bustime-response"]["prd"]:
+        if prd.get("stpid") in results:
+            results[prd["stpid"]].append({"line": prd.get("rt"), "arrival": prd.get("prdctdn")})
+    return results
+
+
+def old_soonest_arrivals(predictions):
+    arrivals = {}
+    for pred in predictions:
+        try:
+            arrival = int(pred.get("arrival", "9999"))
+        except ValueError:
+            continue
+        line = pred.get("line")
+        if arrival < arrivals.get(line, arrival + 1):
+            arrivals[line] = arrival
+    return arrivals
+
+
+def upstream_response(stop_ids, per_stop):
+    rng = random.Random(1)
+    routes = ["22", "36", "8", "9", "49", "X9", "151", "147"]
+    return {"bustime-response": {"prd": [
+        {"stpid": stop_id, "rt": rng.choice(routes), "prdctdn": rng.choice(["DUE"] + [str(m) for m in range(1, 30)]),
+         "tmstmp": "20261017 18:04", "typ": "A", "stpnm": "Clark & Belmont", "vid": "8123", "dstp": 4200,
+         "rtdir": "Northbound", "des": "Howard", "prdtm": "20261017 18:09", "tablockid": "22 -758",
+         "tatripid": "1008547", "dly": False, "zone": ""}
+        for stop_id in stop_ids for _ in range(per_stop)
+    ]}}
+
+
+def handle(data, stop_ids, parse, provider, soonest):
+    found = parse(data, stop_ids)
+    result = {stop_id: {"stop_id": stop_id, "stop_name": "Clark & Belmont", "lat": 41.9398, "lng": -87.6527,
+                        "errors": [], "bus": found[stop_id], "train": []}
+              for stop_id in stop_ids}
+    body = provider.response(result).get_data()
+    for stop_id in stop_ids:
+        soonest(found[stop_id])
+    return body, found
+
+
+def measure(label, data, stop_ids, parse, provider, soonest, iterations):
+    handle(data, stop_ids, parse, provider, soonest)  # warm up
+    start = time.process_time()
+    for _ in range(iterations):
+        handle(data, stop_ids, parse, provider, soonest)
+    cpu = (time.process_time() - start) / iterations
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    body, found = handle(data, stop_ids, parse, provider, soonest)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained = sum(stat.size for stat in after.compare_to(before, "filename"))
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    print(f"  {label:<7} {cpu * 1e6:9.1f} us CPU  {peak / 1024:8.1f} KiB peak  "
+          f"{retained / 1024:8.1f} KiB / {blocks:6d} blocks held by the parsed records + body")
+    return cpu, body
+
+
+def main():
+    num_stops = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    per_stop = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    stop_ids = [str(1000 + i) for i in range(num_stops)]
+    data = upstream_response(stop_ids, per_stop)
+    app = Flask("bench")
+
+    print(f"{num_stops} stops x {per_stop} predictions, {iterations} requests"
+          f"{'' if orjson else ' (orjson not installed: after uses the json module)'}")
+    with app.app_context():
+        old_cpu, old_body = measure("before", data, stop_ids, old_parse_bus_response, DefaultJSONProvider(app),
+                                    old_soonest_arrivals, iterations)
+        new_cpu, new_body = measure("after", data, stop_ids, parse_bus_response, FastJSONProvider(app),
+                                    soonest_arrivals, iterations)
+    print(f"  speedup: {old_cpu / new_cpu:.1f}x  body {len(old_body)} -> {len(new_body)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Peak memory and throughput of loading shapes.txt.
+
+Compares the streaming ingester (with Douglas–Peucker levels) against the
+earlier approach of collecting every row as Python tuples before building
+arrays. Uses google_transit/shapes.txt when it has been fetched from Git
+LFS; otherwise a synthetic file of the same size (~55 MB) is generated.
+
+    python benchmarks/bench_shapes_ingest.py [path/to/shapes.txt]
+"""
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gtfs import is_lfs_pointer  # noqa: E402
+from shapes import ingest_shapes  # noqa: E402
+
+TARGET_BYTES = 55_000_000
+
+
+def collect_then_build(path):
+    # The previous parse_shapes: every point becomes a tuple in a dict of
+    # lists before anything is packed into arrays.
+    points = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            points.setdefault(row['shape_id'], []).append(
+                (int(row['shape_pt_sequence']), float(row['shape_pt_lat']), float(row['shape_pt_lon'])))
+    total = sum(len(p) for p in points.values())
+    lat, lon = np.empty(total), np.empty(total)
+    pos = 0
+    for shape_id in list(points):
+        rows = sorted(points.pop(shape_id))
+        lat[pos:pos + len(rows)] = [r[1] for r in rows]
+        lon[pos:pos + len(rows)] = [r[2] for r in rows]
+        pos += len(rows)
+    return lat, lon
+
+
+def synthesize(path, target_bytes=TARGET_BYTES):
+    # Bus routes run along the street grid: straight runs of densely spaced
+    # points with small survey jitter, turning at intersections.
+    rng = random.Random(7)
+    step = 15 / 111_320  # ~15 m between points
+    with open(path, "w") as f:
+        f.write("shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n")
+        shape = 0
+        while f.tell() < target_bytes:
+            shape += 1
+            lat, lon, seq = rng.uniform(41.65, 42.05), rng.uniform(-87.9, -87.55), 0
+            for _ in range(rng.randint(8, 30)):
+                dlat, dlon = rng.choice(((step, 0), (-step, 0), (0, step * 1.34), (0, -step * 1.34)))
+                for _ in range(rng.randint(15, 110)):
+                    lat += dlat + rng.gauss(0, 0.000005)
+                    lon += dlon + rng.gauss(0, 0.000005)
+                    seq += 1
+                    f.write(f"6{shape:07d},{lat:.9f},{lon:.9f},{seq},{seq * 15}\n")
+
+
+def measure(label, fn, path, rows):
+    start = time.perf_counter()
+    fn(path)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = fn(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:>20}: {elapsed:6.2f} s  {rows / elapsed / 1e6:5.2f} M rows/s  peak {peak / 2**20:7.1f} MiB")
+    return result
+
+
+def main(path=None):
+    tmp = None
+    path = path or "google_transit/shapes.txt"
+    if not os.path.exists(path) or is_lfs_pointer(path):
+        tmp = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
+        tmp.close()
+        print("shapes.txt is not available; generating a synthetic one ...")
+        synthesize(tmp.name)
+        path = tmp.name
+    try:
+        with open(path) as f:
+            rows = sum(1 for _ in f) - 1
+        print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB, {rows} rows")
+        measure("collect then build", collect_then_build, path, rows)
+        shapes = measure("streaming ingest", ingest_shapes, path, rows)
+        print(f"{len(shapes)} shapes, {len(shapes.lat)} points; points kept per zoom level:")
+        for zoom, (_, index) in sorted(shapes.levels.items()):
+            print(f"  z{zoom}: {len(index)} ({len(index) / len(shapes.lat):.1%})")
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
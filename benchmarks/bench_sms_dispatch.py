@@ -0,0 +1,60 @@
+"""Compare a connection per text with the pooled SMSDispatcher.
+
+Runs against the local SMTP stand-in from test_sms_dispatcher, with a
+delay on connect to stand in for the TLS handshake and login to Gmail.
+Run from the repository root:
+
+    python benchmarks/bench_sms_dispatch.py [num_messages] [connect_delay]
+"""
+import os
+import smtplib
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sms_dispatcher import SMSDispatcher  # noqa: E402
+from test_sms_dispatcher import FakeSMTPServer, make_messages  # noqa: E402
+
+
+def send_one_by_one(settings, messages):
+    # What send_sms_via_email used to do for every text.
+    for message in messages:
+        server = smtplib.SMTP(settings.host, settings.port, timeout=settings.timeout)
+        server.login(settings.username, settings.password)
+        server.sendmail(settings.sender, message.recipient, message.as_mime(settings.sender))
+        server.quit()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    connect_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    messages = make_messages(n)
+
+    server = FakeSMTPServer(connect_delay=connect_delay, send_delay=0.002).start()
+    settings = server.settings()
+    try:
+        start = time.perf_counter()
+        send_one_by_one(settings, messages)
+        serial = time.perf_counter() - start
+        serial_connections = server.connections
+
+        server.connections = 0
+        dispatcher = SMSDispatcher(settings, pool_size=4, batch_size=25, default_rate=0)
+        start = time.perf_counter()
+        errors = dispatcher.send_many(messages)
+        pooled = time.perf_counter() - start
+        dispatcher.close()
+    finally:
+        server.stop()
+
+    assert errors == [None] * n
+    print(f"{n} messages, {connect_delay * 1000:.0f} ms connect+login")
+    print(f"  connection per message: {serial:7.2f}s  {n / serial:8.1f} msg/s  {serial_connections} connections")
+    print(f"  pooled dispatcher:      {pooled:7.2f}s  {n / pooled:8.1f} msg/s  {server.connections} connections")
+    print(f"  speedup: {serial / pooled:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
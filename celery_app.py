@@ -2,6 +2,8 @@ import os
 from celery import Celery
 
 celery = Celery(__name__,
+                # The tasks live in app.py; workers import it to find them.
+                include=["app"],
                 broker=os.getenv("CELERY_BROKER_URL"),
                 backend=os.getenv("CELERY_RESULT_BACKEND"))
 
@@ -0,0 +1,160 @@
+import asyncio
+import atexit
+import os
+import random
+import threading
+import time
+
+import aiohttp
+
+from cta_client import (BUS_STOPS_PER_REQUEST, CTA_BUS_API_URL, CTA_TRAIN_API_URL, CircuitOpenError,
+                        UpstreamError, parse_bus_response, parse_train_response)
+from logs import get_logger
+
+log = get_logger("cta_async")
+
+
+class AsyncCTAClient:
+    """aiohttp client that fetches bus and train predictions for many stops at once.
+
+    A private event loop runs on a daemon thread and owns one long-lived
+    ClientSession, so synchronous callers (Flask views, Celery tasks) share
+    its connection pool through fetch(). At most `concurrency` requests are
+    in flight at a time; transient failures are retried like CTAClient does.
+    """
+
+    def __init__(self, bus_url=CTA_BUS_API_URL, train_url=CTA_TRAIN_API_URL, concurrency=10,
+                 connect_timeout=3.05, read_timeout=10.0, max_retries=2, backoff=0.25, breakers=None,
+                 latency=None):
+        self.bus_url = bus_url
+        self.train_url = train_url
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        # Optionally shared with a CTAClient so both clients trip the same breaker.
+        self.breakers = breakers or {}
+        self.latency = latency or {}
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_client(cls, client, concurrency=None):
+        return cls(bus_url=client.bus_url, train_url=client.train_url,
+                   concurrency=concurrency or int(os.getenv("CTA_CONCURRENCY", "10")),
+                   connect_timeout=client.timeout[0], read_timeout=client.timeout[1],
+                   max_retries=client.max_retries, backoff=client.backoff, breakers=client.breakers, latency=client.latency)
+
+    def _ensure_loop(self):
+        # Started lazily, and again after a fork (gunicorn/Celery prefork)
+        # since the loop thread doesn't survive into the child.
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="cta-async", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+            if self._pid is None:
+                atexit.register(self.close)
+            self._loop = loop
+            self._pid = os.getpid()
+            return loop
+
+    async def _open(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(timeout=self.timeout,
+                                              connector=aiohttp.TCPConnector(limit=self.concurrency))
+
+    async def _get_json(self, endpoint, url, params):
+        breaker = self.breakers.get(endpoint)
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"CTA {endpoint} API circuit is open")
+        for attempt in range(self.max_retries + 1):
+            try:
+                data = await self._request(endpoint, url, params)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, UpstreamError):
+                if attempt == self.max_retries:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    raise
+                # Backoff happens outside the semaphore so waiting retries don't hold a slot.
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                continue
+            except Exception:
+                if breaker is not None:
+                    breaker.record_failure()
+                raise
+            if breaker is not None:
+                breaker.record_success()
+            return data
+
+    async def _request(self, endpoint, url, params):
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                async with self._session.get(url, params=params) as r:
+                    if r.status >= 500 or r.status == 429:
+                        raise UpstreamError(f"CTA {endpoint} API returned HTTP {r.status}")
+                    r.raise_for_status()
+                    return await r.json(content_type=None)
+            finally:
+                if endpoint in self.latency:
+                    self.latency[endpoint].observe(time.perf_counter() - start)
+
+    async def bus_predictions(self, stop_ids):
+        CTA_API_KEY = os.getenv("CTA_API_KEY")
+        if not CTA_API_KEY:
+            raise Exception("CTA_API_KEY not set")
+        data = await self._get_json("bus", self.bus_url,
+                                    {"key": CTA_API_KEY, "stpid": ",".join(stop_ids), "format": "json"})
+        return parse_bus_response(data, stop_ids)
+
+    async def train_predictions(self, stop_id):
+        CTA_TRAIN_API_KEY = os.getenv("CTA_TRAIN_API_KEY")
+        if not CTA_TRAIN_API_KEY:
+            raise Exception("CTA_TRAIN_API_KEY not set")
+        data = await self._get_json("train", self.train_url,
+                                    {"key": CTA_TRAIN_API_KEY, "stpid": stop_id, "format": "json"})
+        return parse_train_response(data)
+
+    async def gather(self, pairs):
+        """Fetch (mode, stop_id) pairs concurrently; failed pairs are left out of the result."""
+        bus_ids = [stop_id for mode, stop_id in pairs if mode == "bus"]
+        train_ids = [stop_id for mode, stop_id in pairs if mode == "train"]
+        chunks = [bus_ids[i:i + BUS_STOPS_PER_REQUEST] for i in range(0, len(bus_ids), BUS_STOPS_PER_REQUEST)]
+        jobs = [self.bus_predictions(chunk) for chunk in chunks] + [self.train_predictions(s) for s in train_ids]
+        outcomes = await asyncio.gather(*jobs, return_exceptions=True)
+
+        results = {}
+        for chunk, outcome in zip(chunks, outcomes[:len(chunks)]):
+            if isinstance(outcome, Exception):
+                log.warning("Error fetching bus data for stops %s: %s", chunk, outcome)
+                continue
+            for stop_id, predictions in outcome.items():
+                results[("bus", stop_id)] = predictions
+        for stop_id, outcome in zip(train_ids, outcomes[len(chunks):]):
+            if isinstance(outcome, Exception):
+                log.warning("Error fetching train data for stop %s: %s", stop_id, outcome)
+                continue
+            results[("train", stop_id)] = outcome
+        return results
+
+    def fetch(self, pairs):
+        """Blocking wrapper around gather() for synchronous callers."""
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.gather(pairs), loop).result()
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            if self._pid == os.getpid():
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
@@ -0,0 +1,214 @@
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import LatencyHistogram
+
+CTA_BUS_API_URL = "http://www.ctabustracker.com/bustime/api/v2/getpredictions"
+CTA_TRAIN_API_URL = "http://www.transitchicago.com/traintracker/api/1.0/getpredictions"
+
+# Bus Tracker's getpredictions accepts up to 10 comma-separated stpids.
+BUS_STOPS_PER_REQUEST = 10
+
+
+def countdown_minutes(countdown):
+    """CTA's prdctdn as an int, or None for "DUE" and other non-numeric values."""
+    try:
+        return int(countdown)
+    except (TypeError, ValueError):
+        return None
+
+
+class Prediction:
+    """One arrival prediction, parsed once from the upstream response.
+
+    arrival is the countdown as CTA sends it, for display ("7", "DUE");
+    minutes is the same as an int, or None when it isn't a number. Only
+    line and arrival go over the wire (see to_dict).
+    """
+    __slots__ = ("line", "arrival", "minutes")
+
+    def __init__(self, line, arrival):
+        self.line = line
+        self.arrival = arrival
+        self.minutes = countdown_minutes(arrival)
+
+    def to_dict(self):
+        return {"line": self.line, "arrival": self.arrival}
+
+    def __eq__(self, other):
+        if not isinstance(other, Prediction):
+            return NotImplemented
+        return self.line == other.line and self.arrival == other.arrival
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Prediction({self.line!r}, {self.arrival!r})"
+
+
+def dump_predictions(predictions):
+    """Compact JSON for a cached list of predictions: [[line, arrival], ...]."""
+    return json.dumps([[p.line, p.arrival] for p in predictions], separators=(",", ":"))
+
+
+def load_predictions(raw):
+    return [Prediction(line, arrival) for line, arrival in json.loads(raw)]
+
+
+def parse_bus_response(data, stop_ids):
+    results = {stop_id: [] for stop_id in stop_ids}
+    if "bustime-response" in data and "prd" in data["bustime-response"]:
+        for prd in data["bustime-response"]["prd"]:
+            stop_id = prd.get("stpid")
+            # A single-stop request doesn't need stpid to attribute results.
+            if stop_id not in results and len(stop_ids) == 1:
+                stop_id = stop_ids[0]
+            if stop_id in results:
+                results[stop_id].append(Prediction(prd.get("rt"), prd.get("prdctdn")))
+    return results
+
+
+def parse_train_response(data):
+    if "traintracker-response" in data and "prd" in data["traintracker-response"]:
+        return [Prediction(prd.get("rt"), prd.get("prdctdn")) for prd in data["traintracker-response"]["prd"]]
+    raise Exception("Unexpected train API response structure")
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while an endpoint's breaker is open."""
+
+
+class UpstreamError(Exception):
+    """Retryable upstream failure (5xx or 429)."""
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and fails fast.
+
+    After `reset_timeout` seconds a single trial call is let through; success
+    closes the breaker again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class CTAClient:
+    """Bus Tracker / Train Tracker client over one pooled keep-alive session.
+
+    Every call has connect/read timeouts, retries transient failures a
+    bounded number of times with jittered exponential backoff, and goes
+    through a per-endpoint circuit breaker.
+    """
+
+    def __init__(self, bus_url=CTA_BUS_API_URL, train_url=CTA_TRAIN_API_URL,
+                 connect_timeout=3.05, read_timeout=10.0, max_retries=2, backoff=0.25,
+                 pool_size=20, failure_threshold=5, reset_timeout=30.0):
+        self.bus_url = bus_url
+        self.train_url = train_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breakers = {name: CircuitBreaker(failure_threshold, reset_timeout) for name in ("bus", "train")}
+        self.latency = {name: LatencyHistogram() for name in ("bus", "train")}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            bus_url=os.getenv("CTA_BUS_API_URL", CTA_BUS_API_URL),
+            train_url=os.getenv("CTA_TRAIN_API_URL", CTA_TRAIN_API_URL),
+            connect_timeout=float(os.getenv("CTA_CONNECT_TIMEOUT", "3.05")),
+            read_timeout=float(os.getenv("CTA_READ_TIMEOUT", "10")),
+            max_retries=int(os.getenv("CTA_MAX_RETRIES", "2")),
+        )
+
+    def _get(self, endpoint, url, params):
+        breaker = self.breakers[endpoint]
+        if not breaker.allow():
+            raise CircuitOpenError(f"CTA {endpoint} API circuit is open")
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+                if r.status_code >= 500 or r.status_code == 429:
+                    raise UpstreamError(f"CTA {endpoint} API returned HTTP {r.status_code}")
+                r.raise_for_status()
+                data = r.json()
+            except (requests.ConnectionError, requests.Timeout, UpstreamError):
+                self.latency[endpoint].observe(time.perf_counter() - start)
+                if attempt == self.max_retries:
+                    breaker.record_failure()
+                    raise
+                # Full jitter so retrying workers don't stampede upstream in lockstep.
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                continue
+            except Exception:
+                self.latency[endpoint].observe(time.perf_counter() - start)
+                breaker.record_failure()
+                raise
+            self.latency[endpoint].observe(time.perf_counter() - start)
+            breaker.record_success()
+            return data
+
+    def bus_predictions(self, stop_ids):
+        """One getpredictions call for up to 10 stops, as {stop_id: [prediction, ...]}."""
+        CTA_API_KEY = os.getenv("CTA_API_KEY")
+        if not CTA_API_KEY:
+            raise Exception("CTA_API_KEY not set")
+        stop_ids = list(stop_ids)
+        data = self._get("bus", self.bus_url, {"key": CTA_API_KEY, "stpid": ",".join(stop_ids), "format": "json"})
+        return parse_bus_response(data, stop_ids)
+
+    def train_predictions(self, stop_id):
+        """Train Tracker predictions for a single stop."""
+        CTA_TRAIN_API_KEY = os.getenv("CTA_TRAIN_API_KEY")
+        if not CTA_TRAIN_API_KEY:
+            raise Exception("CTA_TRAIN_API_KEY not set")
+        data = self._get("train", self.train_url, {"key": CTA_TRAIN_API_KEY, "stpid": stop_id, "format": "json"})
+        return parse_train_response(data)
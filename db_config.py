@@ -0,0 +1,103 @@
+import os
+import time
+
+from sqlalchemy import event, update
+
+DEFAULT_DATABASE_URI = 'sqlite:///cta_tracker.db'
+
+# Applied to every new SQLite connection. WAL lets the web workers write
+# while the notification sweep reads (readers no longer block the writer,
+# nor it them); NORMAL only fsyncs at checkpoints, which WAL makes safe.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,         # ms to wait on a locked database before failing
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+BULK_BATCH_SIZE = 500
+
+# Query timings are labelled with the statement's verb; anything else is OTHER.
+SQL_VERBS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+
+def database_uri():
+    """DATABASE_URL if set (postgres:// is accepted for postgresql://), else the local SQLite file."""
+    uri = os.getenv("DATABASE_URL", DEFAULT_DATABASE_URI)
+    if uri.startswith("postgres://"):
+        uri = "postgresql://" + uri[len("postgres://"):]
+    return uri
+
+
+def sqlite_pragmas():
+    """SQLITE_PRAGMAS with SQLITE_BUSY_TIMEOUT / SQLITE_MMAP_SIZE overrides."""
+    pragmas = dict(SQLITE_PRAGMAS)
+    pragmas["busy_timeout"] = int(os.getenv("SQLITE_BUSY_TIMEOUT", pragmas["busy_timeout"]))
+    pragmas["mmap_size"] = int(os.getenv("SQLITE_MMAP_SIZE", pragmas["mmap_size"]))
+    return pragmas
+
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for uri.
+
+    Server databases get a bounded, pre-pinged pool sized by DB_POOL_SIZE /
+    DB_MAX_OVERFLOW / DB_POOL_TIMEOUT / DB_POOL_RECYCLE. SQLite keeps the
+    default pool; its lock waits come from the busy_timeout pragma.
+    """
+    if uri.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": True,
+    }
+
+
+def configure_engine(engine):
+    """Install the SQLite pragmas on engine's connections; no-op for other databases."""
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = sqlite_pragmas()
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def instrument_engine(engine, histograms):
+    """Time every statement engine runs into histograms (a metrics.HistogramFamily), by SQL verb."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        histograms.observe(verb if verb in SQL_VERBS else "OTHER", seconds)
+
+    @event.listens_for(engine, "handle_error")
+    def drop_timer(context):
+        # A failed statement never reaches after_cursor_execute.
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def bulk_update(session, model, rows, batch_size=BULK_BATCH_SIZE):
+    """UPDATE many rows of model by primary key inside session's transaction.
+
+    rows are dicts holding the primary key and the columns to set; each
+    batch goes out as one executemany. Objects already loaded in session
+    aren't refreshed. The caller commits. Returns the number of rows.
+    """
+    rows = list(rows)
+    for i in range(0, len(rows), batch_size):
+        session.execute(update(model), rows[i:i + batch_size])
+    return len(rows)
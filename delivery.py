@@ -0,0 +1,287 @@
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from logs import get_logger
+from metrics import LatencyHistogram
+from stores import MemoryStore, redis_client
+
+log = get_logger("delivery")
+
+# A key stays claimed until the predicted arrival plus this much slack, so
+# a bus that slips by a minute or two isn't announced twice.
+DEDUP_GRACE = 120
+
+SENT = "sent"
+
+
+def dedup_key(phone_number, stop_id, line):
+    """One alert per recipient, stop and line until the predicted arrival has passed."""
+    digits = re.sub(r'\D', '', phone_number or '')
+    return f"{digits}:{stop_id}:{line}"
+
+
+def alert_job(subscription, stop_id, line, arrival, message, now=None):
+    """JSON-serializable delivery job for one alert."""
+    now = time.time() if now is None else now
+    return {
+        "key": dedup_key(subscription.phone_number, stop_id, line),
+        "user_id": subscription.user_id,
+        "phone_number": subscription.phone_number,
+        "carrier": subscription.carrier,
+        "stop_id": stop_id,
+        "line": line,
+        "message": message,
+        "created_at": now,
+        "expires_at": now + arrival * 60 + DEDUP_GRACE,
+    }
+
+
+def _ttl(job):
+    return max(job["expires_at"] - time.time(), 1.0)
+
+
+class MemoryDedupStore:
+    """Dedup keys for a single worker process."""
+
+    def __init__(self, max_entries=100_000):
+        self._store = MemoryStore(max_entries)
+
+    def claim(self, key, owner, ttl):
+        """True if owner may send key: it was free, or owner already holds it."""
+        with self._store.lock:
+            return self._store.add(key, owner, ttl) or self._store.get(key) == owner
+
+    def mark_sent(self, key, ttl):
+        self._store.set(key, SENT, ttl)
+
+    def release(self, key, owner):
+        self._store.delete(key, owner)
+
+    def seen(self, keys):
+        return {key for key in keys if self._store.get(key) is not None}
+
+    def prune(self):
+        # Writes already evict expired keys.
+        return 0
+
+    def clear(self):
+        self._store.clear()
+
+
+class RedisDedupStore:
+    """Dedup keys shared by every worker; claims are SET NX with a TTL."""
+
+    def __init__(self, url, prefix="cta:alerts:"):
+        self._client = redis_client(url)
+        self.prefix = prefix
+
+    def _ms(self, ttl):
+        return max(int(ttl * 1000), 1)
+
+    def claim(self, key, owner, ttl):
+        if self._client.set(self.prefix + key, owner, nx=True, px=self._ms(ttl)):
+            return True
+        # A retry of the same task finds its own claim.
+        return self._client.get(self.prefix + key) == owner.encode()
+
+    def mark_sent(self, key, ttl):
+        self._client.set(self.prefix + key, SENT, px=self._ms(ttl))
+
+    def release(self, key, owner):
+        if self._client.get(self.prefix + key) == owner.encode():
+            self._client.delete(self.prefix + key)
+
+    def seen(self, keys):
+        keys = list(keys)
+        if not keys:
+            return set()
+        values = self._client.mget([self.prefix + key for key in keys])
+        return {key for key, value in zip(keys, values) if value is not None}
+
+    def prune(self):
+        # Redis expires keys itself.
+        return 0
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + "*"):
+            self._client.delete(key)
+
+
+class DatabaseDedupStore:
+    """Dedup keys as rows of table (key, owner, expires_at), shared by every
+    process on the same database.
+
+    The primary key on key makes a claim an INSERT that only one owner can
+    win; an expired row is taken over in place. get_engine is called per
+    operation so workers pick up the engine of their own process.
+    """
+
+    SEEN_BATCH = 500
+
+    def __init__(self, get_engine, table):
+        self.get_engine = get_engine
+        self.table = table
+
+    def claim(self, key, owner, ttl):
+        t = self.table
+        now = time.time()
+        try:
+            with self.get_engine().begin() as conn:
+                taken = conn.execute(update(t).where(t.c.key == key, (t.c.expires_at <= now) | (t.c.owner == owner))
+                                     .values(owner=owner, expires_at=now + ttl))
+                if taken.rowcount:
+                    return True
+                conn.execute(insert(t).values(key=key, owner=owner, expires_at=now + ttl))
+            return True
+        except IntegrityError:
+            return False
+
+    def mark_sent(self, key, ttl):
+        t = self.table
+        values = {"owner": SENT, "expires_at": time.time() + ttl}
+        with self.get_engine().begin() as conn:
+            if not conn.execute(update(t).where(t.c.key == key).values(**values)).rowcount:
+                conn.execute(insert(t).values(key=key, **values))
+
+    def release(self, key, owner):
+        t = self.table
+        with self.get_engine().begin() as conn:
+            conn.execute(delete(t).where(t.c.key == key, t.c.owner == owner))
+
+    def seen(self, keys):
+        t = self.table
+        keys = list(keys)
+        now = time.time()
+        found = set()
+        with self.get_engine().connect() as conn:
+            for i in range(0, len(keys), self.SEEN_BATCH):
+                query = select(t.c.key).where(t.c.key.in_(keys[i:i + self.SEEN_BATCH]), t.c.expires_at > now)
+                found.update(conn.execute(query).scalars())
+        return found
+
+    def prune(self):
+        """Delete expired rows; returns how many."""
+        t = self.table
+        with self.get_engine().begin() as conn:
+            return conn.execute(delete(t).where(t.c.expires_at <= time.time())).rowcount
+
+    def clear(self):
+        with self.get_engine().begin() as conn:
+            conn.execute(delete(self.table))
+
+
+def create_dedup_store(default=None):
+    """Redis when DELIVERY_DEDUP_URL is set, else default (in-process if None).
+
+    The delivery worker runs several prefork children, so the default has to
+    be shared between processes too; app passes a DatabaseDedupStore.
+    """
+    url = os.getenv("DELIVERY_DEDUP_URL")
+    if url:
+        return RedisDedupStore(url)
+    return default if default is not None else MemoryDedupStore()
+
+
+class PipelineMetrics:
+    """Per-stage counters and timings for the notification pipeline.
+
+    Each stage run records how many items it handled and how long it took:
+    fetch (stops' predictions), evaluate (arrivals matched against the
+    index), enqueue and deliver. "queue_wait" is the time from a job being
+    emitted to its text going out.
+    """
+
+    STAGES = ("fetch", "evaluate", "enqueue", "deliver")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {stage: {"runs": 0, "items": 0, "seconds": 0.0} for stage in self.STAGES}
+        self.latency = {stage: LatencyHistogram() for stage in self.STAGES + ("queue_wait",)}
+
+    def record(self, stage, items, seconds):
+        with self._lock:
+            totals = self._stages[stage]
+            totals["runs"] += 1
+            totals["items"] += items
+            totals["seconds"] += seconds
+        self.latency[stage].observe(seconds)
+        rate = items / seconds if seconds else 0.0
+        log.debug("Notification %s: %d in %.3fs (%.1f/s)", stage, items, seconds, rate,
+                  extra={"stage": stage, "items": items, "seconds": round(seconds, 4)})
+
+    def observe_wait(self, seconds):
+        self.latency["queue_wait"].observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: dict(totals) for stage, totals in self._stages.items()}
+        for stage, totals in stages.items():
+            totals["per_second"] = round(totals["items"] / totals["seconds"], 2) if totals["seconds"] else 0.0
+            totals["latency"] = self.latency[stage].snapshot()
+        stages["queue_wait"] = {"latency": self.latency["queue_wait"].snapshot()}
+        return stages
+
+
+class AlertDelivery:
+    """Sends delivery jobs at most once per dedup key.
+
+    deliver() claims each job's key for owner before sending, so a retried
+    task (same owner) picks up where it left off and a job emitted again on
+    a later beat tick is skipped. Sent keys stay marked until the arrival
+    has passed; keys of failed jobs stay claimed for the owner's retries
+    and are freed with give_up(). Jobs still queued once their arrival has
+    passed are dropped unsent.
+    """
+
+    def __init__(self, dedup, get_dispatcher, build_sms, metrics):
+        self.dedup = dedup
+        self.get_dispatcher = get_dispatcher
+        self.build_sms = build_sms
+        self.metrics = metrics
+
+    def deliver(self, jobs, owner):
+        """Returns {"sent", "skipped", "dropped", "expired", "retry": [jobs worth retrying]}."""
+        start = time.perf_counter()
+        pending, messages, skipped, dropped, expired = [], [], 0, 0, 0
+        now = time.time()
+        for job in jobs:
+            if job["expires_at"] <= now:
+                # A backlog or retries outlasted the arrival; the text would be wrong.
+                expired += 1
+                continue
+            if not self.dedup.claim(job["key"], owner, _ttl(job)):
+                skipped += 1
+                continue
+            try:
+                messages.append(self.build_sms(job["phone_number"], job["carrier"], "Transit Alert",
+                                               job["message"]))
+            except ValueError as e:
+                # An unknown carrier won't fix itself on retry.
+                log.warning("Failed to send SMS to %s: %s", job["phone_number"], e)
+                self.dedup.release(job["key"], owner)
+                dropped += 1
+                continue
+            pending.append(job)
+        retry = []
+        errors = self.get_dispatcher().send_many(messages) if messages else []
+        now = time.time()
+        for job, error in zip(pending, errors):
+            if error is None:
+                self.dedup.mark_sent(job["key"], _ttl(job))
+                self.metrics.observe_wait(now - job["created_at"])
+                log.info("Notification sent to %s for line %s", job["phone_number"], job["line"])
+            else:
+                retry.append(job)
+        self.metrics.record("deliver", len(pending) - len(retry), time.perf_counter() - start)
+        return {"sent": len(pending) - len(retry), "skipped": skipped, "dropped": dropped, "expired": expired,
+                "retry": retry}
+
+    def give_up(self, jobs, owner):
+        """Free the keys of jobs that won't be retried, so a later sweep can try again."""
+        for job in jobs:
+            self.dedup.release(job["key"], owner)
@@ -0,0 +1,79 @@
+import numpy as np
+
+from spatial import EARTH_RADIUS_MILES
+
+
+def haversine_many(lat1, lng1, lat2, lng2):
+    """Vectorized haversine in miles; arguments are degrees and broadcast like numpy arrays."""
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dLat = lat2 - lat1
+    dLng = np.radians(np.subtract(lng2, lng1))
+    a = np.sin(dLat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dLng / 2)**2
+    return EARTH_RADIUS_MILES * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class StopCoordinates:
+    """Stop coordinates held in contiguous float64 arrays for batch distance queries.
+
+    Row i of every array corresponds to the i-th stop of the dict the
+    instance was built from, so argmin ties resolve to the first stop just
+    like the scalar scan in get_closest_stop.
+    """
+
+    def __init__(self, stops_dict):
+        self.stops = list(stops_dict.values())
+        self.stop_ids = [s['stop_id'] for s in self.stops]
+        self.lat = np.ascontiguousarray([s['stop_lat'] for s in self.stops], dtype=np.float64)
+        self.lon = np.ascontiguousarray([s['stop_lon'] for s in self.stops], dtype=np.float64)
+        # Precomputed once; the per-query work only touches the origin terms.
+        self._lat_rad = np.radians(self.lat)
+        self._lon_rad = np.radians(self.lon)
+        self._cos_lat = np.cos(self._lat_rad)
+
+    def __len__(self):
+        return len(self.stops)
+
+    def _distances(self, lat_rad, lon_rad, cos_lat):
+        # lat_rad/lon_rad/cos_lat are column vectors (N, 1) for the origins.
+        dLat = self._lat_rad - lat_rad
+        dLng = self._lon_rad - lon_rad
+        a = np.sin(dLat / 2)**2 + cos_lat * self._cos_lat * np.sin(dLng / 2)**2
+        return EARTH_RADIUS_MILES * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    def distances_from(self, lat, lng):
+        """Distance in miles from one origin to every stop, shape (M,)."""
+        return self.distance_matrix([lat], [lng])[0]
+
+    def distance_matrix(self, lats, lngs):
+        """Distances in miles from N origins to every stop, shape (N, M)."""
+        lat_rad = np.radians(np.asarray(lats, dtype=np.float64)).reshape(-1, 1)
+        lon_rad = np.radians(np.asarray(lngs, dtype=np.float64)).reshape(-1, 1)
+        return self._distances(lat_rad, lon_rad, np.cos(lat_rad))
+
+    def nearest(self, lats, lngs, chunk_size=256):
+        """Index of, and distance to, the closest stop for each of N origins.
+
+        Origins are processed chunk_size rows at a time so a large cohort
+        never materializes the full N x M matrix.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        indices = np.empty(len(lats), dtype=np.intp)
+        distances = np.empty(len(lats), dtype=np.float64)
+        if not len(self.stops):
+            indices.fill(-1)
+            distances.fill(np.inf)
+            return indices, distances
+        for start in range(0, len(lats), chunk_size):
+            end = start + chunk_size
+            matrix = self.distance_matrix(lats[start:end], lngs[start:end])
+            best = matrix.argmin(axis=1)
+            indices[start:end] = best
+            distances[start:end] = matrix[np.arange(len(best)), best]
+        return indices, distances
+
+    def nearest_stops(self, lats, lngs, chunk_size=256):
+        """Like nearest() but returns the stop dicts themselves."""
+        indices, _ = self.nearest(lats, lngs, chunk_size)
+        return [self.stops[i] if i >= 0 else None for i in indices]
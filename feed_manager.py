@@ -0,0 +1,215 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from datetime import datetime, timezone
+
+from gtfs import SOURCE_FILES, changed_files
+from logs import get_logger
+from metrics import LatencyHistogram
+
+log = get_logger("feed")
+
+# Loads and rebuilds take seconds, not milliseconds.
+FEED_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Files a feed must contain to be installed.
+REQUIRED_FILES = ('stops.txt',)
+
+
+class FeedState:
+    """Everything derived from one feed version.
+
+    A state is never modified once built; a reload builds a new one next to
+    it (reusing parts whose source files did not change) and replaces the
+    reference in one assignment, so a request that read the old state keeps
+    a consistent view until it finishes.
+    """
+
+    def __init__(self, feed, **parts):
+        self.feed = feed
+        self.parts = parts
+
+    def __getattr__(self, name):
+        try:
+            return self.parts[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FeedManager:
+    """Holds this process's FeedState and swaps it when the feed changes.
+
+    build(feed, previous, changed) returns (parts, rebuilt): the parts for
+    the new state and the names of the parts it had to rebuild. previous is
+    the current state (None on first build) and changed is the set of
+    source files that differ from it. Every swap is recorded in history.
+    """
+
+    def __init__(self, shared_feed, build, history_size=20):
+        self.shared_feed = shared_feed
+        self.build = build
+        self.history = deque(maxlen=history_size)
+        # load: reading a version (CSV or snapshot); build: deriving its state.
+        self.latency = {"load": LatencyHistogram(FEED_BUCKETS), "build": LatencyHistogram(FEED_BUCKETS)}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.state = None
+        self._apply(shared_feed.feed)
+        shared_feed.on_change(self._apply)
+
+    def on_swap(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    def _apply(self, feed):
+        with self._lock:
+            previous = self.state
+            changed = set(SOURCE_FILES) if previous is None else changed_files(previous.feed, feed)
+            start = time.perf_counter()
+            parts, rebuilt = self.build(feed, previous, changed)
+            state = FeedState(feed, **parts)
+            build_seconds = time.perf_counter() - start
+            self.state = state
+            entry = {
+                "version": feed.version,
+                "previous_version": previous.feed.version if previous else None,
+                "changed_files": sorted(changed),
+                "rebuilt": sorted(rebuilt),
+                "load_seconds": round(feed.load_seconds or 0.0, 4),
+                "build_seconds": round(build_seconds, 4),
+                "swapped_at": datetime.now(timezone.utc).isoformat(),
+            }
+            self.history.append(entry)
+            self.latency["load"].observe(feed.load_seconds or 0.0)
+            self.latency["build"].observe(build_seconds)
+        log.info("GTFS feed %s live: changed %s, rebuilt %s in %.2fs", entry["version"],
+                 entry["changed_files"] or "nothing", entry["rebuilt"] or "nothing", build_seconds,
+                 extra={"feed_version": entry["version"], "build_seconds": entry["build_seconds"]})
+        for callback in self._listeners:
+            callback(state)
+        return state
+
+    def reload(self):
+        """Re-read the source files; returns the history entry if the feed changed."""
+        before = self.state.feed.version
+        self.shared_feed.reload()
+        return self.history[-1] if self.state.feed.version != before else None
+
+
+def _signature(feed_dir):
+    signature = {}
+    for name in SOURCE_FILES:
+        try:
+            st = os.stat(os.path.join(feed_dir, name))
+        except FileNotFoundError:
+            continue
+        signature[name] = (st.st_size, st.st_mtime_ns)
+    return signature
+
+
+class FeedWatcher(threading.Thread):
+    """Polls the feed directory and calls on_change once edits settle.
+
+    A change is acted on only after the files look the same on two polls
+    in a row, so a feed that is still being copied in isn't loaded half-way.
+    """
+
+    def __init__(self, feed_dir, on_change, interval=30.0):
+        super().__init__(name="gtfs-watcher", daemon=True)
+        self.feed_dir = feed_dir
+        self.on_change = on_change
+        self.interval = interval
+        self.stopped = threading.Event()
+        self._seen = _signature(feed_dir)
+        self._pending = None
+
+    def poll(self):
+        """One watch step; returns True if on_change was called."""
+        signature = _signature(self.feed_dir)
+        if signature == self._seen:
+            return False
+        if self._pending != signature:
+            self._pending = signature
+            return False
+        self._seen = signature
+        self._pending = None
+        self.on_change()
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                log.exception("GTFS feed reload failed: %s", e)
+
+
+def install_feed_archive(archive, feed_dir):
+    """Unpack a GTFS zip (path or file object) into feed_dir.
+
+    Only the known GTFS files are taken from the archive, wherever they sit
+    in it, and the archive replaces the whole feed: source files it lacks
+    are removed so two versions are never mixed. Everything is extracted and
+    checked in a staging directory first; if moving the set into place
+    fails, the previous files are put back. Returns the names of the
+    installed files; raises ValueError for an unusable archive.
+    """
+    try:
+        bundle = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile:
+        raise ValueError("Feed upload must be a zip archive.")
+    with bundle:
+        members = {}
+        for info in bundle.infolist():
+            name = os.path.basename(info.filename)
+            if name in SOURCE_FILES and not info.is_dir():
+                members[name] = info
+        missing = [name for name in REQUIRED_FILES if name not in members]
+        if missing:
+            raise ValueError(f"Feed archive is missing {', '.join(missing)}.")
+        staging = tempfile.mkdtemp(prefix=".upload-", dir=feed_dir)
+        try:
+            for name, info in members.items():
+                with bundle.open(info) as src, open(os.path.join(staging, name), 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            with open(os.path.join(staging, 'stops.txt'), newline='') as f:
+                header = f.readline()
+            if 'stop_id' not in header or 'stop_lat' not in header:
+                raise ValueError("stops.txt does not look like a GTFS stops file.")
+            _swap_feed_files(staging, feed_dir, members)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return sorted(members)
+
+
+def _swap_feed_files(staging, feed_dir, names):
+    # The current files are hard-linked into a backup first, so files being
+    # replaced never go missing and a failure part-way can be rolled back.
+    backup = os.path.join(staging, ".previous")
+    os.mkdir(backup)
+    previous, installed = [], []
+    try:
+        for name in SOURCE_FILES:
+            path = os.path.join(feed_dir, name)
+            if os.path.exists(path):
+                os.link(path, os.path.join(backup, name))
+                previous.append(name)
+        for name in SOURCE_FILES:
+            path = os.path.join(feed_dir, name)
+            if name in names:
+                os.replace(os.path.join(staging, name), path)
+                installed.append(name)
+            elif name in previous:
+                os.remove(path)
+    except Exception:
+        for name in SOURCE_FILES:
+            path = os.path.join(feed_dir, name)
+            if name in previous:
+                os.replace(os.path.join(backup, name), path)
+            elif name in installed:
+                os.remove(path)
+        raise
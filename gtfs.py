@@ -0,0 +1,530 @@
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from logs import get_logger
+from shapes import Shapes, ingest_shapes
+
+log = get_logger("gtfs")
+
+# Bump when the snapshot layout changes so old snapshots are ignored.
+SNAPSHOT_FORMAT = 6
+SNAPSHOT_DIR = ".snapshots"
+CURRENT_NAME = "CURRENT"
+KEEP_VERSIONS = 3
+
+STOP_FIELDS = ('stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon',
+               'location_type', 'parent_station', 'wheelchair_boarding')
+SOURCE_FILES = ('stops.txt', 'routes.txt', 'shapes.txt', 'trips.txt', 'stop_times.txt')
+ROUTE_FIELDS = ('route_id', 'route_short_name', 'route_long_name', 'route_type', 'route_url',
+                'route_color', 'route_text_color')
+
+
+class Record:
+    """Slotted GTFS row that still reads like the dicts the app used to build.
+
+    stop['stop_lat'] and stop.get('stop_name', default) keep working, but a
+    record costs a fraction of a 9-key dict.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Stop(Record):
+    __slots__ = STOP_FIELDS
+
+    def __init__(self, stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon,
+                 location_type, parent_station, wheelchair_boarding):
+        self.stop_id = stop_id
+        self.stop_code = stop_code
+        self.stop_name = stop_name
+        self.stop_desc = stop_desc
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+        self.location_type = location_type
+        self.parent_station = parent_station
+        self.wheelchair_boarding = wheelchair_boarding
+
+
+class Route(Record):
+    __slots__ = ROUTE_FIELDS
+
+    def __init__(self, route_id, route_short_name, route_long_name, route_type, route_url,
+                 route_color, route_text_color):
+        self.route_id = route_id
+        self.route_short_name = route_short_name
+        self.route_long_name = route_long_name
+        self.route_type = route_type
+        self.route_url = route_url
+        self.route_color = route_color
+        self.route_text_color = route_text_color
+
+
+class Feed:
+    def __init__(self, stops, routes, shapes, version, last_modified, route_shapes=None, route_patterns=None,
+                 files=None):
+        self.stops = stops
+        self.routes = routes
+        self.shapes = shapes
+        self.version = version
+        self.last_modified = last_modified
+        # route_id -> tuple of shape_ids, from trips.txt when the feed has it.
+        self.route_shapes = route_shapes or {}
+        # route_id -> ordered stop_id tuples, one per direction, from
+        # trips.txt and stop_times.txt when the feed has them.
+        self.route_patterns = route_patterns or {}
+        # Source file name -> content hash, for telling which parts changed.
+        self.files = files or {}
+        self.load_seconds = None
+
+
+def is_lfs_pointer(path):
+    # Large GTFS files are kept in Git LFS; a checkout without LFS leaves a
+    # tiny text pointer in their place.
+    with open(path, 'rb') as f:
+        return f.read(40).startswith(b"version https://git-lfs")
+
+
+def _source_files(feed_dir):
+    return [os.path.join(feed_dir, name) for name in SOURCE_FILES
+            if os.path.exists(os.path.join(feed_dir, name))]
+
+
+def file_digests(feed_dir):
+    """{file name: content hash} for the source files present in feed_dir."""
+    digests = {}
+    for path in _source_files(feed_dir):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digests[os.path.basename(path)] = digest.hexdigest()[:16]
+    return digests
+
+
+def feed_version(feed_dir, digests=None):
+    """Content hash of the source files plus the snapshot format."""
+    if digests is None:
+        digests = file_digests(feed_dir)
+    digest = hashlib.sha256(str(SNAPSHOT_FORMAT).encode())
+    for name in sorted(digests):
+        digest.update(f"{name}:{digests[name]}".encode())
+    return digest.hexdigest()[:16]
+
+
+def changed_files(old, new):
+    """Source file names whose contents differ between two feeds."""
+    return {name for name in set(old.files) | set(new.files) if old.files.get(name) != new.files.get(name)}
+
+
+def _last_modified(feed_dir):
+    mtimes = [os.path.getmtime(path) for path in _source_files(feed_dir)]
+    return datetime.fromtimestamp(max(mtimes), timezone.utc)
+
+
+# ------------------------
+# CSV parsing
+# ------------------------
+
+def parse_stops(path):
+    stops = {}
+    intern = sys.intern
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            stop_id = intern(row['stop_id'])
+            stops[stop_id] = Stop(
+                stop_id,
+                intern(row['stop_code']),
+                intern(row['stop_name']),
+                intern(row['stop_desc']),
+                float(row['stop_lat']),
+                float(row['stop_lon']),
+                intern(row['location_type']),
+                intern(row['parent_station']),
+                intern(row['wheelchair_boarding']),
+            )
+    return stops
+
+
+def parse_routes(path):
+    routes = {}
+    if not os.path.exists(path):
+        return routes
+    intern = sys.intern
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            route = Route(*(intern(row.get(name, '')) for name in ROUTE_FIELDS))
+            routes[route.route_id] = route
+    return routes
+
+
+def parse_shapes(path):
+    if not os.path.exists(path) or is_lfs_pointer(path):
+        return Shapes.empty()
+    return ingest_shapes(path)
+
+
+def parse_route_shapes(path):
+    """route_id -> shape_ids used by its trips, streamed from trips.txt."""
+    if not os.path.exists(path) or is_lfs_pointer(path):
+        return {}
+    route_shapes = {}
+    intern = sys.intern
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if 'shape_id' not in header:
+            return {}
+        i_route, i_shape = header.index('route_id'), header.index('shape_id')
+        for row in reader:
+            if row and row[i_shape]:
+                route_shapes.setdefault(intern(row[i_route]), {})[intern(row[i_shape])] = None
+    return {route_id: tuple(shape_ids) for route_id, shape_ids in route_shapes.items()}
+
+
+def parse_route_patterns(trips_path, stop_times_path):
+    """route_id -> ordered stop_id tuples, using the longest trip in each direction.
+
+    stop_times.txt is streamed one trip at a time; feeds list each trip's
+    rows together, and a trip that reappears is just compared again.
+    """
+    for path in (trips_path, stop_times_path):
+        if not os.path.exists(path) or is_lfs_pointer(path):
+            return {}
+    intern = sys.intern
+    trips = {}
+    with open(trips_path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i_trip, i_route = header.index('trip_id'), header.index('route_id')
+        i_direction = header.index('direction_id') if 'direction_id' in header else None
+        for row in reader:
+            if row:
+                direction = row[i_direction] if i_direction is not None else ''
+                trips[row[i_trip]] = (intern(row[i_route]), direction)
+
+    longest = {}
+
+    def finish(trip_id, stop_times):
+        key = trips.get(trip_id)
+        if key is not None and len(stop_times) > len(longest.get(key, ())):
+            stop_times.sort()
+            longest[key] = tuple(intern(stop_id) for _, stop_id in stop_times)
+
+    with open(stop_times_path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i_trip, i_stop, i_seq = header.index('trip_id'), header.index('stop_id'), header.index('stop_sequence')
+        current, stop_times = None, []
+        for row in reader:
+            if not row:
+                continue
+            if row[i_trip] != current:
+                if stop_times:
+                    finish(current, stop_times)
+                current, stop_times = row[i_trip], []
+            stop_times.append((int(row[i_seq]), row[i_stop]))
+        if stop_times:
+            finish(current, stop_times)
+
+    patterns = {}
+    for (route_id, _), stop_ids in sorted(longest.items()):
+        patterns.setdefault(route_id, []).append(stop_ids)
+    return {route_id: tuple(p) for route_id, p in patterns.items()}
+
+
+def parse_feed(feed_dir, version, files=None):
+    return Feed(parse_stops(os.path.join(feed_dir, 'stops.txt')),
+                parse_routes(os.path.join(feed_dir, 'routes.txt')),
+                parse_shapes(os.path.join(feed_dir, 'shapes.txt')),
+                version, _last_modified(feed_dir),
+                parse_route_shapes(os.path.join(feed_dir, 'trips.txt')),
+                parse_route_patterns(os.path.join(feed_dir, 'trips.txt'),
+                                     os.path.join(feed_dir, 'stop_times.txt')),
+                files)
+
+
+# ------------------------
+# Shared snapshots
+# ------------------------
+#
+# Each feed version is written once as uncompressed .npy columns under
+# <feed_dir>/.snapshots/<version>/ and opened with mmap_mode='r', so every
+# gunicorn and Celery process maps the same page-cache pages instead of
+# holding its own copy of the arrays. CURRENT names the published version
+# and is only ever replaced atomically.
+
+# Text columns are stored as one UTF-8 blob per column with a separator
+# that never appears in GTFS text, which decodes far faster than
+# fixed-width unicode arrays and keeps the snapshot free of pickles.
+_SEP = "\x1f"
+
+
+def _text_column(values):
+    return np.frombuffer(_SEP.join(values).encode(), dtype=np.uint8)
+
+
+def _read_text(column, count):
+    if count == 0:
+        return []
+    # Interning shares repeated values (stop_code is usually stop_id,
+    # parent_station repeats per platform) between records.
+    return list(map(sys.intern, column.tobytes().decode().split(_SEP)))
+
+
+def snapshot_root(feed_dir):
+    return os.path.join(feed_dir, SNAPSHOT_DIR)
+
+
+def write_snapshot(root, feed):
+    """Write feed under root/<version>/ unless that version already exists."""
+    final = os.path.join(root, feed.version)
+    if os.path.isdir(final):
+        return final
+    stop_list = list(feed.stops.values())
+    route_list = list(feed.routes.values())
+    shapes = feed.shapes
+    columns = {
+        "stop_lat": np.array([s.stop_lat for s in stop_list], dtype=np.float64),
+        "stop_lon": np.array([s.stop_lon for s in stop_list], dtype=np.float64),
+        "shape_ids": _text_column(list(shapes.shape_ids)),
+        "shape_offsets": np.asarray(shapes.offsets, dtype=np.int64),
+        "shape_lat": np.asarray(shapes.lat, dtype=np.float64),
+        "shape_lon": np.asarray(shapes.lon, dtype=np.float64),
+    }
+    for name in STOP_FIELDS:
+        if name not in ('stop_lat', 'stop_lon'):
+            columns[name] = _text_column([getattr(s, name) for s in stop_list])
+    for name in ROUTE_FIELDS:
+        columns[name] = _text_column([getattr(r, name) for r in route_list])
+    for zoom, (offsets, index) in shapes.levels.items():
+        columns[f"shape_z{zoom}_offsets"] = np.asarray(offsets, dtype=np.int64)
+        columns[f"shape_z{zoom}_index"] = np.asarray(index, dtype=np.int64)
+    pairs = [(route_id, shape_id) for route_id, shape_ids in feed.route_shapes.items() for shape_id in shape_ids]
+    columns["route_shape_routes"] = _text_column([route_id for route_id, _ in pairs])
+    columns["route_shape_shapes"] = _text_column([shape_id for _, shape_id in pairs])
+    patterns = [(route_id, stop_ids) for route_id, ps in feed.route_patterns.items() for stop_ids in ps]
+    columns["pattern_routes"] = _text_column([route_id for route_id, _ in patterns])
+    columns["pattern_offsets"] = np.cumsum([0] + [len(stop_ids) for _, stop_ids in patterns], dtype=np.int64)
+    columns["pattern_stops"] = _text_column([stop_id for _, stop_ids in patterns for stop_id in stop_ids])
+    meta = {"format": SNAPSHOT_FORMAT, "version": feed.version, "stops": len(stop_list),
+            "routes": len(route_list), "route_shapes": len(pairs), "patterns": len(patterns), "shape_levels": sorted(shapes.levels),
+            "files": feed.files,
+            "last_modified": feed.last_modified.isoformat(), "columns": sorted(columns)}
+
+    # Build in a private directory and rename it into place, so readers never
+    # see a half-written version. If another process wins the race, keep its copy.
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f".{feed.version}-", dir=root)
+    try:
+        for name, column in columns.items():
+            np.save(os.path.join(tmp, name + ".npy"), column)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp, final)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(final):
+            raise
+    return final
+
+
+def read_snapshot(root, version):
+    """Map one snapshot version, or return None if it is missing or unreadable."""
+    path = os.path.join(root, version)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("format") != SNAPSHOT_FORMAT or meta.get("version") != version:
+            return None
+        data = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r", allow_pickle=False)
+                for name in meta["columns"]}
+    except (OSError, ValueError, KeyError):
+        return None
+    text = {name: _read_text(data[name], meta["stops"]) for name in STOP_FIELDS
+            if name not in ('stop_lat', 'stop_lon')}
+    text.update({name: _read_text(data[name], meta["routes"]) for name in ROUTE_FIELDS})
+    stops = {}
+    for i, (lat, lon) in enumerate(zip(data["stop_lat"].tolist(), data["stop_lon"].tolist())):
+        stops[text['stop_id'][i]] = Stop(
+            text['stop_id'][i], text['stop_code'][i], text['stop_name'][i], text['stop_desc'][i],
+            lat, lon, text['location_type'][i], text['parent_station'][i], text['wheelchair_boarding'][i])
+    routes = {}
+    for i in range(len(text['route_id'])):
+        route = Route(*(text[name][i] for name in ROUTE_FIELDS))
+        routes[route.route_id] = route
+    # Shape points stay memory-mapped; only the ids are materialized.
+    shape_offsets = data["shape_offsets"]
+    levels = {zoom: (data[f"shape_z{zoom}_offsets"], data[f"shape_z{zoom}_index"]) for zoom in meta["shape_levels"]}
+    shapes = Shapes(_read_text(data["shape_ids"], len(shape_offsets) - 1), shape_offsets,
+                    data["shape_lat"], data["shape_lon"], levels)
+    route_shapes = {}
+    for route_id, shape_id in zip(_read_text(data["route_shape_routes"], meta["route_shapes"]),
+                                  _read_text(data["route_shape_shapes"], meta["route_shapes"])):
+        route_shapes.setdefault(route_id, []).append(shape_id)
+    offsets = data["pattern_offsets"].tolist()
+    pattern_stops = _read_text(data["pattern_stops"], offsets[-1])
+    route_patterns = {}
+    for i, route_id in enumerate(_read_text(data["pattern_routes"], meta["patterns"])):
+        route_patterns.setdefault(route_id, []).append(tuple(pattern_stops[offsets[i]:offsets[i + 1]]))
+    return Feed(stops, routes, shapes, version, datetime.fromisoformat(meta["last_modified"]),
+                {route_id: tuple(shape_ids) for route_id, shape_ids in route_shapes.items()},
+                {route_id: tuple(p) for route_id, p in route_patterns.items()},
+                meta.get("files"))
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, CURRENT_NAME)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish_snapshot(root, version, keep=KEEP_VERSIONS):
+    """Atomically point CURRENT at version and prune old versions."""
+    tmp = os.path.join(root, f".{CURRENT_NAME}.{os.getpid()}")
+    with open(tmp, "w") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(root, CURRENT_NAME))
+    prune_snapshots(root, keep, protect=version)
+
+
+def prune_snapshots(root, keep=KEEP_VERSIONS, protect=None):
+    # Deleting a version other processes still map is safe: their mappings
+    # hold the files open until they switch. Keeping a few recent versions
+    # covers processes that read CURRENT just before a swap.
+    versions = [name for name in os.listdir(root)
+                if not name.startswith(".") and os.path.isdir(os.path.join(root, name))]
+    versions.sort(key=lambda name: os.path.getmtime(os.path.join(root, name)), reverse=True)
+    for name in versions[keep:]:
+        if name != protect:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def load_feed(feed_dir, use_snapshot=True):
+    """Load stops, routes and shapes, preferring a mapped snapshot over CSV.
+
+    A missing snapshot is written after parsing, and the loaded version is
+    published as CURRENT so other processes following it switch over.
+    """
+    start = time.perf_counter()
+    digests = file_digests(feed_dir)
+    version = feed_version(feed_dir, digests)
+    root = snapshot_root(feed_dir)
+    feed = read_snapshot(root, version) if use_snapshot else None
+    source = "snapshot"
+    if feed is None:
+        source = "csv"
+        feed = parse_feed(feed_dir, version, digests)
+        if use_snapshot:
+            try:
+                write_snapshot(root, feed)
+                # Re-open the written copy so this process maps it too.
+                feed = read_snapshot(root, version) or feed
+            except OSError as e:
+                log.warning("Could not write GTFS snapshot: %s", e)
+    if use_snapshot and current_version(root) != version and os.path.isdir(os.path.join(root, version)):
+        try:
+            publish_snapshot(root, version)
+        except OSError as e:
+            log.warning("Could not publish GTFS snapshot: %s", e)
+    feed.load_seconds = time.perf_counter() - start
+    log.info("Loaded GTFS feed %s from %s: %d stops, %d routes, %d shapes in %.2fs",
+             version, source, len(feed.stops), len(feed.routes), len(feed.shapes), feed.load_seconds,
+             extra={"feed_version": version, "source": source, "seconds": round(feed.load_seconds, 4)})
+    return feed
+
+
+class SharedFeed:
+    """This process's copy of the published feed, following CURRENT across swaps.
+
+    refresh() costs a clock read, plus one stat() every check_interval
+    seconds; when CURRENT names a new version it maps that version and calls
+    the on_change listeners with it.
+    """
+
+    def __init__(self, feed_dir, check_interval=5.0):
+        self.feed_dir = feed_dir
+        self.root = snapshot_root(feed_dir)
+        self.check_interval = check_interval
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.feed = load_feed(feed_dir)
+        self._stamp = self._pointer_stamp()
+        self._checked_at = time.monotonic()
+
+    def on_change(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    def _pointer_stamp(self):
+        try:
+            st = os.stat(os.path.join(self.root, CURRENT_NAME))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _swap(self, feed):
+        self.feed = feed
+        for callback in self._listeners:
+            callback(feed)
+
+    def refresh(self, force=False):
+        """Switch to the published version if it changed; True if a swap happened."""
+        if not force and time.monotonic() - self._checked_at < self.check_interval:
+            return False
+        with self._lock:
+            self._checked_at = time.monotonic()
+            stamp = self._pointer_stamp()
+            if stamp == self._stamp and not force:
+                return False
+            self._stamp = stamp
+            version = current_version(self.root)
+            if version is None or version == self.feed.version:
+                return False
+            start = time.perf_counter()
+            feed = read_snapshot(self.root, version)
+            if feed is None:
+                log.warning("GTFS snapshot %s is not readable; keeping %s", version, self.feed.version)
+                return False
+            feed.load_seconds = time.perf_counter() - start
+            log.info("Switching GTFS feed %s -> %s", self.feed.version, version)
+            self._swap(feed)
+            return True
+
+    def reload(self):
+        """Re-read the source files, publish the result and switch to it."""
+        with self._lock:
+            feed = load_feed(self.feed_dir)
+            self._stamp = self._pointer_stamp()
+            self._checked_at = time.monotonic()
+            if feed.version != self.feed.version:
+                self._swap(feed)
+            return feed
@@ -0,0 +1,89 @@
+import os
+import threading
+
+from stores import MemoryStore, RedisStore
+
+
+class UserSnapshot:
+    """Read-only copy of a User row and its favorites.
+
+    Has the attributes and getters the dashboard and read-only endpoints
+    use, so it can stand in for the model without a database session.
+    """
+
+    FIELDS = ("id", "phone_number", "carrier", "home_lat", "home_lng", "notify_minutes",
+              "closest_stop_id", "closest_stop_distance")
+    __slots__ = FIELDS + ("favorites",)
+
+    def __init__(self, favorites=(), **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+        self.favorites = list(favorites)
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.get_favorites(), **{name: getattr(user, name) for name in cls.FIELDS})
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data["favorites"] = list(self.favorites)
+        return data
+
+    def get_favorites(self):
+        return list(self.favorites)
+
+    def get_notification_settings(self):
+        return {"time": self.notify_minutes} if self.notify_minutes is not None else {}
+
+
+class UserCache:
+    """Short-lived UserSnapshots keyed by user id.
+
+    Writers call invalidate() after committing; the TTL bounds how long a
+    change made elsewhere (another worker without a shared backend, a
+    Celery task) can go unseen.
+    """
+
+    def __init__(self, backend=None, ttl=30):
+        self.backend = backend if backend is not None else MemoryStore()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, user_id):
+        data = self.backend.get(str(user_id))
+        self._count("hits" if data is not None else "misses")
+        return UserSnapshot.from_dict(data) if data is not None else None
+
+    def put(self, snapshot):
+        self.backend.set(str(snapshot.id), snapshot.to_dict(), self.ttl)
+
+    def invalidate(self, user_id):
+        self.backend.delete(str(user_id))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = 0
+
+
+def create_user_cache():
+    """Redis when USER_CACHE_URL is set (so a write on one worker is seen by all), else in-process."""
+    url = os.getenv("USER_CACHE_URL")
+    ttl = float(os.getenv("USER_CACHE_TTL", "30"))
+    if url:
+        return UserCache(RedisStore(url, prefix="cta:users:"), ttl=ttl)
+    return UserCache(MemoryStore(max_entries=int(os.getenv("USER_CACHE_SIZE", "10000"))), ttl=ttl)
@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else came in through extra=.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_configured = False
+_lock = threading.Lock()
+
+
+def record_fields(record):
+    """The extra= fields of record."""
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """"time LEVEL logger: message key=value ..." for reading in a terminal."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        fields = record_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+def configure_logging(level=None, fmt=None, stream=None):
+    """Send the app's loggers to stream (stdout) at LOG_LEVEL (INFO), as LOG_FORMAT text or json."""
+    global _configured
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = fmt or os.getenv("LOG_FORMAT", "text")
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+    root = logging.getLogger("cta")
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # Celery and gunicorn configure the root logger their own way.
+    root.propagate = False
+    _configured = True
+
+
+def get_logger(name):
+    """Logger for a module, under the "cta" logger configured on first use."""
+    with _lock:
+        if not _configured:
+            configure_logging()
+    return logging.getLogger("cta." + name)
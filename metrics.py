@@ -0,0 +1,152 @@
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logs import get_logger
+
+log = get_logger("metrics")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Finer buckets for work that should take milliseconds.
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram (seconds) in the Prometheus bucket layout."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._sum += seconds
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            cumulative[bound] = running
+        return {"buckets": cumulative, "count": running, "sum": total}
+
+
+class HistogramFamily:
+    """LatencyHistograms keyed by one label value, created on first use."""
+
+    def __init__(self, buckets=LatencyHistogram.BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram(self.buckets))
+        return histogram
+
+    def observe(self, key, seconds):
+        self.get(key).observe(seconds)
+    def items(self):
+        with self._lock:
+            return list(self._histograms.items())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _sample(name, labels, value):
+    if labels:
+        inner = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+        return f"{name}{{{inner}}} {_number(value)}"
+    return f"{name} {_number(value)}"
+
+
+class MetricsRegistry:
+    """Metrics read from their owners at scrape time, in the Prometheus text format.
+
+    Components keep their own counters and LatencyHistograms; a metric is
+    registered with a collect() callable returning [(labels, value), ...],
+    where a histogram's value is a LatencyHistogram.snapshot().
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, kind, help, collect):
+        with self._lock:
+            self._metrics[name] = (kind, help, collect)
+
+    def histograms(self, name, help, histograms, label):
+        """Export a {label value: LatencyHistogram} mapping (or a callable returning one)."""
+        def collect():
+            source = histograms() if callable(histograms) else histograms
+            items = source.items()
+            return [({label: key}, histogram.snapshot()) for key, histogram in items]
+        self.register(name, "histogram", help, collect)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.items())
+        lines = []
+        for name, (kind, help, collect) in metrics:
+            try:
+                samples = list(collect())
+            except Exception as e:
+                log.warning("Could not collect metric %s: %s", name, e)
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append(_sample(name, labels, value))
+                    continue
+                for bound, count in value["buckets"].items():
+                    lines.append(_sample(name + "_bucket", dict(labels, le=_number(bound)), count))
+                lines.append(_sample(name + "_sum", labels, value["sum"]))
+                lines.append(_sample(name + "_count", labels, value["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(registry, port, host="0.0.0.0"):
+    """Serve registry.render() at /metrics from a daemon thread; for processes without Flask."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
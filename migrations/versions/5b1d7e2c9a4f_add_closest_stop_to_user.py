@@ -0,0 +1,30 @@
+"""Add closest stop columns to User
+
+Revision ID: 5b1d7e2c9a4f
+Revises: 123051c17844
+Create Date: 2026-10-17 10:12:41.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1d7e2c9a4f'
+down_revision = '123051c17844'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('closest_stop_id', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('closest_stop_distance', sa.Float(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_closest_stop_id'), ['closest_stop_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_closest_stop_id'))
+        batch_op.drop_column('closest_stop_distance')
+        batch_op.drop_column('closest_stop_id')
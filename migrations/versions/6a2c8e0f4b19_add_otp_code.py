@@ -0,0 +1,35 @@
+"""Add otp_code for login codes and send counters
+
+Revision ID: 6a2c8e0f4b19
+Revises: d41e9b7c3a52
+Create Date: 2026-10-18 00:02:37.615042
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a2c8e0f4b19'
+down_revision = 'd41e9b7c3a52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'otp_code',
+        sa.Column('key', sa.String(length=40), nullable=False),
+        sa.Column('digest', sa.String(length=64), nullable=True),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    with op.batch_alter_table('otp_code', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_otp_code_expires_at'), ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('otp_code', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_otp_code_expires_at'))
+    op.drop_table('otp_code')
@@ -0,0 +1,106 @@
+"""Move favorites into user_favorite and the alert time into user.notify_minutes
+
+Revision ID: 8c3f4a1d2b7e
+Revises: 5b1d7e2c9a4f
+Create Date: 2026-10-17 21:04:12.118305
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f4a1d2b7e'
+down_revision = '5b1d7e2c9a4f'
+branch_labels = None
+depends_on = None
+
+BATCH = 1000
+
+user = sa.table(
+    'user',
+    sa.column('id', sa.Integer),
+    sa.column('favorite_lines', sa.Text),
+    sa.column('notification_settings', sa.Text),
+    sa.column('notify_minutes', sa.Integer),
+)
+user_favorite = sa.table(
+    'user_favorite',
+    sa.column('user_id', sa.Integer),
+    sa.column('route', sa.String),
+    sa.column('position', sa.Integer),
+)
+
+
+def _loads(value, default):
+    try:
+        return json.loads(value) if value else default
+    except ValueError:
+        return default
+
+
+def _minutes(settings):
+    try:
+        return int(settings.get("time")) if isinstance(settings, dict) and settings.get("time") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def upgrade():
+    op.create_table(
+        'user_favorite',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('route', sa.String(length=20), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'route'),
+    )
+    op.create_index('ix_user_favorite_route_user_id', 'user_favorite', ['route', 'user_id'], unique=False)
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('notify_minutes', sa.Integer(), nullable=True))
+
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(user.c.id, user.c.favorite_lines, user.c.notification_settings)).fetchall()
+    favorites = []
+    for user_id, favorite_lines, notification_settings in rows:
+        routes = _loads(favorite_lines, [])
+        if isinstance(routes, list):
+            for position, route in enumerate(dict.fromkeys(str(r) for r in routes)):
+                favorites.append({"user_id": user_id, "route": route, "position": position})
+        minutes = _minutes(_loads(notification_settings, {}))
+        if minutes is not None:
+            conn.execute(user.update().where(user.c.id == user_id).values(notify_minutes=minutes))
+    for i in range(0, len(favorites), BATCH):
+        op.bulk_insert(user_favorite, favorites[i:i + BATCH])
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('notification_settings')
+        batch_op.drop_column('favorite_lines')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('favorite_lines', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('notification_settings', sa.Text(), nullable=True))
+
+    conn = op.get_bind()
+    routes = {}
+    query = sa.select(user_favorite.c.user_id, user_favorite.c.route).order_by(
+        user_favorite.c.user_id, user_favorite.c.position)
+    for user_id, route in conn.execute(query):
+        routes.setdefault(user_id, []).append(route)
+    for user_id, minutes in conn.execute(sa.select(user.c.id, user.c.notify_minutes)).fetchall():
+        values = {}
+        if user_id in routes:
+            values["favorite_lines"] = json.dumps(routes[user_id])
+        if minutes is not None:
+            values["notification_settings"] = json.dumps({"time": minutes})
+        if values:
+            conn.execute(user.update().where(user.c.id == user_id).values(**values))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('notify_minutes')
+    op.drop_index('ix_user_favorite_route_user_id', table_name='user_favorite')
+    op.drop_table('user_favorite')
@@ -0,0 +1,34 @@
+"""Add alert_claim for delivery dedup keys
+
+Revision ID: d41e9b7c3a52
+Revises: 8c3f4a1d2b7e
+Create Date: 2026-10-17 23:18:05.274913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41e9b7c3a52'
+down_revision = '8c3f4a1d2b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'alert_claim',
+        sa.Column('key', sa.String(length=80), nullable=False),
+        sa.Column('owner', sa.String(length=64), nullable=False),
+        sa.Column('expires_at', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    with op.batch_alter_table('alert_claim', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_alert_claim_expires_at'), ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('alert_claim', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_alert_claim_expires_at'))
+    op.drop_table('alert_claim')
@@ -0,0 +1,234 @@
+import hashlib
+import hmac
+import os
+import re
+import time
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from stores import MemoryStore, redis_client
+
+# Counts a guess against a live code and returns [digest, attempts], or nil
+# once the code is gone; HINCRBY alone would recreate the key without a TTL.
+ATTEMPT_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return nil
+end
+local attempts = redis.call("hincrby", KEYS[1], "attempts", 1)
+return {redis.call("hget", KEYS[1], "digest"), attempts}
+"""
+
+
+class MemoryBackend:
+    """In-process codes and send counters, bounded at max_entries so memory
+    stays flat however many phones sign up at once."""
+
+    def __init__(self, max_entries=10_000):
+        self._store = MemoryStore(max_entries)
+
+    def put_code(self, key, digest, ttl):
+        self._store.set(key, [digest, 0], ttl)
+
+    def attempt(self, key):
+        """Count one guess at key's code; (digest, attempts including this one) or None if there is no code."""
+        with self._store.lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            entry[1] += 1
+            return entry[0], entry[1]
+
+    def delete(self, key):
+        """True if key was there to delete."""
+        with self._store.lock:
+            found = self._store.get(key) is not None
+            self._store.delete(key)
+            return found
+
+    def hit(self, key, window):
+        """Count one event in key's fixed window; returns (count, seconds until it resets)."""
+        with self._store.lock:
+            counter = self._store.get(key)
+            if counter is None:
+                counter = [0]
+                self._store.set(key, counter, window)
+            counter[0] += 1
+            return counter[0], self._store.ttl(key)
+
+    def clear(self):
+        self._store.clear()
+
+    def __len__(self):
+        return len(self._store)
+
+
+class RedisBackend:
+    """Shared across gunicorn workers; Redis TTLs do the eviction."""
+
+    def __init__(self, url, prefix="cta:otp:"):
+        self._client = redis_client(url)
+        self.prefix = prefix
+        self._attempt = self._client.register_script(ATTEMPT_SCRIPT)
+
+    def put_code(self, key, digest, ttl):
+        pipe = self._client.pipeline()
+        pipe.delete(self.prefix + key)
+        pipe.hset(self.prefix + key, mapping={"digest": digest, "attempts": 0})
+        pipe.expire(self.prefix + key, max(int(ttl), 1))
+        pipe.execute()
+
+    def attempt(self, key):
+        entry = self._attempt(keys=[self.prefix + key])
+        if entry is None:
+            return None
+        digest, attempts = entry
+        return digest.decode(), int(attempts)
+
+    def delete(self, key):
+        return bool(self._client.delete(self.prefix + key))
+
+    def hit(self, key, window):
+        # SET NX starts the window with its expiry; INCR keeps that TTL.
+        pipe = self._client.pipeline()
+        pipe.set(self.prefix + key, 0, ex=max(int(window), 1), nx=True)
+        pipe.incr(self.prefix + key)
+        pipe.ttl(self.prefix + key)
+        _, count, ttl = pipe.execute()
+        return count, max(ttl, 0)
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + "*"):
+            self._client.delete(key)
+
+
+class DatabaseBackend:
+    """Codes and send counters as rows of table (key, digest, count,
+    expires_at), shared by every process on the same database.
+
+    count is a code's attempts or a window's sends; both are bumped with
+    an UPDATE, so concurrent requests can't lose an increment. Expired rows
+    are swept out whenever a code is issued.
+    """
+
+    def __init__(self, get_engine, table):
+        self.get_engine = get_engine
+        self.table = table
+
+    def _live(self, key, now):
+        return (self.table.c.key == key) & (self.table.c.expires_at > now)
+
+    def put_code(self, key, digest, ttl):
+        t = self.table
+        now = time.time()
+        with self.get_engine().begin() as conn:
+            conn.execute(delete(t).where((t.c.key == key) | (t.c.expires_at <= now)))
+            conn.execute(insert(t).values(key=key, digest=digest, count=0, expires_at=now + ttl))
+
+    def attempt(self, key):
+        t = self.table
+        now = time.time()
+        with self.get_engine().begin() as conn:
+            if not conn.execute(update(t).where(self._live(key, now)).values(count=t.c.count + 1)).rowcount:
+                return None
+            return tuple(conn.execute(select(t.c.digest, t.c.count).where(t.c.key == key)).one())
+
+    def delete(self, key):
+        t = self.table
+        with self.get_engine().begin() as conn:
+            return bool(conn.execute(delete(t).where(self._live(key, time.time()))).rowcount)
+
+    def _hit(self, key, window):
+        t = self.table
+        now = time.time()
+        with self.get_engine().begin() as conn:
+            if not conn.execute(update(t).where(self._live(key, now)).values(count=t.c.count + 1)).rowcount:
+                conn.execute(delete(t).where(t.c.key == key))
+                conn.execute(insert(t).values(key=key, count=1, expires_at=now + window))
+            count, expires_at = conn.execute(select(t.c.count, t.c.expires_at).where(t.c.key == key)).one()
+        return count, expires_at - now
+
+    def hit(self, key, window):
+        try:
+            return self._hit(key, window)
+        except IntegrityError:
+            # Another request opened the window between our UPDATE and INSERT.
+            return self._hit(key, window)
+
+    def clear(self):
+        with self.get_engine().begin() as conn:
+            conn.execute(delete(self.table))
+
+
+class OTPStore:
+    """One-time codes keyed by phone number.
+
+    A code lives for ttl seconds and is good for one successful check;
+    max_attempts wrong guesses burn it. Each phone may be sent at most
+    send_limit codes per send_window seconds. Codes are stored hashed.
+    """
+
+    def __init__(self, backend=None, ttl=300, max_attempts=5, send_limit=3, send_window=600):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.send_limit = send_limit
+        self.send_window = send_window
+
+    @staticmethod
+    def _key(phone_number):
+        return re.sub(r'\D', '', phone_number or '')
+
+    @staticmethod
+    def _digest(code):
+        return hashlib.sha256(str(code).encode()).hexdigest()
+
+    def issue(self, phone_number, code):
+        """Store code for phone_number; returns 0, or the seconds to wait if rate limited."""
+        key = self._key(phone_number)
+        count, resets_in = self.backend.hit("sends:" + key, self.send_window)
+        if count > self.send_limit:
+            return max(int(resets_in), 1)
+        self.backend.put_code("code:" + key, self._digest(code), self.ttl)
+        return 0
+
+    def verify(self, phone_number, code):
+        """"ok", "invalid", "expired" (no live code) or "locked" (too many attempts)."""
+        key = "code:" + self._key(phone_number)
+        # The attempt is counted before the code is compared, so concurrent
+        # guesses can't get more than max_attempts comparisons between them.
+        entry = self.backend.attempt(key)
+        if entry is None:
+            return "expired"
+        digest, attempts = entry
+        if attempts > self.max_attempts:
+            return "locked"
+        if hmac.compare_digest(digest, self._digest(code)):
+            # Only the request that deletes the code signs in with it.
+            return "ok" if self.backend.delete(key) else "expired"
+        if attempts == self.max_attempts:
+            # Burnt: the next try needs a new code.
+            self.backend.delete(key)
+            return "locked"
+        return "invalid"
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_otp_store(default=None):
+    """Build the store from OTP_STORE_URL / _TTL / _SIZE, OTP_MAX_ATTEMPTS and OTP_SEND_LIMIT / _WINDOW.
+
+    Redis with OTP_STORE_URL, else default; an in-process backend (one
+    gunicorn worker only) if that is None too.
+    """
+    url = os.getenv("OTP_STORE_URL")
+    if url:
+        backend = RedisBackend(url)
+    else:
+        backend = default if default is not None else MemoryBackend(int(os.getenv("OTP_STORE_SIZE", "10000")))
+    return OTPStore(backend,
+                    ttl=int(os.getenv("OTP_TTL", "300")),
+                    max_attempts=int(os.getenv("OTP_MAX_ATTEMPTS", "5")),
+                    send_limit=int(os.getenv("OTP_SEND_LIMIT", "3")),
+                    send_window=int(os.getenv("OTP_SEND_WINDOW", "600")))
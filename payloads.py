@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import brotli
+except ImportError:  # optional; without it clients get gzip
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # optional; without it JSON goes through the json module
+    orjson = None
+
+
+def json_default(obj):
+    """Objects with a to_dict() (prediction records and the like), then Flask's usual types."""
+    to_dict = getattr(obj, "to_dict", None)
+    if to_dict is not None:
+        return to_dict()
+    return DefaultJSONProvider.default(obj)
+
+
+def dumps_bytes(obj):
+    """Compact UTF-8 JSON for obj."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=json_default, separators=(",", ":")).encode()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider on top of orjson, when it is installed.
+
+    Responses are built straight from orjson's bytes. Keys keep their
+    insertion order rather than being sorted, and output is always compact.
+    Calls passing json.dumps/loads keyword arguments fall back to the
+    default provider.
+    """
+
+    default = staticmethod(json_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
+
+
+class PrecomputedPayload:
+    """A JSON response body serialized and compressed once, then served many times.
+
+    Responses carry a strong ETag per encoding plus Last-Modified, so repeat
+    visits revalidate with a 304 instead of downloading the body again.
+    """
+
+    def __init__(self, obj, last_modified=None, mimetype="application/json"):
+        self.mimetype = mimetype
+        self.body = dumps_bytes(obj)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.last_modified = (last_modified or datetime.now(timezone.utc)).replace(microsecond=0)
+        self.encoded = {"gzip": gzip.compress(self.body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body, quality=11)
+
+    def _etag_for(self, encoding):
+        return f"{self.etag}-{encoding}" if encoding else self.etag
+
+    def _pick_encoding(self, req):
+        offered = req.accept_encodings
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and offered[encoding] > 0:
+                return encoding
+        return None
+
+    def _not_modified(self, req):
+        if req.if_none_match:
+            return any(req.if_none_match.contains(self._etag_for(e)) for e in (None, "gzip", "br"))
+        if req.if_modified_since:
+            return self.last_modified <= req.if_modified_since
+        return False
+
+    def response(self, req):
+        encoding = self._pick_encoding(req)
+        if self._not_modified(req):
+            resp = Response(status=304)
+        else:
+            resp = Response(self.encoded[encoding] if encoding else self.body, mimetype=self.mimetype)
+            if encoding:
+                resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(self._etag_for(encoding))
+        resp.last_modified = self.last_modified
+        # Browsers may keep the body but must revalidate, so a feed change
+        # shows up on the next load.
+        resp.headers["Cache-Control"] = "public, no-cache"
+        resp.vary.add("Accept-Encoding")
+        return resp
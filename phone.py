@@ -1,7 +1,9 @@
 import re
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+
+from logs import get_logger
+from sms_dispatcher import OutgoingSMS, get_dispatcher
+
+log = get_logger("phone")
 
 CARRIER_GATEWAYS = {
     "att": "@txt.att.net",
@@ -11,33 +13,25 @@ CARRIER_GATEWAYS = {
     "uscellular": "@email.uscc.net"
 }
 
-def send_sms_via_email(to_number, carrier, subject, body, app_config):
-    try:
-        if carrier:
-            gateway = CARRIER_GATEWAYS.get(carrier.lower())
-            if not gateway:
-                raise ValueError("Invalid carrier provided.")
-            clean_number = re.sub(r'\D', '', to_number)
-            recipient = f"{clean_number}{gateway}"
-        else:
-            recipient = to_number
-
-        print("Sending SMS to:", recipient)
-
-        msg = MIMEMultipart()
-        msg["From"] = app_config.get("MAIL_DEFAULT_SENDER")
-        msg["To"] = recipient
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, 'plain'))
+def sms_address(to_number, carrier):
+    """Email address that delivers to this number as a text."""
+    if carrier:
+        gateway = CARRIER_GATEWAYS.get(carrier.lower())
+        if not gateway:
+            raise ValueError("Invalid carrier provided.")
+        clean_number = re.sub(r'\D', '', to_number)
+        return f"{clean_number}{gateway}"
+    return to_number
 
-        print(f"Connecting to {app_config.get('MAIL_SERVER')}:{app_config.get('MAIL_PORT')}...")
-        print(f"Logging in as {app_config.get('MAIL_USERNAME')}...")
+def build_sms(to_number, carrier, subject, body):
+    return OutgoingSMS(sms_address(to_number, carrier), (carrier or "").lower(), subject, body)
 
-        server = smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=30)
-        server.login(app_config.get("MAIL_USERNAME"), app_config.get("MAIL_PASSWORD"))
-        server.sendmail(app_config.get("MAIL_DEFAULT_SENDER"), recipient, msg.as_string())
-        server.quit()
-        print(f"SMS (via email) sent to {recipient}")
+def send_sms_via_email(to_number, carrier, subject, body, app_config):
+    try:
+        message = build_sms(to_number, carrier, subject, body)
+        # Goes out over the process's pooled, already-authenticated connection.
+        get_dispatcher(app_config).send(message)
+        log.info("SMS (via email) sent to %s", message.recipient)
     except Exception as e:
-        print(f"Failed to send SMS: {e}")
+        log.error("Failed to send SMS: %s", e)
         raise
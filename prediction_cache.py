@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from cta_client import dump_predictions, load_predictions
+from stores import MemoryStore, RedisStore
+
+
+class MemoryBackend(MemoryStore):
+    """In-process TTL cache with LRU eviction once max_entries is reached."""
+
+    def add_lock(self, key, ttl):
+        # Coalescing inside one process is handled by PredictionCache itself.
+        return True
+
+    def release_lock(self, key, token):
+        pass
+
+
+# Delete a lock only while it still holds our token: after its TTL lapses
+# the key may belong to another process.
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisBackend(RedisStore):
+    """Shared backend so every gunicorn and Celery process sees the same entries.
+
+    Lock keys let one process fetch a stop while the others wait for the
+    result instead of calling CTA themselves. add_lock returns a token that
+    release_lock needs, so a process can only release a lock it took.
+    """
+
+    def __init__(self, url, prefix="cta:predictions:", dumps=json.dumps, loads=json.loads):
+        super().__init__(url, prefix, dumps, loads)
+        self._release = self._client.register_script(RELEASE_LOCK_SCRIPT)
+
+    def add_lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        if self._client.set(self.prefix + "lock:" + key, token, nx=True, px=self._ms(ttl)):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        self._release(keys=[self.prefix + "lock:" + key], args=[token])
+
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class PredictionCache:
+    """Realtime prediction cache keyed by (mode, stop_id).
+
+    Concurrent misses for the same key wait on a single in-flight fetch
+    rather than each calling upstream. Only successful fetches are cached.
+    A waiter gives up after wait_timeout seconds, so a stuck fetch can't
+    hold up every later request for its stop.
+    """
+
+    def __init__(self, backend=None, ttl=15, lock_timeout=5, poll_interval=0.05, wait_timeout=15):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    @staticmethod
+    def _key(mode, stop_id):
+        return f"{mode}:{stop_id}"
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = 0
+
+    def _wait_for_peer(self, key):
+        # Another process holds the fetch lock; poll for the value it writes.
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            value = self.backend.get(key)
+            if value is not None:
+                return value
+            time.sleep(self.poll_interval)
+        return None
+
+    def _claim(self, keys):
+        """Split missed keys into ones this thread fetches and ones already in flight."""
+        leading, following = [], []
+        with self._lock:
+            for key in keys:
+                call = self._inflight.get(key)
+                if call is None:
+                    self._inflight[key] = _InFlight()
+                    leading.append(key)
+                else:
+                    following.append((key, call))
+        return leading, following
+
+    def _finish(self, key, value=None, error=None):
+        with self._lock:
+            call = self._inflight.pop(key)
+        call.value = value
+        call.error = error
+        call.event.set()
+
+    def get_or_fetch(self, mode, stop_id, fetch):
+        """Return the cached predictions for one stop, calling fetch() on a miss."""
+        key = self._key(mode, stop_id)
+        return self._get_many([key], lambda keys: {key: fetch()})[key]
+
+    def get_multi(self, pairs, fetch_pairs):
+        """Cached predictions for many (mode, stop_id) pairs, fetching the misses in one call.
+
+        fetch_pairs(missing_pairs) returns {(mode, stop_id): predictions}
+        so callers can fetch several modes in one concurrent round; pairs
+        it leaves out are treated as failed and are neither cached nor
+        returned.
+        """
+        keys = {self._key(mode, stop_id): (mode, stop_id) for mode, stop_id in pairs}
+
+        def fetch_keys(missing):
+            fetched = fetch_pairs([keys[key] for key in missing])
+            return {self._key(mode, stop_id): value for (mode, stop_id), value in fetched.items()}
+
+        found = self._get_many(list(keys), fetch_keys, raise_errors=False)
+        return {keys[key]: value for key, value in found.items()}
+
+    def _get_many(self, keys, fetch_keys, raise_errors=True):
+        results = {}
+        missing = []
+        for key in keys:
+            value = self.backend.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                results[key] = value
+        self._count("hits", len(results))
+        if not missing:
+            return results
+
+        leading, following = self._claim(missing)
+        try:
+            # Keys another process is already fetching are waited on, not refetched.
+            # A peer that times out is fetched here, but its lock stays its own.
+            tokens = {}
+            peers = []
+            for key in leading:
+                token = self.backend.add_lock(key, self.lock_timeout)
+                if token:
+                    tokens[key] = token
+                else:
+                    peers.append(key)
+            for key in peers:
+                value = self._wait_for_peer(key)
+                if value is not None:
+                    results[key] = value
+                    leading.remove(key)
+                    self._count("coalesced")
+                    self._finish(key, value)
+            if leading:
+                self._count("misses", len(leading))
+                try:
+                    fetched = fetch_keys(leading)
+                except Exception as e:
+                    for key in leading:
+                        if key in tokens:
+                            self.backend.release_lock(key, tokens[key])
+                        self._finish(key, error=e)
+                    leading = []
+                    if raise_errors:
+                        raise
+                    fetched = {}
+                for key in leading:
+                    value = fetched.get(key)
+                    if value is not None:
+                        self.backend.set(key, value, self.ttl)
+                        results[key] = value
+                    if key in tokens:
+                        self.backend.release_lock(key, tokens[key])
+                    self._finish(key, value)
+                leading = []
+        finally:
+            # Never leave waiters hanging if something unexpected escaped.
+            for key in leading:
+                self._finish(key, error=RuntimeError("prediction fetch aborted"))
+
+        deadline = time.monotonic() + self.wait_timeout
+        for key, call in following:
+            if not call.event.wait(max(deadline - time.monotonic(), 0)):
+                if raise_errors:
+                    raise TimeoutError(f"Timed out waiting for the in-flight fetch of {key}")
+                continue
+            self._count("coalesced")
+            if call.error is not None:
+                if raise_errors:
+                    raise call.error
+                continue
+            if call.value is not None:
+                results[key] = call.value
+        return results
+
+
+def create_prediction_cache():
+    """Build the cache from PREDICTION_CACHE_URL / _TTL / _SIZE environment settings."""
+    ttl = float(os.getenv("PREDICTION_CACHE_TTL", "15"))
+    url = os.getenv("PREDICTION_CACHE_URL")
+    if url:
+        backend = RedisBackend(url, dumps=dump_predictions, loads=load_predictions)
+    else:
+        backend = MemoryBackend(max_entries=int(os.getenv("PREDICTION_CACHE_SIZE", "2048")))
+    return PredictionCache(backend, ttl=ttl)
@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """Samples one thread's stack every interval seconds from a helper thread.
+
+    The profiled thread runs untouched (no tracing hooks), so it is cheap
+    enough to switch on for a single request in production. The result is
+    a count per collapsed stack, root first, in the "folded" format that
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005, max_depth=128):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.seconds = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+        self._started_at = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.seconds = time.perf_counter() - self._started_at
+        return self
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self, directory, label):
+        """Write the folded stacks under directory; returns the file's path."""
+        os.makedirs(directory, exist_ok=True)
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in label)
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe}-{uuid.uuid4().hex[:8]}.folded")
+        with open(path, "w") as f:
+            f.write(self.folded())
+        return path
@@ -0,0 +1,129 @@
+import queue
+import threading
+
+from logs import get_logger
+
+log = get_logger("realtime")
+
+
+class PollerLimitError(Exception):
+    """Raised when watching another stop would start more than max_pollers pollers."""
+
+
+class Subscription:
+    """One open stream's view of a stop: a bounded queue of (event, data) pairs."""
+
+    def __init__(self, stop_id, maxsize=16):
+        self.stop_id = stop_id
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event, data, snapshot):
+        try:
+            self._queue.put_nowait((event, data))
+        except queue.Full:
+            # A slow client gets its backlog replaced by the current state
+            # instead of holding up the poller.
+            with self._queue.mutex:
+                self._queue.queue.clear()
+            self._queue.put_nowait(("snapshot", snapshot))
+
+    def get(self, timeout=None):
+        """Next (event, data) pair, or None if nothing arrived within timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class StopPoller(threading.Thread):
+    """Polls one stop on an interval and publishes what changed to the hub."""
+
+    def __init__(self, hub, stop_id):
+        super().__init__(name=f"realtime-poller-{stop_id}", daemon=True)
+        self.hub = hub
+        self.stop_id = stop_id
+        self.stopped = threading.Event()
+        self.state = None
+        self.ready = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                state = self.hub.fetch(self.stop_id)
+            except Exception as e:
+                log.warning("Realtime poll failed for stop %s: %s", self.stop_id, e)
+                state = None
+            if state is not None:
+                if self.state is None:
+                    self.state = state
+                    self.hub._publish(self.stop_id, "snapshot", state, state)
+                else:
+                    changes = {k: v for k, v in state.items() if self.state.get(k) != v}
+                    self.state = state
+                    if changes:
+                        changes["stop_id"] = self.stop_id
+                        self.hub._publish(self.stop_id, "update", changes, state)
+            self.ready.set()
+            self.stopped.wait(self.hub.interval)
+
+
+class RealtimeHub:
+    """Fans one upstream poller per watched stop out to every subscriber.
+
+    The first subscriber for a stop starts its poller; when the last one
+    leaves, the poller stops. Upstream load therefore scales with the number
+    of distinct stops being watched, not with the number of open dashboards.
+    At most max_pollers stops are polled at once.
+    """
+
+    def __init__(self, fetch, interval=15.0, max_pollers=200):
+        self.fetch = fetch
+        self.interval = interval
+        self.max_pollers = max_pollers
+        self._subscribers = {}
+        self._pollers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, stop_id):
+        sub = Subscription(stop_id)
+        with self._lock:
+            poller = self._pollers.get(stop_id)
+            if poller is None and len(self._pollers) >= self.max_pollers:
+                raise PollerLimitError(f"Already polling {len(self._pollers)} stops")
+            self._subscribers.setdefault(stop_id, set()).add(sub)
+            if poller is None:
+                poller = self._pollers[stop_id] = StopPoller(self, stop_id)
+                poller.start()
+            elif poller.state is not None:
+                # Late joiners start from the poller's current state.
+                sub.put("snapshot", poller.state, poller.state)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.stop_id)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[sub.stop_id]
+                poller = self._pollers.pop(sub.stop_id, None)
+                if poller is not None:
+                    poller.stopped.set()
+
+    def _publish(self, stop_id, event, data, snapshot):
+        with self._lock:
+            subs = list(self._subscribers.get(stop_id, ()))
+        for sub in subs:
+            sub.put(event, data, snapshot)
+
+    def watched_stops(self):
+        with self._lock:
+            return {stop_id: len(subs) for stop_id, subs in self._subscribers.items()}
+
+    def close(self):
+        with self._lock:
+            for poller in self._pollers.values():
+                poller.stopped.set()
+            self._pollers.clear()
+            self._subscribers.clear()
@@ -0,0 +1,76 @@
+from spatial import StopIndex, haversine
+
+
+def route_summary(route):
+    return {
+        "route_id": route.route_id,
+        # Trains without a short name fall back to their id ("Red").
+        "line": route.route_short_name or route.route_id,
+        "short_name": route.route_short_name or route.route_id,
+        "long_name": route.route_long_name,
+        "type": route.route_type,
+        "color": route.route_color,
+        "text_color": route.route_text_color,
+    }
+
+
+class RouteIndex:
+    """Per-route lookups built once per feed.
+
+    route_id -> metadata and route_id -> ordered stops are dicts; each route
+    also gets its own k-d tree, so "nearest stop on this route" is a tree
+    search rather than a scan of the route's stops.
+    """
+
+    def __init__(self, feed):
+        self.routes = {route_id: route_summary(route) for route_id, route in feed.routes.items()}
+        self.patterns = {}
+        self._positions = {}
+        self._spatial = {}
+        for route_id, patterns in feed.route_patterns.items():
+            patterns = [tuple(s for s in pattern if s in feed.stops) for pattern in patterns]
+            patterns = [p for p in patterns if p]
+            if not patterns:
+                continue
+            self.patterns[route_id] = patterns
+            # First place each stop appears: (pattern, position).
+            positions = {}
+            for p, pattern in enumerate(patterns):
+                for i, stop_id in enumerate(pattern):
+                    positions.setdefault(stop_id, (p, i))
+            self._positions[route_id] = positions
+            self._spatial[route_id] = StopIndex({stop_id: feed.stops[stop_id] for stop_id in positions})
+        self._stops = feed.stops
+
+    def summaries(self):
+        return sorted(self.routes.values(), key=_route_sort_key)
+
+    def has_stops(self, route_id):
+        return route_id in self._spatial
+
+    def nearest_stop(self, route_id, lat, lng):
+        return self._spatial[route_id].closest(lat, lng)
+
+    def stops_from(self, route_id, lat, lng, limit=10):
+        """The route stop nearest (lat, lng), followed by the next stops in route order."""
+        nearest = self.nearest_stop(route_id, lat, lng)
+        p, i = self._positions[route_id][nearest['stop_id']]
+        pattern = self.patterns[route_id][p]
+        result = []
+        for stop_id in pattern[i:i + limit]:
+            stop = self._stops[stop_id]
+            result.append({
+                "stop_id": stop_id,
+                "stop_name": stop['stop_name'],
+                "lat": stop['stop_lat'],
+                "lon": stop['stop_lon'],
+                "distance": round(haversine(lat, lng, stop['stop_lat'], stop['stop_lon']), 3),
+            })
+        return result
+
+
+def _route_sort_key(summary):
+    # Numbered bus routes in numeric order, then everything else by name.
+    line = summary["line"]
+    digits = "".join(ch for ch in line if ch.isdigit())
+    return (0, int(digits), line) if digits and line[0].isdigit() else (1, 0, line)
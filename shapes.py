@@ -0,0 +1,193 @@
+import csv
+import math
+from array import array
+
+import numpy as np
+
+from logs import get_logger
+
+log = get_logger("shapes")
+
+# Route geometry is simplified once per level at ingest time. Each level
+# drops detail smaller than a pixel at its zoom, and a request for zoom z is
+# served from the first level at or above z (full detail past the last).
+SIMPLIFY_ZOOMS = (10, 13, 16)
+
+METERS_PER_DEGREE = 111_320.0
+# Web Mercator ground resolution at the equator for zoom 0, in m/pixel.
+EQUATOR_METERS_PER_PIXEL = 156_543.03
+
+
+def tolerance_for_zoom(zoom, lat):
+    """Size of one map pixel in meters at this zoom and latitude."""
+    return EQUATOR_METERS_PER_PIXEL * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def level_for_zoom(zoom, levels=SIMPLIFY_ZOOMS):
+    """Simplification level to serve for a map zoom; None means full detail."""
+    if zoom is None:
+        return None
+    for level in sorted(levels):
+        if zoom <= level:
+            return level
+    return None
+
+
+def douglas_peucker(x, y, tolerance):
+    """Indices of the points kept when simplifying the polyline (x, y).
+
+    Iterative Douglas–Peucker: each span's farthest point is found with one
+    vectorized pass, so long shapes don't recurse point by point.
+    """
+    n = len(x)
+    if n < 3:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, n - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            dist = np.hypot(px, py)
+        else:
+            dist = np.abs(px * dy - py * dx) / norm
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            mid = start + 1 + i
+            keep[mid] = True
+            spans.append((start, mid))
+            spans.append((mid, end))
+    return np.flatnonzero(keep)
+
+
+def simplify_levels(lat, lon, levels=SIMPLIFY_ZOOMS):
+    """{zoom: kept point indices} for one shape."""
+    lat0 = float(lat.mean()) if len(lat) else 0.0
+    # Equirectangular projection around the shape is plenty at city scale.
+    x = lon * (math.cos(math.radians(lat0)) * METERS_PER_DEGREE)
+    y = lat * METERS_PER_DEGREE
+    return {zoom: douglas_peucker(x, y, tolerance_for_zoom(zoom, lat0)) for zoom in levels}
+
+
+class Shapes:
+    """All shape points in columnar form: shape i spans lat/lon[offsets[i]:offsets[i + 1]].
+
+    levels maps a simplification zoom to (offsets, index): shape i at that
+    level is lat/lon[index[offsets[i]:offsets[i + 1]]].
+    """
+
+    def __init__(self, shape_ids, offsets, lat, lon, levels=None):
+        self.shape_ids = shape_ids
+        self.offsets = offsets
+        self.lat = lat
+        self.lon = lon
+        self.levels = levels or {}
+        # A shape id listed twice (see ingest_shapes) resolves to its last copy.
+        self._positions = {shape_id: i for i, shape_id in enumerate(shape_ids)}
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.zeros(1, dtype=np.int64), np.empty(0), np.empty(0))
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, shape_id):
+        return shape_id in self._positions
+
+    def coordinates(self, shape_id, zoom=None):
+        """[[lon, lat], ...] for one shape, simplified for zoom if given."""
+        i = self._positions[shape_id]
+        level = level_for_zoom(zoom, self.levels)
+        if level is None:
+            start, end = self.offsets[i], self.offsets[i + 1]
+            return np.column_stack((self.lon[start:end], self.lat[start:end])).tolist()
+        offsets, index = self.levels[level]
+        points = index[offsets[i]:offsets[i + 1]]
+        return np.column_stack((self.lon[points], self.lat[points])).tolist()
+
+
+class _ShapeWriter:
+    """Appends finished shapes to growing typed arrays."""
+
+    def __init__(self, levels):
+        self.shape_ids = []
+        self.offsets = array('q', [0])
+        self.lat = array('d')
+        self.lon = array('d')
+        # Kept only while ingesting, to merge shapes whose rows are split up.
+        self.seq = array('q')
+        self.levels = {zoom: (array('q', [0]), array('q')) for zoom in levels}
+        self.positions = {}
+
+    def add(self, shape_id, points):
+        """Append one shape given as (sequence, lat, lon) tuples in any order."""
+        points.sort()
+        lat = np.fromiter((p[1] for p in points), dtype=np.float64, count=len(points))
+        lon = np.fromiter((p[2] for p in points), dtype=np.float64, count=len(points))
+        base = len(self.lat)
+        self.positions[shape_id] = len(self.shape_ids)
+        self.shape_ids.append(shape_id)
+        self.seq.extend(p[0] for p in points)
+        self.lat.frombytes(lat.tobytes())
+        self.lon.frombytes(lon.tobytes())
+        self.offsets.append(len(self.lat))
+        for zoom, kept in simplify_levels(lat, lon, self.levels).items():
+            offsets, index = self.levels[zoom]
+            index.frombytes((kept + base).astype(np.int64).tobytes())
+            offsets.append(len(index))
+
+    def points(self, shape_id):
+        i = self.positions[shape_id]
+        return list(zip(self.seq[self.offsets[i]:self.offsets[i + 1]],
+                        self.lat[self.offsets[i]:self.offsets[i + 1]],
+                        self.lon[self.offsets[i]:self.offsets[i + 1]]))
+
+    def finish(self):
+        levels = {zoom: (np.frombuffer(offsets, dtype=np.int64), np.frombuffer(index, dtype=np.int64))
+                  for zoom, (offsets, index) in self.levels.items()}
+        return Shapes(self.shape_ids, np.frombuffer(self.offsets, dtype=np.int64),
+                      np.frombuffer(self.lat, dtype=np.float64), np.frombuffer(self.lon, dtype=np.float64),
+                      levels)
+
+
+def ingest_shapes(path, levels=SIMPLIFY_ZOOMS):
+    """Stream shapes.txt into Shapes, simplifying each shape as it completes.
+
+    Only one shape's points are held as Python objects at a time; everything
+    else goes straight into typed arrays, so peak memory stays close to the
+    size of the result. Feeds normally list each shape's rows together; a
+    shape whose rows reappear later is merged and stored again.
+    """
+    writer = _ShapeWriter(levels)
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i_id, i_lat = header.index('shape_id'), header.index('shape_pt_lat')
+        i_lon, i_seq = header.index('shape_pt_lon'), header.index('shape_pt_sequence')
+        current, points = None, []
+        for row in reader:
+            if not row:
+                continue
+            shape_id = row[i_id]
+            if shape_id != current:
+                if points:
+                    _flush(writer, current, points)
+                current, points = shape_id, []
+            points.append((int(row[i_seq]), float(row[i_lat]), float(row[i_lon])))
+        if points:
+            _flush(writer, current, points)
+    return writer.finish()
+
+
+def _flush(writer, shape_id, points):
+    if shape_id in writer.positions:
+        # The earlier copy stays in the arrays but is no longer reachable.
+        log.warning("shapes.txt lists shape %s in more than one run; merging", shape_id)
+        points = writer.points(shape_id) + points
+    writer.add(shape_id, points)
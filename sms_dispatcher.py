@@ -0,0 +1,349 @@
+import os
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from logs import get_logger
+from metrics import LatencyHistogram
+
+log = get_logger("sms")
+
+
+def is_connection_error(error):
+    """True if the connection can't be trusted after error and should be reopened."""
+    # SMTPException subclasses OSError, so rule out per-message refusals first.
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    if isinstance(error, smtplib.SMTPException):
+        return isinstance(error, smtplib.SMTPServerDisconnected)
+    return isinstance(error, OSError)
+
+
+class SMTPSettings:
+    def __init__(self, host, port, username=None, password=None, sender=None, use_ssl=True, use_tls=False,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(host=config.get("MAIL_SERVER") or "smtp.gmail.com",
+                   port=int(config.get("MAIL_PORT") or 465),
+                   username=config.get("MAIL_USERNAME"),
+                   password=config.get("MAIL_PASSWORD"),
+                   sender=config.get("MAIL_DEFAULT_SENDER"),
+                   use_ssl=bool(config.get("MAIL_USE_SSL", True)),
+                   use_tls=bool(config.get("MAIL_USE_TLS", False)))
+
+    def key(self):
+        return (self.host, self.port, self.username, self.password, self.sender, self.use_ssl, self.use_tls)
+
+
+class OutgoingSMS:
+    """One text: the gateway address it goes to and the carrier it is rate-limited under."""
+    __slots__ = ("recipient", "carrier", "subject", "body")
+
+    def __init__(self, recipient, carrier, subject, body):
+        self.recipient = recipient
+        self.carrier = carrier
+        self.subject = subject
+        self.body = body
+
+    def as_mime(self, sender):
+        msg = MIMEMultipart()
+        msg["From"] = sender
+        msg["To"] = self.recipient
+        msg["Subject"] = self.subject
+        msg.attach(MIMEText(self.body, 'plain'))
+        return msg.as_string()
+
+
+class RateLimiter:
+    """Token bucket per key (carrier). rates are messages per second."""
+
+    def __init__(self, rates=None, default_rate=5.0, burst=5, clock=time.monotonic, sleep=time.sleep):
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take one token for key, sleeping until it is available; returns the wait."""
+        rate = self.rates.get(key, self.default_rate)
+        if not rate:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * rate) - 1
+            self._buckets[key] = (tokens, now)
+        # A negative balance is a reservation: wait until it's paid back.
+        wait = -tokens / rate if tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class PooledConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = None
+        self.sent = 0
+        self.last_used = 0.0
+        # Set once the current message's DATA has started: from then on the
+        # server may have accepted it even if the connection fails.
+        self.delivering = False
+
+    def open(self):
+        settings = self.pool.settings
+        start = time.perf_counter()
+        if settings.use_ssl:
+            client = smtplib.SMTP_SSL(settings.host, settings.port, timeout=settings.timeout)
+        else:
+            client = smtplib.SMTP(settings.host, settings.port, timeout=settings.timeout)
+            if settings.use_tls:
+                client.starttls()
+        if settings.username:
+            client.login(settings.username, settings.password)
+            self.pool._count("logins")
+        self.pool.latency["connect"].observe(time.perf_counter() - start)
+        self.client = client
+        self.sent = 0
+        self.last_used = time.monotonic()
+        self.pool._count("connections")
+
+    def close(self):
+        if self.client is None:
+            return
+        try:
+            self.client.quit()
+        except Exception:
+            self.client.close()
+        self.client = None
+
+    def reopen(self):
+        self.close()
+        self.pool._count("reconnects")
+        self.open()
+
+    def _refused(self, code):
+        # As sendmail does: 421 means the server is closing the session.
+        if code == 421:
+            self.client.close()
+        else:
+            try:
+                self.client.rset()
+            except smtplib.SMTPServerDisconnected:
+                pass
+
+    def send(self, message):
+        """sendmail's steps, split so a failure in the envelope can be told apart from one in DATA."""
+        self.delivering = False
+        if self.client is None:
+            self.open()
+        client = self.client
+        sender = self.pool.settings.sender
+        start = time.perf_counter()
+        client.ehlo_or_helo_if_needed()
+        code, resp = client.mail(sender)
+        if code != 250:
+            self._refused(code)
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+        code, resp = client.rcpt(message.recipient)
+        if code not in (250, 251):
+            self._refused(code)
+            raise smtplib.SMTPRecipientsRefused({message.recipient: (code, resp)})
+        self.delivering = True
+        code, resp = client.data(message.as_mime(sender))
+        if code != 250:
+            self._refused(code)
+            raise smtplib.SMTPDataError(code, resp)
+        self.pool.latency["send"].observe(time.perf_counter() - start)
+        self.sent += 1
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """At most `size` authenticated SMTP connections, kept open between sends.
+
+    Connections idle longer than max_idle are checked with NOOP before reuse,
+    and one that has sent max_messages is retired (providers cap messages
+    per session).
+    """
+
+    def __init__(self, settings, size=4, max_messages=100, max_idle=60.0):
+        self.settings = settings
+        self.size = size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.stats = {"connections": 0, "logins": 0, "reconnects": 0}
+        # connect covers TLS and login; send is one sendmail.
+        self.latency = {"connect": LatencyHistogram(), "send": LatencyHistogram()}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + n
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            return PooledConnection(self)
+        if conn.client is not None and time.monotonic() - conn.last_used > self.max_idle:
+            try:
+                if conn.client.noop()[0] != 250:
+                    conn.close()
+            except OSError:
+                conn.close()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        conn = self._checkout()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        else:
+            if conn.client is not None and conn.sent >= self.max_messages:
+                conn.close()
+            if conn.client is not None:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SMSDispatcher:
+    """Sends texts over pooled SMTP connections.
+
+    send_many splits messages into batches of batch_size; each batch goes
+    out over one connection, with up to pool_size batches in flight. A
+    connection dropped before a message's DATA started is reopened and the
+    message retried once; once DATA has started the server may already have
+    it, so it is reported instead of being sent twice. Other failures are
+    reported per message.
+    """
+
+    def __init__(self, settings, pool_size=4, batch_size=25, carrier_rates=None, default_rate=5.0,
+                 max_messages=100):
+        self.pool = SMTPPool(settings, size=pool_size, max_messages=max_messages)
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(carrier_rates, default_rate)
+        self._lock = threading.Lock()
+        self._stats = {"sent": 0, "failed": 0, "batches": 0, "throttled_seconds": 0.0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self.pool.stats)
+        return stats
+
+    def _send_batch(self, batch):
+        errors = []
+        self._count("batches")
+        with self.pool.connection() as conn:
+            for message in batch:
+                self._count("throttled_seconds", self.limiter.acquire(message.carrier))
+                try:
+                    try:
+                        conn.send(message)
+                    except Exception as e:
+                        if not is_connection_error(e) or conn.delivering:
+                            raise
+                        conn.reopen()
+                        conn.send(message)
+                except Exception as e:
+                    if is_connection_error(e):
+                        conn.close()
+                    log.warning("Failed to send SMS to %s: %s", message.recipient, e)
+                    self._count("failed")
+                    errors.append(e)
+                else:
+                    self._count("sent")
+                    errors.append(None)
+        return errors
+
+    def send_many(self, messages):
+        """Send every message; returns a list with None or the exception for each, in order."""
+        messages = list(messages)
+        if not messages:
+            return []
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        if len(batches) == 1:
+            return self._send_batch(batches[0])
+        with ThreadPoolExecutor(max_workers=min(self.pool.size, len(batches)),
+                                thread_name_prefix="sms-dispatch") as executor:
+            return [error for errors in executor.map(self._send_batch, batches) for error in errors]
+
+    def send(self, message):
+        error = self.send_many([message])[0]
+        if error is not None:
+            raise error
+
+    def close(self):
+        self.pool.close()
+
+
+def parse_rates(spec):
+    """"att=1,verizon=0.5" -> {"att": 1.0, "verizon": 0.5}."""
+    rates = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            carrier, rate = part.split("=", 1)
+            rates[carrier.strip().lower()] = float(rate)
+    return rates
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def get_dispatcher(config):
+    """Shared dispatcher for these mail settings, one per process.
+
+    Pool size, batch size and rate limits come from SMTP_POOL_SIZE,
+    SMTP_BATCH_SIZE, SMS_DEFAULT_RATE and SMS_CARRIER_RATES.
+    """
+    settings = SMTPSettings.from_config(config)
+    # Keyed by pid too: pooled sockets must not be shared across a fork.
+    key = (os.getpid(), settings.key())
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(key)
+        if dispatcher is None:
+            dispatcher = _dispatchers[key] = SMSDispatcher(
+                settings,
+                pool_size=int(os.getenv("SMTP_POOL_SIZE", "4")),
+                batch_size=int(os.getenv("SMTP_BATCH_SIZE", "25")),
+                carrier_rates=parse_rates(os.getenv("SMS_CARRIER_RATES")),
+                default_rate=float(os.getenv("SMS_DEFAULT_RATE", "5")))
+        return dispatcher
@@ -0,0 +1,211 @@
+import heapq
+import math
+
+EARTH_RADIUS_MILES = 3958.8
+
+# Slack (in squared unit-sphere chord length) used when re-checking near ties
+# with haversine, so floating point noise can't change which stop wins.
+_TIE_EPSILON = 1e-12
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    R = EARTH_RADIUS_MILES  # Radius in miles
+    dLat = math.radians(lat2 - lat1)
+    dLng = math.radians(lng2 - lng1)
+    a = math.sin(dLat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dLng/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+
+def to_unit_xyz(lat, lng):
+    phi = math.radians(lat)
+    lam = math.radians(lng)
+    cos_phi = math.cos(phi)
+    return (cos_phi * math.cos(lam), cos_phi * math.sin(lam), math.sin(phi))
+
+
+def miles_to_chord(miles):
+    angle = min(max(miles, 0.0) / EARTH_RADIUS_MILES, math.pi)
+    return 2 * math.sin(angle / 2)
+
+
+class StopIndex:
+    """k-d tree over GTFS stops for nearest-stop and radius queries.
+
+    Stops are placed on the unit sphere, where straight-line (chord) distance
+    orders points the same way great-circle distance does. Distances handed
+    back to callers are always computed with haversine().
+    """
+
+    def __init__(self, stops_dict):
+        self._stops = list(stops_dict.values())
+        self._points = [to_unit_xyz(s['stop_lat'], s['stop_lon']) for s in self._stops]
+        # Implicit tree: the median of every [lo, hi) slice is the node, split
+        # on whichever axis has the widest spread in that slice.
+        self._order = list(range(len(self._stops)))
+        self._axes = [0] * len(self._stops)
+        self._build(0, len(self._order))
+
+    def __len__(self):
+        return len(self._stops)
+
+    def _build(self, lo, hi):
+        if hi - lo <= 1:
+            return
+        points = self._points
+        members = self._order[lo:hi]
+        spreads = [max(points[i][a] for i in members) - min(points[i][a] for i in members) for a in range(3)]
+        axis = spreads.index(max(spreads))
+        self._order[lo:hi] = sorted(members, key=lambda i: points[i][axis])
+        mid = (lo + hi) // 2
+        self._axes[mid] = axis
+        self._build(lo, mid)
+        self._build(mid + 1, hi)
+
+    def _knn(self, target, k):
+        # Max-heap of (-d2, -i) so the worst candidate sits on top; ties are
+        # broken by insertion order like a linear scan would.
+        heap = []
+        order = self._order
+        points = self._points
+        axes = self._axes
+
+        def visit(lo, hi):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            i = order[mid]
+            p = points[i]
+            d2 = (p[0] - target[0])**2 + (p[1] - target[1])**2 + (p[2] - target[2])**2
+            if len(heap) < k:
+                heapq.heappush(heap, (-d2, -i))
+            elif (d2, i) < (-heap[0][0], -heap[0][1]):
+                heapq.heapreplace(heap, (-d2, -i))
+            axis = axes[mid]
+            diff = target[axis] - p[axis]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            visit(near[0], near[1])
+            if len(heap) < k or diff * diff <= -heap[0][0]:
+                visit(far[0], far[1])
+
+        visit(0, len(order))
+        return sorted((-neg_d2, -neg_i) for neg_d2, neg_i in heap)
+
+    def _range(self, target, r2):
+        found = []
+        order = self._order
+        points = self._points
+        axes = self._axes
+
+        def visit(lo, hi):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            i = order[mid]
+            p = points[i]
+            d2 = (p[0] - target[0])**2 + (p[1] - target[1])**2 + (p[2] - target[2])**2
+            if d2 <= r2:
+                found.append(i)
+            axis = axes[mid]
+            diff = target[axis] - p[axis]
+            if diff <= 0 or diff * diff <= r2:
+                visit(lo, mid)
+            if diff >= 0 or diff * diff <= r2:
+                visit(mid + 1, hi)
+
+        visit(0, len(order))
+        return found
+
+    def nearest(self, lat, lng, k=1):
+        """Return the k closest stops as (stop, distance_in_miles) pairs."""
+        if not self._stops or k <= 0:
+            return []
+        target = to_unit_xyz(lat, lng)
+        return [(self._stops[i], haversine(lat, lng, self._stops[i]['stop_lat'], self._stops[i]['stop_lon']))
+                for _, i in self._knn(target, k)]
+
+    def within_radius(self, lat, lng, miles):
+        """Return every stop within `miles` of (lat, lng), closest first."""
+        if not self._stops:
+            return []
+        target = to_unit_xyz(lat, lng)
+        r2 = miles_to_chord(miles) ** 2 + _TIE_EPSILON
+        results = []
+        for i in self._range(target, r2):
+            stop = self._stops[i]
+            d = haversine(lat, lng, stop['stop_lat'], stop['stop_lon'])
+            if d <= miles:
+                results.append((d, i, stop))
+        results.sort(key=lambda r: (r[0], r[1]))
+        return [(stop, d) for d, _, stop in results]
+
+    def closest(self, lat, lng):
+        """Closest stop, identical to a first-wins linear haversine scan."""
+        if not self._stops:
+            return None
+        target = to_unit_xyz(lat, lng)
+        best_d2, _ = self._knn(target, 1)[0]
+        # Re-rank anything within float noise of the winner using haversine
+        # so the answer matches the original scan exactly.
+        best = None
+        for i in self._range(target, best_d2 + _TIE_EPSILON):
+            stop = self._stops[i]
+            key = (haversine(lat, lng, stop['stop_lat'], stop['stop_lon']), i)
+            if best is None or key < best[0]:
+                best = (key, stop)
+        return best[1]
+
+
+def to_pixel(lat, lng, zoom):
+    """Web Mercator pixel coordinates at a zoom level (256px tiles), as Leaflet uses."""
+    scale = 256 * 2 ** zoom
+    sin_lat = min(max(math.sin(math.radians(lat)), -0.9999), 0.9999)
+    x = (lng + 180.0) / 360.0 * scale
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+class GridIndex:
+    """Uniform lat/lon bucket grid for viewport (bounding box) queries."""
+
+    def __init__(self, stops_dict, cell_size=0.01):
+        self.cell_size = cell_size
+        self._cells = {}
+        for stop in stops_dict.values():
+            self._cells.setdefault(self._cell(stop['stop_lat'], stop['stop_lon']), []).append(stop)
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def within_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Stops inside the box, scanning only the grid cells it overlaps."""
+        lo_row, lo_col = self._cell(min_lat, min_lon)
+        hi_row, hi_col = self._cell(max_lat, max_lon)
+        found = []
+        if (hi_row - lo_row + 1) * (hi_col - lo_col + 1) > len(self._cells):
+            # Huge boxes: walking the occupied cells is cheaper than the range.
+            keys = [k for k in self._cells if lo_row <= k[0] <= hi_row and lo_col <= k[1] <= hi_col]
+        else:
+            keys = [(r, c) for r in range(lo_row, hi_row + 1) for c in range(lo_col, hi_col + 1)]
+        for key in keys:
+            for stop in self._cells.get(key, ()):
+                if min_lat <= stop['stop_lat'] <= max_lat and min_lon <= stop['stop_lon'] <= max_lon:
+                    found.append(stop)
+        return found
+
+    def clusters(self, min_lon, min_lat, max_lon, max_lat, zoom, radius_px=60):
+        """Group stops in the box into screen-space grid clusters at this zoom.
+
+        Returns (stops, lat, lng) tuples: lat/lng is the cluster centroid and
+        stops the members, in index order.
+        """
+        groups = {}
+        for stop in self.within_bbox(min_lon, min_lat, max_lon, max_lat):
+            x, y = to_pixel(stop['stop_lat'], stop['stop_lon'], zoom)
+            groups.setdefault((int(x // radius_px), int(y // radius_px)), []).append(stop)
+        result = []
+        for members in groups.values():
+            lat = sum(s['stop_lat'] for s in members) / len(members)
+            lng = sum(s['stop_lon'] for s in members) / len(members)
+            result.append((members, lat, lng))
+        return result
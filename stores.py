@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def redis_client(url):
+    """Client for a shared backend; redis is only imported once one is configured."""
+    import redis
+    return redis.Redis.from_url(url)
+
+
+class MemoryStore:
+    """In-process entries with a TTL each, bounded at max_entries.
+
+    Entries expire lazily when read; writes also drop expired entries from
+    the least recently used end and, past max_entries, the least recently
+    used live ones. lock is re-entrant: hold it to make a read-then-write
+    from several calls atomic.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self._live(key, time.monotonic())
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def ttl(self, key):
+        """Seconds until key expires, or None if it isn't set."""
+        with self.lock:
+            now = time.monotonic()
+            entry = self._live(key, now)
+            return entry[1] - now if entry is not None else None
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            now = time.monotonic()
+            self._entries[key] = (value, now + ttl)
+            self._entries.move_to_end(key)
+            while self._entries:
+                oldest, (_, expires_at) = next(iter(self._entries.items()))
+                if expires_at > now and len(self._entries) <= self.max_entries:
+                    break
+                del self._entries[oldest]
+
+    def add(self, key, value, ttl):
+        """Set key only if it isn't set; True if it was added."""
+        with self.lock:
+            if self.get(key) is not None:
+                return False
+            self.set(key, value, ttl)
+            return True
+
+    def delete(self, key, value=None):
+        """Remove key; with value, only while key still holds it."""
+        with self.lock:
+            if value is None or self.get(key) == value:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisStore:
+    """Entries shared by every process. Expiry is handled by Redis TTLs; size
+    bounding is left to the server's maxmemory policy.
+    """
+
+    def __init__(self, url, prefix, dumps=json.dumps, loads=json.loads):
+        self._client = redis_client(url)
+        self.prefix = prefix
+        self.dumps = dumps
+        self.loads = loads
+
+    @staticmethod
+    def _ms(ttl):
+        return max(int(ttl * 1000), 1)
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        return self.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, self.dumps(value), px=self._ms(ttl))
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + "*"):
+            self._client.delete(key)
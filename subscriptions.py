@@ -0,0 +1,283 @@
+import json
+import os
+import threading
+
+from stores import redis_client
+
+
+class Subscription:
+    """One user waiting on one line at their stop."""
+    __slots__ = ("user_id", "phone_number", "carrier", "threshold")
+
+    def __init__(self, user_id, phone_number, carrier, threshold):
+        self.user_id = user_id
+        self.phone_number = phone_number
+        self.carrier = carrier
+        self.threshold = threshold
+
+    def to_list(self):
+        return [self.user_id, self.phone_number, self.carrier, self.threshold]
+
+
+class MemorySubscriptions:
+    """Index for a single process."""
+
+    shared = False
+    # Kept up to date by SubscriptionIndex.subscribe/unsubscribe.
+    needs_sync = True
+
+    def __init__(self):
+        self._by_key = {}
+        self._by_user = {}
+        self._stop_counts = {}
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def _remove(self, user_id):
+        previous = self._by_user.pop(user_id, None)
+        if previous is None:
+            return
+        stop_id, lines = previous
+        for line in lines:
+            subscribers = self._by_key[(stop_id, line)]
+            del subscribers[user_id]
+            if not subscribers:
+                del self._by_key[(stop_id, line)]
+        self._stop_counts[stop_id] -= len(lines)
+        if not self._stop_counts[stop_id]:
+            del self._stop_counts[stop_id]
+
+    def replace(self, subscription, stop_id, lines):
+        with self._lock:
+            self._remove(subscription.user_id)
+            if not lines:
+                return
+            for line in lines:
+                self._by_key.setdefault((stop_id, line), {})[subscription.user_id] = subscription
+            self._by_user[subscription.user_id] = (stop_id, tuple(lines))
+            self._stop_counts[stop_id] = self._stop_counts.get(stop_id, 0) + len(lines)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def get(self, stop_id, line):
+        with self._lock:
+            return list(self._by_key.get((stop_id, line), {}).values())
+
+    def get_many(self, stop_ids, lines):
+        with self._lock:
+            return {(stop_id, line): list(self._by_key[(stop_id, line)].values())
+                    for stop_id in stop_ids for line in lines if (stop_id, line) in self._by_key}
+
+    def stop_ids(self):
+        with self._lock:
+            return list(self._stop_counts)
+
+    def mark_ready(self):
+        self.ready = True
+
+    def clear(self):
+        with self._lock:
+            self._by_key.clear()
+            self._by_user.clear()
+            self._stop_counts.clear()
+        self.ready = False
+
+    def __len__(self):
+        return len(self._by_user)
+
+
+class RedisSubscriptions:
+    """Index shared by the web processes that write it and the workers that sweep it.
+
+    (stop, line) -> hash of user_id to subscription; a per-user key records
+    what to remove on the next change, and a hash of per-stop counts lists
+    the stops anyone is subscribed at.
+    """
+
+    shared = True
+    needs_sync = True
+
+    def __init__(self, url, prefix="cta:subs:"):
+        self._client = redis_client(url)
+        self.prefix = prefix
+
+    def _key(self, stop_id, line):
+        return f"{self.prefix}{stop_id}|{line}"
+
+    def _remove(self, pipe, user_id, previous):
+        if previous is None:
+            return
+        stop_id, lines = json.loads(previous)
+        for line in lines:
+            pipe.hdel(self._key(stop_id, line), user_id)
+        pipe.hincrby(self.prefix + "stops", stop_id, -len(lines))
+        pipe.delete(f"{self.prefix}user:{user_id}")
+
+    def _swap(self, user_id, subscription=None, stop_id=None, lines=()):
+        """Replace user_id's entries with lines at stop_id in one transaction.
+
+        The user key is WATCHed while its previous entries are read, so two
+        writers racing on the same user retry rather than both decrementing
+        the old stop's count.
+        """
+        user_key = f"{self.prefix}user:{user_id}"
+
+        def swap(pipe):
+            previous = pipe.get(user_key)
+            pipe.multi()
+            self._remove(pipe, user_id, previous)
+            if lines:
+                value = json.dumps(subscription.to_list())
+                for line in lines:
+                    pipe.hset(self._key(stop_id, line), user_id, value)
+                pipe.hincrby(self.prefix + "stops", stop_id, len(lines))
+                pipe.set(user_key, json.dumps([stop_id, list(lines)]))
+
+        self._client.transaction(swap, user_key)
+
+    def replace(self, subscription, stop_id, lines):
+        self._swap(subscription.user_id, subscription, stop_id, lines)
+
+    def remove(self, user_id):
+        self._swap(user_id)
+
+    def get(self, stop_id, line):
+        return [Subscription(*json.loads(raw)) for raw in self._client.hvals(self._key(stop_id, line))]
+
+    def get_many(self, stop_ids, lines):
+        keys = [(stop_id, line) for stop_id in stop_ids for line in lines]
+        pipe = self._client.pipeline()
+        for stop_id, line in keys:
+            pipe.hvals(self._key(stop_id, line))
+        return {key: [Subscription(*json.loads(raw)) for raw in values]
+                for key, values in zip(keys, pipe.execute()) if values}
+
+    def stop_ids(self):
+        counts = self._client.hgetall(self.prefix + "stops")
+        return [stop_id.decode() for stop_id, count in counts.items() if int(count) > 0]
+
+    @property
+    def ready(self):
+        return bool(self._client.exists(self.prefix + "ready"))
+
+    def mark_ready(self):
+        self._client.set(self.prefix + "ready", "1")
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + "*"):
+            self._client.delete(key)
+
+
+class DatabaseSubscriptions:
+    """Reads subscriptions straight from the user tables.
+
+    The rows the endpoints write are the index, so there is nothing to keep
+    in sync; lookup(stop_ids, lines) is one indexed query per batch.
+    """
+
+    shared = True
+    needs_sync = False
+    ready = True
+
+    def __init__(self, lookup, stop_ids):
+        self._lookup = lookup
+        self._stop_ids = stop_ids
+
+    def replace(self, subscription, stop_id, lines):
+        pass
+
+    def remove(self, user_id):
+        pass
+
+    def get(self, stop_id, line):
+        return self.get_many([stop_id], [line]).get((stop_id, line), [])
+
+    def get_many(self, stop_ids, lines):
+        return self._lookup(stop_ids, lines)
+
+    def stop_ids(self):
+        return self._stop_ids()
+
+    def mark_ready(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+class SubscriptionIndex:
+    """(stop_id, line) -> subscribers, so predictions are matched to the users they affect.
+
+    The sweep walks stops and their predictions and looks each (stop, line)
+    up here, instead of walking users and checking each prediction against
+    their favorites.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemorySubscriptions()
+
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    @property
+    def ready(self):
+        return self.backend.ready
+
+    @property
+    def needs_sync(self):
+        return self.backend.needs_sync
+
+    def mark_ready(self):
+        self.backend.mark_ready()
+
+    def subscribe(self, subscription, stop_id, lines):
+        """Make lines at stop_id this user's only subscriptions."""
+        self.backend.replace(subscription, stop_id, list(dict.fromkeys(lines)))
+
+    def unsubscribe(self, user_id):
+        self.backend.remove(user_id)
+
+    def stop_ids(self):
+        return self.backend.stop_ids()
+
+    def match_stops(self, arrivals_by_stop):
+        """(stop_id, subscription, line, arrival) for every subscriber an arrival is due for.
+
+        arrivals_by_stop maps stop_id -> {line: minutes until its next
+        arrival}; all the stops are looked up in one backend call.
+        """
+        lines = {line for arrivals in arrivals_by_stop.values() for line in arrivals}
+        found = self.backend.get_many(list(arrivals_by_stop), sorted(lines))
+        matches = []
+        for (stop_id, line), subscriptions in found.items():
+            arrival = arrivals_by_stop.get(stop_id, {}).get(line)
+            if arrival is None:
+                continue
+            for subscription in subscriptions:
+                if arrival <= subscription.threshold:
+                    matches.append((stop_id, subscription, line, arrival))
+        return matches
+
+    def clear(self):
+        self.backend.clear()
+
+
+def soonest_arrivals(predictions):
+    """line -> minutes until its next arrival, from cta_client.Prediction records."""
+    arrivals = {}
+    for pred in predictions:
+        # minutes is None for "DUE" and other non-numeric countdowns.
+        if pred.minutes is not None and pred.minutes < arrivals.get(pred.line, pred.minutes + 1):
+            arrivals[pred.line] = pred.minutes
+    return arrivals
+
+
+def create_subscription_index(default=None):
+    """Redis-backed when SUBSCRIPTION_INDEX_URL is set, else default (in-process if None)."""
+    url = os.getenv("SUBSCRIPTION_INDEX_URL")
+    if url:
+        return SubscriptionIndex(RedisSubscriptions(url))
+    return SubscriptionIndex(default)
@@ -1,5 +1,12 @@
+import gzip
+import json
 import unittest
-from app import app
+from types import SimpleNamespace
+from unittest import mock
+
+import payloads
+from cta_client import Prediction
+from app import app, stops, get_closest_stop, assign_closest_stop
 
 class AppTestCase(unittest.TestCase):
     def setUp(self):
@@ -35,5 +42,111 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'signin.html', response.data)
 
+class GeoJSONPayloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_stops_feature_collection(self):
+        response = self.app.get('/api/stops')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['type'], 'FeatureCollection')
+        self.assertEqual(len(data['features']), len(stops))
+        self.assertIsNotNone(response.headers.get('ETag'))
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+    def test_line_is_sorted_by_stop_id(self):
+        data = self.app.get('/api/line').get_json()
+        first = min(stops.values(), key=lambda s: int(s['stop_id']))
+        self.assertEqual(data['geometry']['coordinates'][0], [first['stop_lon'], first['stop_lat']])
+
+    def test_gzip_encoding(self):
+        response = self.app.get('/api/stops', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        data = json.loads(gzip.decompress(response.data))
+        self.assertEqual(len(data['features']), len(stops))
+
+    def test_etag_revalidation(self):
+        etag = self.app.get('/api/stops').headers['ETag']
+        response = self.app.get('/api/stops', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = self.app.get('/api/stops', headers={'If-None-Match': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_last_modified_revalidation(self):
+        last_modified = self.app.get('/api/line').headers['Last-Modified']
+        response = self.app.get('/api/line', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+class StopViewportTestCase(unittest.TestCase):
+    # Roughly the Loop.
+    BBOX = (-87.64, 41.87, -87.62, 41.89)
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def get(self, bbox, zoom):
+        return self.app.get('/api/stops?bbox=%s&zoom=%d' % (','.join(str(v) for v in bbox), zoom))
+
+    def test_bbox_returns_only_stops_in_view(self):
+        min_lon, min_lat, max_lon, max_lat = self.BBOX
+        data = self.get(self.BBOX, 16).get_json()
+        expected = {s['stop_id'] for s in stops.values()
+                    if min_lat <= s['stop_lat'] <= max_lat and min_lon <= s['stop_lon'] <= max_lon}
+        self.assertTrue(expected)
+        self.assertEqual({f['properties']['stop_id'] for f in data['features']}, expected)
+
+    def test_low_zoom_is_clustered(self):
+        bbox = (min(s['stop_lon'] for s in stops.values()), min(s['stop_lat'] for s in stops.values()),
+                max(s['stop_lon'] for s in stops.values()), max(s['stop_lat'] for s in stops.values()))
+        data = self.get(bbox, 10).get_json()
+        self.assertLess(len(data['features']), len(stops) / 10)
+        total = sum(f['properties'].get('point_count', 1) for f in data['features'])
+        self.assertEqual(total, len(stops))
+
+    def test_bbox_responses_revalidate(self):
+        response = self.get(self.BBOX, 16)
+        again = self.app.get(response.request.url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+    def test_invalid_bbox(self):
+        self.assertEqual(self.app.get('/api/stops?bbox=1,2,3').status_code, 400)
+        self.assertEqual(self.get((-87.62, 41.87, -87.64, 41.89), 16).status_code, 400)
+        self.assertEqual(self.app.get('/api/stops?bbox=nan,41,-87,42&zoom=12').status_code, 400)
+        self.assertEqual(self.app.get('/api/stops?bbox=-inf,41,-87,42&zoom=12').status_code, 400)
+
+class ClosestStopAssignmentTestCase(unittest.TestCase):
+    def test_assign_closest_stop(self):
+        user = SimpleNamespace(home_lat=41.8781, home_lng=-87.6298)
+        assign_closest_stop(user)
+        self.assertEqual(user.closest_stop_id, get_closest_stop(41.8781, -87.6298, stops)['stop_id'])
+        self.assertLess(user.closest_stop_distance, 0.5)
+
+    def test_assign_closest_stop_clears_without_home(self):
+        user = SimpleNamespace(home_lat=None, home_lng=None, closest_stop_id="1", closest_stop_distance=0.1)
+        assign_closest_stop(user)
+        self.assertIsNone(user.closest_stop_id)
+        self.assertIsNone(user.closest_stop_distance)
+
+class JSONProviderTestCase(unittest.TestCase):
+    payload = {"1106": {"stop_id": "1106", "bus": [Prediction("22", "4")], "train": [], "errors": ["train"]}}
+
+    def render(self):
+        with app.test_request_context():
+            return app.json.response(self.payload).get_data()
+
+    def test_prediction_records_on_the_wire(self):
+        body = json.loads(self.render())
+        self.assertEqual(body["1106"]["bus"], [{"line": "22", "arrival": "4"}])
+
+    def test_same_output_without_orjson(self):
+        fast = json.loads(self.render())
+        with mock.patch.object(payloads, "orjson", None):
+            self.assertEqual(json.loads(self.render()), fast)
+            self.assertEqual(json.loads(app.json.dumps(self.payload)), fast)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,140 @@
+import json
+import os
+import socket
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+from cta_async import AsyncCTAClient
+from cta_client import (CTAClient, CircuitBreaker, CircuitOpenError, Prediction, dump_predictions,
+                        load_predictions, parse_train_response)
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    # Serves the queued status codes in order, then 200s.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.calls += 1
+        self.server.peers.add(self.client_address)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        payload = json.dumps({"bustime-response": {"prd": [{"stpid": "1", "rt": "22", "prdctdn": "4"}]}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ScriptedServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+        self.server.calls = 0
+        self.server.statuses = []
+        self.server.peers = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/bus"
+        self.env = mock.patch.dict(os.environ, {"CTA_API_KEY": "test"})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CTAClientTestCase(ScriptedServerTestCase):
+    def test_bus_predictions(self):
+        client = CTAClient(bus_url=self.url)
+        self.assertEqual(client.bus_predictions(["1", "2"]), {"1": [Prediction("22", "4")], "2": []})
+        self.assertEqual(client.latency["bus"].snapshot()["count"], 1)
+
+    def test_retries_server_errors(self):
+        self.server.statuses = [503, 502]
+        client = CTAClient(bus_url=self.url, max_retries=2, backoff=0)
+        self.assertIn("1", client.bus_predictions(["1"]))
+        self.assertEqual(self.server.calls, 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.statuses = [500, 500, 500]
+        client = CTAClient(bus_url=self.url, max_retries=1, backoff=0)
+        with self.assertRaises(Exception):
+            client.bus_predictions(["1"])
+        self.assertEqual(self.server.calls, 2)
+
+    def test_reuses_connections(self):
+        client = CTAClient(bus_url=self.url)
+        for _ in range(3):
+            client.bus_predictions(["1"])
+        # Keep-alive: all three requests arrive on the same client socket.
+        self.assertEqual(len(self.server.peers), 1)
+
+    def test_circuit_opens_and_fails_fast(self):
+        client = CTAClient(bus_url=f"http://127.0.0.1:{unused_port()}/bus",
+                           max_retries=0, failure_threshold=2, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                client.bus_predictions(["1"])
+        self.assertEqual(client.breakers["bus"].state, "open")
+        with self.assertRaises(CircuitOpenError):
+            client.bus_predictions(["1"])
+
+
+class AsyncCTAClientTestCase(ScriptedServerTestCase):
+    def client(self, **kwargs):
+        client = AsyncCTAClient(bus_url=self.url, backoff=0, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_retries_server_errors(self):
+        self.server.statuses = [503, 429]
+        self.assertIn(("bus", "1"), self.client(max_retries=2).fetch([("bus", "1")]))
+        self.assertEqual(self.server.calls, 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.statuses = [500, 500, 500]
+        breaker = CircuitBreaker()
+        self.assertEqual(self.client(max_retries=1, breakers={"bus": breaker}).fetch([("bus", "1")]), {})
+        self.assertEqual(self.server.calls, 2)
+        self.assertEqual(breaker._failures, 1)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_half_open_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())   # the single trial call
+        self.assertFalse(breaker.allow())  # everyone else still fails fast
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+
+class PredictionTestCase(unittest.TestCase):
+    def test_countdown_is_parsed_once(self):
+        data = {"traintracker-response": {"prd": [{"rt": "Red", "prdctdn": "12"}, {"rt": "Blue", "prdctdn": "DUE"},
+                                                  {"rt": "G"}]}}
+        predictions = parse_train_response(data)
+        self.assertEqual([p.minutes for p in predictions], [12, None, None])
+        self.assertEqual(predictions[1].to_dict(), {"line": "Blue", "arrival": "DUE"})
+
+    def test_cache_round_trip(self):
+        predictions = [Prediction("22", "4"), Prediction("Red", "DUE")]
+        restored = load_predictions(dump_predictions(predictions))
+        self.assertEqual(restored, predictions)
+        self.assertEqual(restored[0].minutes, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
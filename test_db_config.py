@@ -0,0 +1,116 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import StaticPool
+
+import app as cta_app
+from db_config import configure_engine, database_uri, engine_options
+from subscriptions import SubscriptionIndex
+
+
+class DatabaseURITestCase(unittest.TestCase):
+    def test_default_and_override(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(database_uri(), "sqlite:///cta_tracker.db")
+        with mock.patch.dict(os.environ, {"DATABASE_URL": "postgres://u:p@db/cta"}):
+            self.assertEqual(database_uri(), "postgresql://u:p@db/cta")
+
+    def test_engine_options(self):
+        self.assertEqual(engine_options("sqlite:///cta_tracker.db"), {})
+        with mock.patch.dict(os.environ, {"DB_POOL_SIZE": "20"}):
+            options = engine_options("postgresql://u:p@db/cta")
+        self.assertEqual(options["pool_size"], 20)
+        self.assertTrue(options["pool_pre_ping"])
+
+
+class SQLitePragmaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.engine = create_engine(f"sqlite:///{self.tmp}/test.db")
+        self.addCleanup(self.engine.dispose)
+        configure_engine(self.engine)
+
+    def test_pragmas(self):
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute(text("PRAGMA journal_mode")).scalar(), "wal")
+            self.assertEqual(conn.execute(text("PRAGMA synchronous")).scalar(), 1)  # NORMAL
+            self.assertEqual(conn.execute(text("PRAGMA busy_timeout")).scalar(), 5000)
+
+    def test_writer_is_not_blocked_by_an_open_read(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER)"))
+            conn.execute(text("INSERT INTO t (v) VALUES (1)"))
+        # A long read, like the sweep's: an explicit transaction holding a snapshot.
+        reader = sqlite3.connect(f"{self.tmp}/test.db", isolation_level=None)
+        self.addCleanup(reader.close)
+        reader.execute("BEGIN")
+        self.assertEqual(reader.execute("SELECT v FROM t").fetchone()[0], 1)
+        start = time.perf_counter()
+        with self.engine.begin() as writer:
+            writer.execute(text("UPDATE t SET v = 2"))
+        self.assertLess(time.perf_counter() - start, 1.0)
+        # The reader keeps its snapshot until its transaction ends.
+        self.assertEqual(reader.execute("SELECT v FROM t").fetchone()[0], 1)
+
+
+class BulkReassignTestCase(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        engines = cta_app.db._app_engines[cta_app.app]
+        self.addCleanup(engines.__setitem__, None, engines[None])
+        engines[None] = engine
+        self.statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+        self.ctx = cta_app.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+        cta_app.db.create_all()
+        homes = [(41.8781, -87.6298), (41.9484, -87.6553), (41.7943, -87.5907), (None, None)]
+        for n, (lat, lng) in enumerate(homes):
+            cta_app.db.session.add(cta_app.User(phone_number=f"31255500{n:02d}", home_lat=lat, home_lng=lng))
+        cta_app.db.session.commit()
+
+    def test_every_user_in_one_bulk_update(self):
+        del self.statements[:]
+        self.assertEqual(cta_app.refresh_closest_stops(), 3)
+        cta_app.db.session.commit()
+        # One column-only SELECT, then one executemany UPDATE.
+        self.assertEqual([s.split()[0] for s in self.statements], ["SELECT", "UPDATE"])
+        for user in cta_app.User.query.all():
+            if user.home_lat is None:
+                self.assertIsNone(user.closest_stop_id)
+                continue
+            expected = mock.Mock(home_lat=user.home_lat, home_lng=user.home_lng)
+            cta_app.assign_closest_stop(expected)
+            self.assertEqual(user.closest_stop_id, expected.closest_stop_id)
+            self.assertAlmostEqual(user.closest_stop_distance, expected.closest_stop_distance, places=9)
+
+    def test_stale_stops_are_resynced_into_a_built_index(self):
+        index = SubscriptionIndex()
+        index.mark_ready()
+        self.addCleanup(setattr, cta_app, "subscription_index", cta_app.subscription_index)
+        cta_app.subscription_index = index
+        users = cta_app.User.query.order_by(cta_app.User.id).all()
+        for user in users:
+            user.carrier = "att"
+            user.set_favorites(["22"])
+        users[0].closest_stop_id = "dropped-stop"
+        cta_app.db.session.commit()
+        cta_app.subscribe_user(index, users[0], ["22"])
+
+        self.assertEqual(cta_app.refresh_stale_closest_stops(), 3)
+        # Moved off the dropped stop, and the users with no stop are added.
+        expected = sorted({user.closest_stop_id for user in users if user.home_lat is not None})
+        self.assertEqual(sorted(index.stop_ids()), expected)
+        self.assertNotIn("dropped-stop", index.stop_ids())
+
+
+if __name__ == '__main__':
+    unittest.main()
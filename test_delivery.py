@@ -0,0 +1,177 @@
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import app as cta_app
+from delivery import AlertDelivery, DatabaseDedupStore, MemoryDedupStore, PipelineMetrics, alert_job, dedup_key
+from phone import build_sms
+from subscriptions import Subscription
+
+
+class FlakyDispatcher:
+    """Fails each recipient's first `failures` sends."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.attempts = {}
+        self.sent = []
+
+    def send_many(self, messages):
+        errors = []
+        for message in messages:
+            attempt = self.attempts[message.recipient] = self.attempts.get(message.recipient, 0) + 1
+            if attempt <= self.failures:
+                errors.append(ConnectionError("connection reset"))
+            else:
+                self.sent.append(message)
+                errors.append(None)
+        return errors
+
+
+def use_memory_database(test):
+    """Point the app at a fresh in-memory database for the length of test."""
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    engines = cta_app.db._app_engines[cta_app.app]
+    test.addCleanup(engines.__setitem__, None, engines[None])
+    engines[None] = engine
+    with cta_app.app.app_context():
+        cta_app.db.create_all()
+    return engine
+
+
+def make_jobs(n, carrier="att", arrival=3):
+    return [alert_job(Subscription(i, f"(312) 555-{i:04d}", carrier, 5), "1106", "22", arrival, f"Bus {i}")
+            for i in range(n)]
+
+
+class AlertDeliveryTestCase(unittest.TestCase):
+    def make_store(self):
+        return MemoryDedupStore()
+
+    def setUp(self):
+        self.dedup = self.make_store()
+        self.dispatcher = FlakyDispatcher()
+        self.metrics = PipelineMetrics()
+        self.delivery = AlertDelivery(self.dedup, lambda: self.dispatcher, build_sms, self.metrics)
+
+    def test_dedup_key_is_per_recipient_stop_and_line(self):
+        self.assertEqual(dedup_key("(312) 555-0001", "1106", "22"), "3125550001:1106:22")
+        self.assertEqual(make_jobs(1)[0]["key"], "3125550000:1106:22")
+
+    def test_redelivered_jobs_are_skipped(self):
+        jobs = make_jobs(3)
+        self.assertEqual(self.delivery.deliver(jobs, "tick-1")["sent"], 3)
+        result = self.delivery.deliver(make_jobs(3), "tick-2")
+        self.assertEqual((result["sent"], result["skipped"]), (0, 3))
+        self.assertEqual(len(self.dispatcher.sent), 3)
+
+    def test_retry_resumes_under_same_owner(self):
+        self.dispatcher.failures = 1
+        result = self.delivery.deliver(make_jobs(2), "task-1")
+        self.assertEqual((result["sent"], len(result["retry"])), (0, 2))
+        # Another tick can't take the keys while the task is retrying...
+        self.assertEqual(self.delivery.deliver(make_jobs(2), "task-2")["skipped"], 2)
+        # ...but the retry itself goes through.
+        self.assertEqual(self.delivery.deliver(result["retry"], "task-1")["sent"], 2)
+        self.assertEqual(len(self.dispatcher.sent), 2)
+
+    def test_give_up_frees_keys(self):
+        self.dispatcher.failures = 1
+        result = self.delivery.deliver(make_jobs(1), "task-1")
+        self.delivery.give_up(result["retry"], "task-1")
+        self.assertEqual(self.delivery.deliver(make_jobs(1), "task-2")["sent"], 1)
+
+    def test_bad_carrier_is_dropped_not_retried(self):
+        result = self.delivery.deliver(make_jobs(1, carrier="pigeon"), "task-1")
+        self.assertEqual((result["dropped"], result["retry"]), (1, []))
+        self.assertEqual(self.dedup.seen([make_jobs(1)[0]["key"]]), set())
+
+    def test_expired_jobs_are_dropped(self):
+        jobs = make_jobs(2)
+        jobs[0]["expires_at"] = time.time() - 1
+        result = self.delivery.deliver(jobs, "task-1")
+        self.assertEqual((result["sent"], result["expired"]), (1, 1))
+        self.assertEqual(self.dedup.seen([jobs[0]["key"]]), set())
+
+    def test_keys_expire_after_the_arrival(self):
+        self.assertTrue(self.dedup.claim("k", "a", 0.1))
+        self.assertFalse(self.dedup.claim("k", "b", 0.1))
+        time.sleep(0.15)
+        self.assertTrue(self.dedup.claim("k", "b", 0.1))
+
+    def test_metrics_cover_delivery_and_queue_wait(self):
+        jobs = make_jobs(4)
+        for job in jobs:
+            job["created_at"] -= 2
+        self.delivery.deliver(jobs, "task-1")
+        stats = self.metrics.snapshot()
+        self.assertEqual((stats["deliver"]["runs"], stats["deliver"]["items"]), (1, 4))
+        self.assertEqual(stats["queue_wait"]["latency"]["count"], 4)
+        self.assertEqual(stats["queue_wait"]["latency"]["buckets"][1.0], 0)
+
+
+class DatabaseDedupTestCase(AlertDeliveryTestCase):
+    """The same delivery guarantees with the keys in a table."""
+
+    def make_store(self):
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        cta_app.AlertClaim.__table__.create(engine)
+        self.addCleanup(engine.dispose)
+        return DatabaseDedupStore(lambda: engine, cta_app.AlertClaim.__table__)
+
+    def test_prune_removes_only_expired_keys(self):
+        self.dedup.claim("old", "a", 0.01)
+        self.dedup.mark_sent("new", 60)
+        time.sleep(0.02)
+        self.assertEqual(self.dedup.prune(), 1)
+        self.assertEqual(self.dedup.seen(["old", "new"]), {"new"})
+
+    def test_app_shares_keys_through_the_database(self):
+        use_memory_database(self)
+        self.assertIsInstance(cta_app.alert_dedup, DatabaseDedupStore)
+        cta_app.alert_dedup.mark_sent("k", 60)
+        other_worker = DatabaseDedupStore(cta_app.db_engine, cta_app.AlertClaim.__table__)
+        self.assertFalse(other_worker.claim("k", "task-2", 60))
+
+
+class DeliveryTasksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = FlakyDispatcher()
+        use_memory_database(self)
+        cta_app.alert_dedup.clear()
+        patcher = mock.patch.object(cta_app, "get_sms_dispatcher", lambda: self.dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enqueue_batches_and_skips_sent_keys(self):
+        jobs = make_jobs(120)
+        cta_app.alert_dedup.mark_sent(jobs[0]["key"], 60)
+        with mock.patch.object(cta_app.deliver_alerts, "apply_async") as apply_async:
+            result = cta_app.enqueue_deliveries(jobs)
+        self.assertEqual(result, {"queued": 119, "already_sent": 1, "batches": 3})
+        sizes = [len(call.kwargs["args"][0]) for call in apply_async.call_args_list]
+        self.assertEqual(sizes, [50, 50, 19])
+        self.assertTrue(all(call.kwargs["queue"] == cta_app.DELIVERY_QUEUE
+                            for call in apply_async.call_args_list))
+
+    def test_delivery_task_retries_failed_jobs(self):
+        self.dispatcher.failures = 2
+        with mock.patch.object(cta_app, "delivery_backoff", return_value=0):
+            cta_app.deliver_alerts.apply(args=[make_jobs(3)], task_id="batch-1")
+        self.assertEqual(len(self.dispatcher.sent), 3)
+        self.assertEqual(self.dispatcher.attempts["3125550000@txt.att.net"], 3)
+
+    def test_delivery_task_gives_up_after_max_retries(self):
+        self.dispatcher.failures = cta_app.DELIVERY_MAX_RETRIES + 1
+        with mock.patch.object(cta_app, "delivery_backoff", return_value=0):
+            cta_app.deliver_alerts.apply(args=[make_jobs(1)], task_id="batch-1")
+        self.assertEqual(self.dispatcher.sent, [])
+        # The key is free again for the next sweep.
+        self.assertEqual(cta_app.alert_dedup.seen([make_jobs(1)[0]["key"]]), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import random
+import unittest
+import numpy as np
+from app import haversine, stops, get_closest_stop
+from distances import StopCoordinates, haversine_many
+
+
+class BatchHaversineTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(11)
+        self.origins = [(rng.uniform(41.64, 42.07), rng.uniform(-87.94, -87.52)) for _ in range(20)]
+        self.coords = StopCoordinates(stops)
+
+    def test_distances_from_matches_scalar(self):
+        lat, lng = self.origins[0]
+        batch = self.coords.distances_from(lat, lng)
+        scalar = [haversine(lat, lng, s["stop_lat"], s["stop_lon"]) for s in stops.values()]
+        np.testing.assert_allclose(batch, scalar, rtol=0, atol=1e-9)
+
+    def test_distance_matrix_matches_scalar(self):
+        lats = [lat for lat, _ in self.origins]
+        lngs = [lng for _, lng in self.origins]
+        matrix = self.coords.distance_matrix(lats, lngs)
+        self.assertEqual(matrix.shape, (len(self.origins), len(stops)))
+        sample = list(stops.values())[::500]
+        for row, (lat, lng) in enumerate(self.origins):
+            for col, stop in zip(range(0, len(stops), 500), sample):
+                self.assertAlmostEqual(matrix[row, col], haversine(lat, lng, stop["stop_lat"], stop["stop_lon"]), places=9)
+
+    def test_haversine_many_broadcasts(self):
+        lat, lng = self.origins[1]
+        other = self.origins[2]
+        self.assertAlmostEqual(float(haversine_many(lat, lng, other[0], other[1])),
+                               haversine(lat, lng, other[0], other[1]), places=9)
+
+    def test_nearest_matches_closest_stop(self):
+        lats = [lat for lat, _ in self.origins]
+        lngs = [lng for _, lng in self.origins]
+        nearest = self.coords.nearest_stops(lats, lngs, chunk_size=7)
+        for (lat, lng), stop in zip(self.origins, nearest):
+            self.assertIs(stop, get_closest_stop(lat, lng, stops))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import app as cta_app
+from feed_manager import FeedManager, FeedWatcher, install_feed_archive
+from gtfs import SharedFeed, load_feed
+
+STOPS_CSV = """stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,wheelchair_boarding
+1,1,Jackson & Austin,,41.876,-87.774,0,,1
+30001,30001,Austin (O'Hare-bound),,41.870,-87.776,0,40010,1
+"""
+ROUTES_CSV = """route_id,route_short_name,route_long_name,route_type,route_url,route_color,route_text_color
+1,1,Bronzeville/Union Station,3,,,
+Red,,Red Line,1,,c60c30,ffffff
+"""
+
+
+def write(feed_dir, name, body):
+    with open(os.path.join(feed_dir, name), "w") as f:
+        f.write(body)
+
+
+def feed_zip(files, prefix=""):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as bundle:
+        for name, body in files.items():
+            bundle.writestr(prefix + name, body)
+    buf.seek(0)
+    return buf
+
+
+class FeedManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write(self.dir, "stops.txt", STOPS_CSV)
+        write(self.dir, "routes.txt", ROUTES_CSV)
+        self.manager = FeedManager(SharedFeed(self.dir, check_interval=0), cta_app.build_feed_state)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_first_build_creates_everything(self):
+        entry = self.manager.history[-1]
+        self.assertIsNone(entry["previous_version"])
+        self.assertIn("stop_index", entry["rebuilt"])
+        self.assertIn("route_index", entry["rebuilt"])
+        self.assertEqual(set(self.manager.state.payloads), {"line", "stops", "routes", "gtfs_routes"})
+
+    def test_routes_change_keeps_stop_indexes(self):
+        old = self.manager.state
+        write(self.dir, "routes.txt", ROUTES_CSV + "Blue,,Blue Line,1,,00a1de,ffffff\n")
+        entry = self.manager.reload()
+        new = self.manager.state
+        self.assertEqual(entry["changed_files"], ["routes.txt"])
+        self.assertNotIn("stop_index", entry["rebuilt"])
+        self.assertIs(new.stop_index, old.stop_index)
+        self.assertIs(new.payloads["stops"], old.payloads["stops"])
+        self.assertIsNot(new.route_index, old.route_index)
+        self.assertIn("Blue", new.route_index.routes)
+        # The old state is untouched, so requests still holding it stay consistent.
+        self.assertNotIn("Blue", old.route_index.routes)
+        self.assertIsNot(new.payloads, old.payloads)
+        self.assertGreaterEqual(entry["build_seconds"], 0)
+        self.assertGreater(entry["load_seconds"], 0)
+
+    def test_stops_change_rebuilds_stop_indexes(self):
+        old = self.manager.state
+        write(self.dir, "stops.txt", STOPS_CSV + "2,2,Jackson & Central,,41.877,-87.764,0,,1\n")
+        entry = self.manager.reload()
+        self.assertEqual(entry["changed_files"], ["stops.txt"])
+        self.assertIsNot(self.manager.state.stop_index, old.stop_index)
+        self.assertIn("2", self.manager.state.stops)
+        self.assertEqual(entry["previous_version"], old.feed.version)
+
+    def test_unchanged_reload_is_a_no_op(self):
+        self.assertIsNone(self.manager.reload())
+        self.assertEqual(len(self.manager.history), 1)
+
+    def test_version_published_elsewhere_is_swapped_in(self):
+        write(self.dir, "stops.txt", STOPS_CSV + "2,2,Jackson & Central,,41.877,-87.764,0,,1\n")
+        # Another process publishing the new version (load_feed writes CURRENT).
+        load_feed(self.dir)
+        self.assertTrue(self.manager.shared_feed.refresh())
+        self.assertIn("2", self.manager.state.stops)
+        self.assertEqual(self.manager.history[-1]["changed_files"], ["stops.txt"])
+
+
+class FeedWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write(self.dir, "stops.txt", STOPS_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_waits_for_files_to_settle(self):
+        calls = []
+        watcher = FeedWatcher(self.dir, lambda: calls.append(1))
+        self.assertFalse(watcher.poll())
+        write(self.dir, "stops.txt", STOPS_CSV + "2,2,Jackson & Central,,41.877,-87.764,0,,1\n")
+        self.assertFalse(watcher.poll())
+        self.assertEqual(calls, [])
+        self.assertTrue(watcher.poll())
+        self.assertEqual(calls, [1])
+        self.assertFalse(watcher.poll())
+
+
+class InstallArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_installs_known_files_from_any_folder(self):
+        archive = feed_zip({"stops.txt": STOPS_CSV, "routes.txt": ROUTES_CSV, "README": "x"}, prefix="gtfs/")
+        self.assertEqual(install_feed_archive(archive, self.dir), ["routes.txt", "stops.txt"])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["routes.txt", "stops.txt"])
+        with open(os.path.join(self.dir, "stops.txt")) as f:
+            self.assertEqual(f.read(), STOPS_CSV)
+
+    def test_rejects_bad_archives(self):
+        with self.assertRaises(ValueError):
+            install_feed_archive(io.BytesIO(b"not a zip"), self.dir)
+        with self.assertRaises(ValueError):
+            install_feed_archive(feed_zip({"routes.txt": ROUTES_CSV}), self.dir)
+        with self.assertRaises(ValueError):
+            install_feed_archive(feed_zip({"stops.txt": "a,b\n1,2\n"}), self.dir)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_files_missing_from_the_archive_are_removed(self):
+        write(self.dir, "stops.txt", "old")
+        write(self.dir, "trips.txt", "old")
+        install_feed_archive(feed_zip({"stops.txt": STOPS_CSV, "routes.txt": ROUTES_CSV}), self.dir)
+        self.assertEqual(sorted(os.listdir(self.dir)), ["routes.txt", "stops.txt"])
+
+    def test_failed_install_restores_the_previous_feed(self):
+        write(self.dir, "stops.txt", "old stops")
+        write(self.dir, "trips.txt", "old trips")
+        real_replace = os.replace
+
+        def failing_replace(src, dst):
+            if os.path.basename(dst) == "routes.txt":
+                raise OSError("disk full")
+            real_replace(src, dst)
+        with mock.patch("feed_manager.os.replace", failing_replace), self.assertRaises(OSError):
+            install_feed_archive(feed_zip({"stops.txt": STOPS_CSV, "routes.txt": ROUTES_CSV}), self.dir)
+        self.assertEqual(sorted(os.listdir(self.dir)), ["stops.txt", "trips.txt"])
+        for name, body in (("stops.txt", "old stops"), ("trips.txt", "old trips")):
+            with open(os.path.join(self.dir, name)) as f:
+                self.assertEqual(f.read(), body)
+
+
+class FeedAdminEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = cta_app.app.test_client()
+
+    def test_disabled_without_token(self):
+        with mock.patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("FEED_ADMIN_TOKEN", None)
+            self.assertEqual(self.client.get("/api/admin/feed").status_code, 404)
+
+    def test_requires_token(self):
+        with mock.patch.dict(os.environ, {"FEED_ADMIN_TOKEN": "s3cret"}):
+            self.assertEqual(self.client.get("/api/admin/feed").status_code, 403)
+            response = self.client.get("/api/admin/feed", headers={"Authorization": "Bearer s3cret"})
+            self.assertEqual(response.status_code, 200)
+            data = response.get_json()
+            self.assertEqual(data["version"], cta_app.feed_manager.state.feed.version)
+            self.assertTrue(data["history"])
+
+    def test_bad_upload(self):
+        with mock.patch.dict(os.environ, {"FEED_ADMIN_TOKEN": "s3cret"}):
+            response = self.client.post("/api/admin/feed", data=b"nope",
+                                        headers={"Authorization": "Bearer s3cret"})
+            self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
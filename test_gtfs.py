@@ -0,0 +1,145 @@
+import os
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from gtfs import (SharedFeed, Stop, current_version, feed_version, load_feed, parse_shapes, read_snapshot,
+                  snapshot_root)
+
+STOPS_CSV = """stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,wheelchair_boarding
+1,1,Jackson & Austin,,41.876,-87.774,0,,1
+30001,30001,Austin (O'Hare-bound),,41.870,-87.776,0,40010,1
+"""
+ROUTES_CSV = """route_id,route_short_name,route_long_name,route_type,route_url,route_color,route_text_color
+1,1,Bronzeville/Union Station,3,,,
+Red,,Red Line,1,,c60c30,ffffff
+"""
+SHAPES_CSV = """shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled
+A,41.2,-87.2,2,10
+A,41.1,-87.1,1,0
+B,41.5,-87.5,1,0
+"""
+
+
+def write_feed(feed_dir):
+    for name, body in (("stops.txt", STOPS_CSV), ("routes.txt", ROUTES_CSV), ("shapes.txt", SHAPES_CSV)):
+        with open(os.path.join(feed_dir, name), "w") as f:
+            f.write(body)
+
+
+def append_stop(feed_dir):
+    with open(os.path.join(feed_dir, "stops.txt"), "a") as f:
+        f.write("2,2,Jackson & Central,,41.877,-87.764,0,,1\n")
+
+
+class GTFSLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_feed(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_records_read_like_dicts(self):
+        feed = load_feed(self.dir, use_snapshot=False)
+        stop = feed.stops["30001"]
+        self.assertIsInstance(stop, Stop)
+        self.assertEqual(stop["stop_lat"], 41.870)
+        self.assertEqual(stop.get("parent_station"), "40010")
+        self.assertEqual(stop.get("missing", "x"), "x")
+        with self.assertRaises(KeyError):
+            stop["missing"]
+        self.assertFalse(hasattr(stop, "__dict__"))
+        self.assertEqual(feed.routes["Red"]["route_color"], "c60c30")
+
+    def test_shapes_are_ordered_by_sequence(self):
+        feed = load_feed(self.dir, use_snapshot=False)
+        self.assertEqual(feed.shapes.coordinates("A"), [[-87.1, 41.1], [-87.2, 41.2]])
+        self.assertEqual(feed.shapes.coordinates("B"), [[-87.5, 41.5]])
+
+    def test_snapshot_round_trip(self):
+        from_csv = load_feed(self.dir, use_snapshot=False)
+        load_feed(self.dir)
+        loaded = read_snapshot(snapshot_root(self.dir), from_csv.version)
+        self.assertIsNotNone(loaded)
+        self.assertEqual({k: v.to_dict() for k, v in loaded.stops.items()},
+                         {k: v.to_dict() for k, v in from_csv.stops.items()})
+        self.assertEqual({k: v.to_dict() for k, v in loaded.routes.items()},
+                         {k: v.to_dict() for k, v in from_csv.routes.items()})
+        self.assertEqual(loaded.shapes.coordinates("A"), from_csv.shapes.coordinates("A"))
+        self.assertEqual(loaded.shapes.coordinates("A", zoom=10), from_csv.shapes.coordinates("A", zoom=10))
+        self.assertEqual(loaded.last_modified, from_csv.last_modified)
+
+    def test_shape_points_are_memory_mapped(self):
+        feed = load_feed(self.dir)
+        self.assertIsInstance(feed.shapes.lat, np.memmap)
+        self.assertFalse(feed.shapes.lat.flags.writeable)
+
+    def test_stale_snapshot_is_rebuilt_and_published(self):
+        old = load_feed(self.dir)
+        self.assertEqual(current_version(snapshot_root(self.dir)), old.version)
+        append_stop(self.dir)
+        self.assertIsNone(read_snapshot(snapshot_root(self.dir), feed_version(self.dir)))
+        new = load_feed(self.dir)
+        self.assertNotEqual(old.version, new.version)
+        self.assertIn("2", new.stops)
+        self.assertEqual(current_version(snapshot_root(self.dir)), new.version)
+
+
+def _publish(feed_dir):
+    load_feed(feed_dir)
+
+
+class SharedFeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        write_feed(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_follows_version_published_by_another_process(self):
+        shared = SharedFeed(self.dir, check_interval=0)
+        seen = []
+        shared.on_change(seen.append)
+        self.assertFalse(shared.refresh())
+
+        append_stop(self.dir)
+        proc = multiprocessing.get_context("spawn").Process(target=_publish, args=(self.dir,))
+        proc.start()
+        proc.join(30)
+        self.assertEqual(proc.exitcode, 0)
+
+        self.assertTrue(shared.refresh())
+        self.assertIn("2", shared.feed.stops)
+        self.assertEqual([f.version for f in seen], [shared.feed.version])
+        self.assertFalse(shared.refresh())
+
+    def test_refresh_is_rate_limited(self):
+        shared = SharedFeed(self.dir, check_interval=60)
+        append_stop(self.dir)
+        load_feed(self.dir)
+        self.assertFalse(shared.refresh())
+        self.assertTrue(shared.refresh(force=True))
+
+    def test_reload_swaps_in_process(self):
+        shared = SharedFeed(self.dir, check_interval=60)
+        old = shared.feed
+        append_stop(self.dir)
+        shared.reload()
+        self.assertNotEqual(shared.feed.version, old.version)
+        self.assertEqual(current_version(shared.root), shared.feed.version)
+        self.assertNotIn("2", old.stops)
+
+    def test_lfs_pointer_shapes_are_empty(self):
+        path = os.path.join(self.dir, "shapes.txt")
+        with open(path, "w") as f:
+            f.write("version https://git-lfs.github.com/spec/v1\noid sha256:abc\nsize 1\n")
+        self.assertEqual(len(parse_shapes(path)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+import app as cta_app
+from identity import UserCache, UserSnapshot
+from subscriptions import SubscriptionIndex
+
+
+class UserCacheTestCase(unittest.TestCase):
+    def test_round_trip_and_invalidate(self):
+        cache = UserCache(ttl=60)
+        cache.put(UserSnapshot(["22", "Red"], id=7, phone_number="3125550007", notify_minutes=8))
+        snapshot = cache.get(7)
+        self.assertEqual((snapshot.phone_number, snapshot.get_favorites()), ("3125550007", ["22", "Red"]))
+        self.assertEqual(snapshot.get_notification_settings(), {"time": 8})
+        cache.invalidate(7)
+        self.assertIsNone(cache.get(7))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_entries_expire(self):
+        cache = UserCache(ttl=0)
+        cache.put(UserSnapshot(id=7))
+        self.assertIsNone(cache.get(7))
+
+
+class RequestUserTestCase(unittest.TestCase):
+    """Counts the SQL statements each request sends to the database."""
+
+    def setUp(self):
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        engines = cta_app.db._app_engines[cta_app.app]
+        self.addCleanup(engines.__setitem__, None, engines[None])
+        engines[None] = engine
+        self.statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+
+        for p in (mock.patch.object(cta_app, "subscription_index", SubscriptionIndex()),
+                  mock.patch.object(cta_app, "user_cache", UserCache(ttl=60))):
+            p.start()
+            self.addCleanup(p.stop)
+
+        with cta_app.app.app_context():
+            cta_app.db.create_all()
+            user = cta_app.User(phone_number="3125550007", carrier="att", home_lat=41.88, home_lng=-87.63)
+            user.set_favorites(["22"])
+            cta_app.assign_closest_stop(user)
+            cta_app.db.session.add(user)
+            cta_app.db.session.commit()
+            self.user_id = user.id
+        self.client = cta_app.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess["authenticated"] = True
+            sess["phone_number"] = "3125550007"
+            sess["user_id"] = self.user_id
+
+    def request(self, method, url, **kwargs):
+        del self.statements[:]
+        response = self.client.open(url, method=method, **kwargs)
+        return response, len(self.statements)
+
+    def test_dashboard_is_served_from_the_cache(self):
+        response, queries = self.request("GET", "/dashboard")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 1)  # user and favorites in one SELECT
+        response, queries = self.request("GET", "/dashboard")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 0)
+
+    def test_write_loads_once_and_invalidates(self):
+        self.request("GET", "/dashboard")
+        response, queries = self.request("POST", "/api/add_favorite", json={"route_id": "Red"})
+        self.assertEqual(response.get_json()["status"], "success")
+        self.assertEqual(queries, 2)  # SELECT user + INSERT favorite
+        response, queries = self.request("GET", "/dashboard")
+        self.assertEqual(queries, 1)
+        self.assertIn(b"Red", response.data)
+        self.assertEqual([s.user_id for s in cta_app.subscription_index.backend.get(
+            cta_app.subscription_index.stop_ids()[0], "Red")], [self.user_id])
+
+    def test_set_home_rejects_bad_coordinates(self):
+        for lat, lng in (("nan", "-87.6"), ("41.9", "inf"), (91, -87.6), (41.9, -181), (41.9, None)):
+            response, _ = self.request("POST", "/api/set_home", json={"lat": lat, "lng": lng})
+            self.assertEqual(response.status_code, 400, (lat, lng))
+        response, _ = self.request("POST", "/api/set_home", json={"lat": 41.95, "lng": -87.65})
+        self.assertEqual(response.get_json()["status"], "success")
+
+    def test_settings_write(self):
+        response, queries = self.request("POST", "/api/set_notification",
+                                         json={"notification_settings": {"time": "9"}})
+        self.assertEqual(response.get_json()["status"], "success")
+        self.assertEqual(queries, 2)  # SELECT user + UPDATE user
+        with cta_app.app.app_context():
+            self.assertEqual(cta_app.db.session.get(cta_app.User, self.user_id).notify_minutes, 9)
+
+    def test_user_is_loaded_once_per_request(self):
+        with cta_app.app.test_request_context():
+            cta_app.session["user_id"] = self.user_id
+            del self.statements[:]
+            self.assertIs(cta_app.get_current_user(), cta_app.get_current_user())
+            self.assertEqual(cta_app.get_current_identity().id, self.user_id)
+            self.assertEqual(len(self.statements), 1)
+
+    def test_phone_only_session_is_upgraded(self):
+        with self.client.session_transaction() as sess:
+            del sess["user_id"]
+        response, queries = self.request("GET", "/dashboard")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 2)  # id by phone, then the cached-user miss
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess["user_id"], self.user_id)
+        _, queries = self.request("GET", "/dashboard")
+        self.assertEqual(queries, 0)
+
+    def test_signed_out(self):
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        response, queries = self.request("GET", "/dashboard")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(queries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, text
+
+import app as cta_app
+from db_config import instrument_engine
+from logs import JSONFormatter, TextFormatter
+from metrics import HistogramFamily, LatencyHistogram, MetricsRegistry
+from profiler import SamplingProfiler
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = LatencyHistogram(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(seconds)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["buckets"], {0.1: 1, 1.0: 3, float("inf"): 4})
+        self.assertEqual(snapshot["count"], 4)
+        self.assertAlmostEqual(snapshot["sum"], 4.25)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    def test_render_counters_and_histograms(self):
+        registry = MetricsRegistry()
+        histogram = LatencyHistogram((0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        registry.register("lookups_total", "counter", "Lookups.", lambda: [({"result": "hits"}, 3)])
+        registry.histograms("call_seconds", "Calls.", {"bus": histogram}, "endpoint")
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE lookups_total counter", lines)
+        self.assertIn('lookups_total{result="hits"} 3', lines)
+        self.assertIn("# TYPE call_seconds histogram", lines)
+        self.assertIn('call_seconds_bucket{endpoint="bus",le="0.1"} 1', lines)
+        self.assertIn('call_seconds_bucket{endpoint="bus",le="+Inf"} 2', lines)
+        self.assertIn('call_seconds_count{endpoint="bus"} 2', lines)
+
+    def test_failing_collector_is_skipped(self):
+        registry = MetricsRegistry()
+        registry.register("broken", "gauge", "Broken.", lambda: 1 / 0)
+        registry.register("up", "gauge", "Up.", lambda: [({}, True)])
+        with self.assertLogs("cta.metrics", "WARNING"):
+            body = registry.render()
+        self.assertNotIn("broken", body)
+        self.assertIn("up 1\n", body)
+
+    def test_histogram_family(self):
+        family = HistogramFamily((0.1, 1.0))
+        family.observe("SELECT", 0.01)
+        family.observe("UPDATE", 2.0)
+        snapshots = {key: histogram.snapshot() for key, histogram in family.items()}
+        self.assertEqual(snapshots["SELECT"]["buckets"][0.1], 1)
+        self.assertEqual(snapshots["UPDATE"]["count"], 1)
+
+
+class InstrumentEngineTestCase(unittest.TestCase):
+    def test_queries_timed_by_verb(self):
+        engine = create_engine("sqlite://")
+        self.addCleanup(engine.dispose)
+        family = HistogramFamily()
+        instrument_engine(engine, family)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (x INTEGER)"))
+            conn.execute(text("INSERT INTO t VALUES (1)"))
+            conn.execute(text("SELECT x FROM t")).all()
+            with self.assertRaises(Exception):
+                conn.execute(text("SELECT nope FROM t"))
+        counts = {key: histogram.snapshot()["count"] for key, histogram in family.items()}
+        self.assertEqual(counts["SELECT"], 1)
+        self.assertEqual(counts["INSERT"], 1)
+        self.assertEqual(counts["OTHER"], 1)
+
+
+class LoggingTestCase(unittest.TestCase):
+    def record(self):
+        return logging.LogRecord("cta.test", logging.INFO, __file__, 1, "sent %d", (3,), None)
+
+    def test_json_formatter(self):
+        record = self.record()
+        record.run_id = "abc"
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["msg"], "sent 3")
+        self.assertEqual(entry["run_id"], "abc")
+
+    def test_text_formatter_appends_fields(self):
+        record = self.record()
+        record.stage = "deliver"
+        self.assertTrue(TextFormatter().format(record).endswith("cta.test: sent 3 stage=deliver"))
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    def test_samples_target_thread(self):
+        def busy_wait():
+            end = time.perf_counter() + 0.1
+            while time.perf_counter() < end:
+                pass
+
+        profiler = SamplingProfiler(interval=0.002).start()
+        busy_wait()
+        profiler.stop()
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn("test_metrics.py:busy_wait", profiler.folded())
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = profiler.write(tmp, "a/b")
+        self.assertEqual(os.path.dirname(path), tmp)
+        with open(path) as f:
+            self.assertEqual(f.read(), profiler.folded())
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = cta_app.app.test_client()
+
+    def test_metrics(self):
+        self.client.get("/metrics")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        body = response.get_data(as_text=True)
+        self.assertIn('http_request_seconds_count{endpoint="metrics_endpoint"}', body)
+        self.assertIn('cta_circuit_open{endpoint="bus"} 0', body)
+        self.assertIn("# TYPE notification_stage_seconds histogram", body)
+        self.assertIn("realtime_watched_stops 0\n", body)
+        self.assertIn("# TYPE realtime_streams gauge", body)
+
+    def test_metrics_token(self):
+        with mock.patch.dict(os.environ, {"METRICS_TOKEN": "s3cret"}):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            response = self.client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_profiled_request(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with mock.patch.multiple(cta_app, PROFILE_TOKEN="p", PROFILE_DIR=tmp):
+            plain = self.client.get("/metrics", headers={"X-Profile": "wrong"})
+            profiled = self.client.get("/metrics", headers={"X-Profile": "p"})
+        self.assertNotIn("X-Profile-File", plain.headers)
+        self.assertEqual(os.listdir(tmp), [profiled.headers["X-Profile-File"]])
+        self.assertNotIn("sampling-profiler", [thread.name for thread in threading.enumerate()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import itertools
+import json
+import os
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import app as cta_app
+from subscriptions import SubscriptionIndex
+
+
+class FakeCTAHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        stop_ids = parse_qs(url.query)["stpid"][0].split(",")
+        self.server.calls.append((url.path, stop_ids))
+        if url.path.startswith("/bus"):
+            body = {"bustime-response": {"prd": [
+                {"stpid": stop_id, "rt": "22", "prdctdn": "3"} for stop_id in stop_ids
+            ]}}
+        else:
+            body = {"traintracker-response": {"prd": [
+                {"stpid": stop_id, "rt": "Red", "prdctdn": "12"} for stop_id in stop_ids
+            ]}}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.messages = []
+
+    def send_many(self, messages):
+        self.messages.extend(messages)
+        return [None] * len(messages)
+
+
+_ids = itertools.count(1)
+
+
+def make_user(stop_id, favorites, time="5"):
+    user_id = next(_ids)
+    user = SimpleNamespace(id=user_id, phone_number=str(3125550000 + user_id), carrier="att",
+                           closest_stop_id=stop_id)
+    user.get_notification_settings = lambda: {"time": time}
+    return user, favorites
+
+
+class NotificationPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCTAHandler)
+        self.server.calls = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.patches = [
+            mock.patch.object(cta_app.cta_client, "bus_url", base + "/bus"),
+            mock.patch.object(cta_app.cta_client, "train_url", base + "/train"),
+            mock.patch.object(cta_app.cta_async, "bus_url", base + "/bus"),
+            mock.patch.object(cta_app.cta_async, "train_url", base + "/train"),
+            mock.patch.dict(os.environ, {"CTA_API_KEY": "test", "CTA_TRAIN_API_KEY": "test"}),
+        ]
+        for p in self.patches:
+            p.start()
+        # Dedup keys live in the database.
+        engines = cta_app.db._app_engines[cta_app.app]
+        self.addCleanup(engines.__setitem__, None, engines[None])
+        engines[None] = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        with cta_app.app.app_context():
+            cta_app.db.create_all()
+        cta_app.prediction_cache.clear()
+        cta_app.alert_dedup.clear()
+        self.dispatcher = RecordingDispatcher()
+        self.patches.append(mock.patch.object(cta_app, "get_sms_dispatcher", lambda: self.dispatcher))
+        self.patches[-1].start()
+        self.stop_ids = list(cta_app.stops)[:12]
+        cta_app.celery.conf.task_always_eager = True
+        self.addCleanup(setattr, cta_app.celery.conf, "task_always_eager", False)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sweep(self, cohort):
+        """Run one sweep_stops shard over an index of just cohort; returns the number of texts sent."""
+        index = SubscriptionIndex()
+        index.mark_ready()
+        for user, favorites in cohort:
+            cta_app.subscribe_user(index, user, favorites)
+        sent = len(self.dispatcher.messages)
+        with mock.patch.object(cta_app, "subscription_index", index):
+            cta_app.sweep_stops.apply(args=[sorted(index.stop_ids())]).get()
+        return len(self.dispatcher.messages) - sent
+
+    def test_fetches_each_stop_once(self):
+        # 500 users spread over 12 stops.
+        cohort = [make_user(self.stop_ids[i % 12], ["22"]) for i in range(500)]
+        sent = self.sweep(cohort)
+        bus_calls = [ids for path, ids in self.server.calls if path == "/bus"]
+        train_calls = [ids for path, ids in self.server.calls if path == "/train"]
+        # Bus stops go out in batches of 10; trains are one stop per call.
+        self.assertEqual([len(ids) for ids in bus_calls], [10, 2])
+        self.assertEqual(len(train_calls), 12)
+        self.assertEqual(sent, 500)
+        self.assertEqual(len(self.dispatcher.messages), 500)
+
+    def test_thresholds_and_favorites_are_per_user(self):
+        stop_id = self.stop_ids[0]
+        cohort = [
+            make_user(stop_id, ["22"]),              # bus in 3 <= 5
+            make_user(stop_id, ["Red"]),             # train in 12 > 5
+            make_user(stop_id, ["Red"], time="15"),  # train in 12 <= 15
+            make_user(stop_id, ["Blue"]),            # not arriving
+        ]
+        sent = self.sweep(cohort)
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(self.server.calls), 2)
+        bodies = [message.body for message in self.dispatcher.messages]
+        self.assertTrue(any("line 22" in body for body in bodies))
+        self.assertTrue(any("line Red" in body for body in bodies))
+
+    def test_second_sweep_is_served_from_cache(self):
+        cohort = [make_user(stop_id, ["22"]) for stop_id in self.stop_ids[:3]]
+        self.sweep(cohort)
+        calls = len(self.server.calls)
+        self.sweep(cohort)
+        self.assertEqual(len(self.server.calls), calls)
+        self.assertEqual(cta_app.prediction_cache.stats()["hits"], 6)
+
+    def test_same_arrival_is_not_texted_twice(self):
+        cohort = [make_user(stop_id, ["22"]) for stop_id in self.stop_ids[:3]]
+        self.assertEqual(self.sweep(cohort), 3)
+        # The next beat tick sees the same buses still on their way.
+        cta_app.prediction_cache.clear()
+        self.assertEqual(self.sweep(cohort), 0)
+        self.assertEqual(len(self.dispatcher.messages), 3)
+
+    def start_sweep(self, result_backend):
+        conf = cta_app.celery.conf
+        self.addCleanup(conf.__setitem__, "result_backend", conf.result_backend)
+        conf["result_backend"] = result_backend
+        index = SubscriptionIndex()
+        index.mark_ready()
+        for stop_id in self.stop_ids[:5]:
+            user, favorites = make_user(stop_id, ["22"])
+            cta_app.subscribe_user(index, user, favorites)
+        with mock.patch.object(cta_app, "subscription_index", index), \
+                mock.patch.object(cta_app, "SWEEP_STOP_SHARD_SIZE", 2), \
+                mock.patch.object(cta_app, "refresh_stale_closest_stops"), \
+                mock.patch.object(cta_app, "iter_cohort", side_effect=AssertionError("scanned users")):
+            return cta_app.check_favorite_line_notifications.apply().get()
+
+    def test_sweep_shards_by_subscribed_stop(self):
+        result = self.start_sweep("cache+memory://")
+        self.assertTrue(result["summarized"])
+        summary = cta_app.sweep_history[-1]
+        self.assertEqual((summary["run_id"], summary["shards"], summary["stops"], summary["queued"]),
+                         (result["run_id"], 3, 5, 5))
+        self.assertEqual(len(self.dispatcher.messages), 5)
+
+    def test_sweep_without_result_backend_skips_the_summary(self):
+        runs = len(cta_app.sweep_history)
+        result = self.start_sweep(None)
+        self.assertEqual((result["shards"], result["summarized"]), (3, False))
+        self.assertEqual(len(cta_app.sweep_history), runs)
+        self.assertEqual(len(self.dispatcher.messages), 5)
+
+    def test_realtime_all_returns_both_modes(self):
+        stop_ids = self.stop_ids[:3]
+        client = cta_app.app.test_client()
+        response = client.get("/api/realtime/all?stop_ids=" + ",".join(stop_ids))
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(sorted(data), sorted(stop_ids))
+        for stop_id in stop_ids:
+            self.assertEqual(data[stop_id]["bus"], [{"line": "22", "arrival": "3"}])
+            self.assertEqual(data[stop_id]["train"], [{"line": "Red", "arrival": "12"}])
+            self.assertEqual(data[stop_id]["errors"], [])
+        # One batched bus call plus one train call per stop.
+        self.assertEqual(len(self.server.calls), 4)
+
+    def test_realtime_all_validates_arguments(self):
+        client = cta_app.app.test_client()
+        self.assertEqual(client.get("/api/realtime/all").status_code, 400)
+        self.assertEqual(client.get("/api/realtime/all?stop_ids=1&types=ferry").status_code, 400)
+        too_many = ",".join(str(i) for i in range(cta_app.MAX_REALTIME_STOPS + 1))
+        self.assertEqual(client.get("/api/realtime/all?stop_ids=" + too_many).status_code, 400)
+
+    def test_users_without_known_stop_are_skipped(self):
+        cohort = [make_user("not-a-stop", ["22"])]
+        self.assertEqual(self.sweep(cohort), 0)
+        self.assertEqual(self.dispatcher.messages, [])
+        self.assertEqual(self.server.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
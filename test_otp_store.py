@@ -0,0 +1,174 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.pool import StaticPool
+
+import app as cta_app
+from db_config import configure_engine
+from otp_store import DatabaseBackend, MemoryBackend, OTPStore
+
+
+class OTPStoreTestCase(unittest.TestCase):
+    def make_store(self, **settings):
+        return OTPStore(MemoryBackend(), **settings)
+
+    def stored(self):
+        return repr(self.store.backend._store._entries)
+
+    def setUp(self):
+        self.store = self.make_store(ttl=60, max_attempts=3, send_limit=2, send_window=60)
+
+    def test_code_is_single_use(self):
+        self.assertEqual(self.store.issue("(312) 555-1234", "482913"), 0)
+        self.assertEqual(self.store.verify("312-555-1234", "482913"), "ok")
+        self.assertEqual(self.store.verify("3125551234", "482913"), "expired")
+
+    def test_new_code_replaces_old(self):
+        self.store.issue("3125551234", "111111")
+        self.store.issue("3125551234", "222222")
+        self.assertEqual(self.store.verify("3125551234", "111111"), "invalid")
+        self.assertEqual(self.store.verify("3125551234", "222222"), "ok")
+
+    def test_wrong_guesses_burn_the_code(self):
+        self.store.issue("3125551234", "482913")
+        self.assertEqual(self.store.verify("3125551234", "000000"), "invalid")
+        self.assertEqual(self.store.verify("3125551234", "000001"), "invalid")
+        self.assertEqual(self.store.verify("3125551234", "000002"), "locked")
+        self.assertEqual(self.store.verify("3125551234", "482913"), "expired")
+
+    def test_codes_expire(self):
+        store = self.make_store(ttl=0.01)
+        store.issue("3125551234", "482913")
+        time.sleep(0.02)
+        self.assertEqual(store.verify("3125551234", "482913"), "expired")
+
+    def test_sends_are_rate_limited_per_phone(self):
+        self.assertEqual(self.store.issue("3125551234", "1"), 0)
+        self.assertEqual(self.store.issue("3125551234", "2"), 0)
+        wait = self.store.issue("3125551234", "3")
+        self.assertTrue(0 < wait <= 60)
+        # The limited request didn't replace the live code.
+        self.assertEqual(self.store.verify("3125551234", "2"), "ok")
+        self.assertEqual(self.store.issue("3125559999", "4"), 0)
+
+    def test_codes_are_not_stored_in_clear(self):
+        self.store.issue("3125551234", "482913")
+        self.assertNotIn("482913", self.stored())
+
+    def test_concurrent_guesses_share_the_attempt_cap(self):
+        self.store.issue("3125551234", "482913")
+        barrier = threading.Barrier(8)
+        results = []
+
+        def guess(n):
+            barrier.wait()
+            results.append(self.store.verify("3125551234", f"00000{n}"))
+
+        threads = [threading.Thread(target=guess, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count("invalid"), self.store.max_attempts - 1)
+        self.assertEqual(self.store.verify("3125551234", "482913"), "expired")
+
+
+class MemoryBackendTestCase(unittest.TestCase):
+    def test_memory_stays_bounded_under_a_spike(self):
+        store = OTPStore(MemoryBackend(max_entries=500))
+        for i in range(20_000):
+            store.issue(f"312{i:07d}", "123123")
+        self.assertLessEqual(len(store.backend), 500)
+        self.assertEqual(store.verify(f"312{19_999:07d}", "123123"), "ok")
+
+
+
+class DatabaseBackendTestCase(OTPStoreTestCase):
+    """The same guarantees with codes and counters in the otp_code table."""
+
+    def make_store(self, **settings):
+        # A file, so each thread gets its own connection as in production.
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        engine = create_engine(f"sqlite:///{tmp}/otp.db")
+        self.addCleanup(engine.dispose)
+        configure_engine(engine)
+        cta_app.OTPCode.__table__.create(engine)
+        return OTPStore(DatabaseBackend(lambda: engine, cta_app.OTPCode.__table__), **settings)
+
+    def stored(self):
+        backend = self.store.backend
+        with backend.get_engine().connect() as conn:
+            return repr(conn.execute(select(backend.table)).all())
+
+    def test_issuing_sweeps_out_expired_rows(self):
+        store = self.make_store(ttl=0.01, send_window=0.01)
+        store.issue("3125551234", "482913")
+        time.sleep(0.02)
+        store.issue("3125559999", "123123")
+        with store.backend.get_engine().connect() as conn:
+            keys = conn.execute(select(store.backend.table.c.key)).scalars().all()
+        self.assertEqual(sorted(keys), ["code:3125559999", "sends:3125559999"])
+
+
+class OTPEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        # Codes live in the database.
+        engines = cta_app.db._app_engines[cta_app.app]
+        self.addCleanup(engines.__setitem__, None, engines[None])
+        engines[None] = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        with cta_app.app.app_context():
+            cta_app.db.create_all()
+        cta_app.otp_store.clear()
+        self.client = cta_app.app.test_client()
+        patcher = mock.patch.object(cta_app, "send_sms_via_email")
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_otp(self, phone="3125551234"):
+        return self.client.post("/api/send_otp", json={"phone_number": phone, "carrier": "att"})
+
+    def verify(self, otp, phone="3125551234"):
+        return self.client.post("/api/verify_otp", json={"phone_number": phone, "otp": otp})
+
+    def sent_code(self):
+        return self.send.call_args.kwargs["body"].rsplit(" ", 1)[1]
+
+    def test_send_then_verify(self):
+        self.assertEqual(self.send_otp().get_json()["status"], "success")
+        self.assertEqual(self.verify("not-it").get_json()["message"], "Invalid OTP.")
+        self.assertEqual(self.verify(self.sent_code()).get_json()["status"], "success")
+        with self.client.session_transaction() as sess:
+            self.assertTrue(sess["authenticated"])
+
+    def test_send_rate_limit(self):
+        for _ in range(cta_app.otp_store.send_limit):
+            self.assertEqual(self.send_otp().status_code, 200)
+        response = self.send_otp()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.send.call_count, cta_app.otp_store.send_limit)
+
+    def test_attempt_cap(self):
+        self.send_otp()
+        code = self.sent_code()
+        for _ in range(cta_app.otp_store.max_attempts - 1):
+            self.assertEqual(self.verify("000000").status_code, 200)
+        self.assertEqual(self.verify("000000").status_code, 429)
+        self.assertEqual(self.verify(code).get_json()["status"], "error")
+
+    def test_no_master_code_by_default(self):
+        self.send_otp()
+        self.assertEqual(self.verify("123456").get_json()["message"], "Invalid OTP.")
+
+    def test_dev_test_code(self):
+        with mock.patch.object(cta_app, "OTP_TEST_CODE", "424242"):
+            self.assertEqual(self.verify("424242").get_json()["status"], "success")
+
+
+if __name__ == '__main__':
+    unittest.main()
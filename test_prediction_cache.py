@@ -0,0 +1,127 @@
+import threading
+import time
+import unittest
+from prediction_cache import MemoryBackend, PredictionCache
+
+
+class PredictionCacheTestCase(unittest.TestCase):
+    def test_hit_after_miss(self):
+        cache = PredictionCache(ttl=60)
+        calls = []
+        fetch = lambda: calls.append(1) or [{"line": "22", "arrival": "3"}]
+        self.assertEqual(cache.get_or_fetch("bus", "1", fetch), [{"line": "22", "arrival": "3"}])
+        self.assertEqual(cache.get_or_fetch("bus", "1", fetch), [{"line": "22", "arrival": "3"}])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "coalesced": 0})
+
+    def test_mode_is_part_of_the_key(self):
+        cache = PredictionCache(ttl=60)
+        cache.get_or_fetch("bus", "1", lambda: ["bus"])
+        self.assertEqual(cache.get_or_fetch("train", "1", lambda: ["train"]), ["train"])
+
+    def test_entries_expire(self):
+        cache = PredictionCache(ttl=0.01)
+        cache.get_or_fetch("bus", "1", lambda: [1])
+        time.sleep(0.02)
+        self.assertEqual(cache.get_or_fetch("bus", "1", lambda: [2]), [2])
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_lru_eviction(self):
+        backend = MemoryBackend(max_entries=2)
+        backend.set("a", 1, 60)
+        backend.set("b", 2, 60)
+        backend.get("a")
+        backend.set("c", 3, 60)
+        self.assertEqual(len(backend), 2)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), 1)
+
+    def test_failures_are_not_cached(self):
+        cache = PredictionCache(ttl=60)
+
+        def boom():
+            raise ValueError("upstream down")
+        with self.assertRaises(ValueError):
+            cache.get_or_fetch("bus", "1", boom)
+        self.assertEqual(cache.get_or_fetch("bus", "1", lambda: [1]), [1])
+
+    def test_concurrent_misses_are_coalesced(self):
+        cache = PredictionCache(ttl=60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ["ok"]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch("bus", "1", slow_fetch)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for t in threads[1:]:
+            t.start()
+        # Give the followers time to find the in-flight fetch.
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["ok"]] * 5)
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 1, "coalesced": 4})
+
+    def test_get_multi_fetches_only_missing_stops(self):
+        cache = PredictionCache(ttl=60)
+        cache.get_or_fetch("bus", "1", lambda: ["one"])
+        requested = []
+
+        def fetch_pairs(pairs):
+            requested.append(list(pairs))
+            # Stop "3" failed upstream and is left out.
+            return {("bus", "2"): ["two"], ("train", "2"): ["red"]}
+        found = cache.get_multi([("bus", "1"), ("bus", "2"), ("train", "2"), ("bus", "3")], fetch_pairs)
+        self.assertEqual(requested, [[("bus", "2"), ("train", "2"), ("bus", "3")]])
+        self.assertEqual(found, {("bus", "1"): ["one"], ("bus", "2"): ["two"], ("train", "2"): ["red"]})
+        self.assertEqual(cache.get_multi([("bus", "2")], fetch_pairs), {("bus", "2"): ["two"]})
+        self.assertEqual(len(requested), 1)
+
+    def test_peer_lock_is_not_released_by_others(self):
+        class PeerLocked(MemoryBackend):
+            def add_lock(self, key, ttl):
+                return None if key == "bus:1" else "token"
+
+            def release_lock(self, key, token):
+                self.released.append((key, token))
+
+        backend = PeerLocked()
+        backend.released = []
+        cache = PredictionCache(backend, ttl=60, lock_timeout=0.05, poll_interval=0.01)
+        # The peer never writes bus:1, so this process fetches it itself.
+        found = cache.get_multi([("bus", "1"), ("bus", "2")], lambda pairs: {pair: [pair[1]] for pair in pairs})
+        self.assertEqual(found, {("bus", "1"): ["1"], ("bus", "2"): ["2"]})
+        self.assertEqual(backend.released, [("bus:2", "token")])
+
+    def test_followers_give_up_on_a_stuck_fetch(self):
+        cache = PredictionCache(ttl=60, wait_timeout=0.05)
+        started = threading.Event()
+        release = threading.Event()
+
+        def stuck_fetch():
+            started.set()
+            release.wait(5)
+            return ["late"]
+
+        leader = threading.Thread(target=cache.get_or_fetch, args=("bus", "1", stuck_fetch))
+        leader.start()
+        self.addCleanup(leader.join, 5)
+        self.addCleanup(release.set)
+        started.wait(5)
+        with self.assertRaises(TimeoutError):
+            cache.get_or_fetch("bus", "1", lambda: ["never"])
+        self.assertEqual(cache.get_multi([("bus", "1")], lambda pairs: {}), {})
+
+if __name__ == '__main__':
+    unittest.main()
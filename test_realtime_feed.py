@@ -0,0 +1,110 @@
+import os
+import threading
+import unittest
+from unittest import mock
+
+import app as cta_app
+from realtime_feed import PollerLimitError, RealtimeHub
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.bus = [{"line": "22", "arrival": "5"}]
+
+    def __call__(self, stop_id):
+        with self.lock:
+            self.calls += 1
+        return {"stop_id": stop_id, "bus": list(self.bus), "train": []}
+
+
+class RealtimeHubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.upstream = FakeUpstream()
+        self.hub = RealtimeHub(self.upstream, interval=0.02)
+
+    def tearDown(self):
+        self.hub.close()
+
+    def test_subscribers_share_one_poller(self):
+        subs = [self.hub.subscribe("1") for _ in range(50)]
+        for sub in subs:
+            event, data = sub.get(timeout=2)
+            self.assertEqual(event, "snapshot")
+            self.assertEqual(data["bus"], [{"line": "22", "arrival": "5"}])
+        self.assertEqual(self.hub.watched_stops(), {"1": 50})
+        self.assertEqual(len(self.hub._pollers), 1)
+
+    def test_only_changes_are_published(self):
+        sub = self.hub.subscribe("1")
+        self.assertEqual(sub.get(timeout=2)[0], "snapshot")
+        # Unchanged polls publish nothing.
+        self.assertIsNone(sub.get(timeout=0.1))
+        self.upstream.bus = [{"line": "22", "arrival": "4"}]
+        event, data = sub.get(timeout=2)
+        self.assertEqual(event, "update")
+        self.assertEqual(data, {"stop_id": "1", "bus": [{"line": "22", "arrival": "4"}]})
+
+    def test_late_subscriber_gets_current_state(self):
+        first = self.hub.subscribe("1")
+        first.get(timeout=2)
+        late = self.hub.subscribe("1")
+        event, data = late.get(timeout=2)
+        self.assertEqual(event, "snapshot")
+        self.assertEqual(data["stop_id"], "1")
+
+    def test_poller_stops_without_subscribers(self):
+        sub = self.hub.subscribe("1")
+        sub.get(timeout=2)
+        poller = self.hub._pollers["1"]
+        self.hub.unsubscribe(sub)
+        poller.join(2)
+        self.assertFalse(poller.is_alive())
+        calls = self.upstream.calls
+        threading.Event().wait(0.1)
+        self.assertEqual(self.upstream.calls, calls)
+        self.assertEqual(self.hub.watched_stops(), {})
+
+    def test_poller_limit(self):
+        self.hub.max_pollers = 2
+        self.hub.subscribe("1")
+        second = self.hub.subscribe("2")
+        with self.assertRaises(PollerLimitError):
+            self.hub.subscribe("3")
+        # Stops already being polled still take subscribers.
+        self.hub.subscribe("1")
+        self.hub.unsubscribe(second)
+        self.hub.subscribe("3")
+        self.assertEqual(sorted(self.hub.watched_stops()), ["1", "3"])
+
+
+class RealtimeStreamEndpointTestCase(unittest.TestCase):
+    def test_stream_sends_snapshot(self):
+        upstream = FakeUpstream()
+        with mock.patch.object(cta_app.realtime_hub, "fetch", upstream), \
+                mock.patch.dict(os.environ, {"CTA_API_KEY": "test", "CTA_TRAIN_API_KEY": "test"}):
+            response = cta_app.app.test_client().get("/api/realtime/stream?stop_id=1", buffered=False)
+            self.assertEqual(response.mimetype, "text/event-stream")
+            chunks = iter(response.response)
+            self.assertEqual(next(chunks), b"retry: 5000\n\n")
+            self.assertTrue(next(chunks).startswith(b"event: snapshot\ndata: "))
+            response.close()
+        self.assertEqual(cta_app.realtime_hub.watched_stops(), {})
+
+    def test_stream_requires_stop_id(self):
+        self.assertEqual(cta_app.app.test_client().get("/api/realtime/stream").status_code, 400)
+
+    def test_unknown_stop(self):
+        response = cta_app.app.test_client().get("/api/realtime/stream?stop_id=no-such-stop")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(cta_app.realtime_hub.watched_stops(), {})
+
+    def test_poller_limit(self):
+        with mock.patch.object(cta_app.realtime_hub, "max_pollers", 0), \
+                mock.patch.dict(os.environ, {"CTA_API_KEY": "test", "CTA_TRAIN_API_KEY": "test"}):
+            response = cta_app.app.test_client().get("/api/realtime/stream?stop_id=1")
+        self.assertEqual(response.status_code, 429)
+
+if __name__ == '__main__':
+    unittest.main()
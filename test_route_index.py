@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import app as cta_app
+from feed_manager import FeedState
+from gtfs import Feed, load_feed, parse_route_patterns
+from route_index import RouteIndex
+
+TRIPS_CSV = """route_id,service_id,trip_id,direction_id,shape_id
+Red,1,r1,0,S1
+Red,1,r2,0,S1
+Red,1,r3,1,S2
+22,1,b1,0,S3
+"""
+# r2 is a short turn; the longest trip per direction becomes the pattern.
+STOP_TIMES_CSV = """trip_id,arrival_time,departure_time,stop_id,stop_sequence
+r1,08:00:00,08:00:00,30001,1
+r1,08:02:00,08:02:00,30002,2
+r1,08:04:00,08:04:00,30003,3
+r2,09:00:00,09:00:00,30002,1
+r2,09:02:00,09:02:00,30003,2
+r3,08:10:00,08:10:00,30004,2
+r3,08:08:00,08:08:00,30005,1
+b1,08:00:00,08:00:00,1,1
+"""
+
+
+class RoutePatternTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, body in (("trips.txt", TRIPS_CSV), ("stop_times.txt", STOP_TIMES_CSV)):
+            with open(os.path.join(self.dir, name), "w") as f:
+                f.write(body)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_longest_trip_per_direction_in_sequence_order(self):
+        patterns = parse_route_patterns(os.path.join(self.dir, "trips.txt"), os.path.join(self.dir, "stop_times.txt"))
+        self.assertEqual(patterns["Red"], (("30001", "30002", "30003"), ("30005", "30004")))
+        self.assertEqual(patterns["22"], (("1",),))
+
+    def test_missing_stop_times(self):
+        os.remove(os.path.join(self.dir, "stop_times.txt"))
+        self.assertEqual(parse_route_patterns(os.path.join(self.dir, "trips.txt"),
+                                              os.path.join(self.dir, "stop_times.txt")), {})
+
+
+def line_feed():
+    # Five real stops strung into one outbound and one inbound pattern.
+    stop_ids = sorted(cta_app.stops, key=int)[:5]
+    patterns = {"Red": (tuple(stop_ids), tuple(reversed(stop_ids)))}
+    return Feed(cta_app.stops, cta_app.routes, cta_app.feed.shapes, "route-test", cta_app.feed.last_modified,
+                route_patterns=patterns), stop_ids
+
+
+class RouteIndexTestCase(unittest.TestCase):
+    def test_routes_metadata(self):
+        index = RouteIndex(cta_app.feed)
+        summaries = index.summaries()
+        self.assertEqual(len(summaries), len(cta_app.routes))
+        red = index.routes["Red"]
+        self.assertEqual(red["route_id"], "Red")
+        self.assertEqual(red["line"], "Red Line")
+        self.assertEqual(red["color"], "C60C30")
+        # Bus routes sort numerically.
+        numbered = [s["line"] for s in summaries if s["line"].isdigit()]
+        self.assertEqual(numbered, sorted(numbered, key=int))
+
+    def test_nearest_stop_on_route_then_following_stops(self):
+        feed, stop_ids = line_feed()
+        index = RouteIndex(feed)
+        third = cta_app.stops[stop_ids[2]]
+        result = index.stops_from("Red", third['stop_lat'], third['stop_lon'], limit=10)
+        self.assertEqual([s["stop_id"] for s in result], stop_ids[2:])
+        self.assertEqual(result[0]["distance"], 0)
+
+    def test_matches_linear_scan(self):
+        feed, stop_ids = line_feed()
+        index = RouteIndex(feed)
+        for lat, lng in ((41.88, -87.63), (41.95, -87.7), (41.7, -87.6)):
+            expected = min(stop_ids, key=lambda s: cta_app.haversine(lat, lng, cta_app.stops[s]['stop_lat'],
+                                                                     cta_app.stops[s]['stop_lon']))
+            self.assertEqual(index.nearest_stop("Red", lat, lng)['stop_id'], expected)
+
+
+class RouteEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = cta_app.app.test_client()
+        self.original_state = cta_app.feed_manager.state
+
+    def tearDown(self):
+        cta_app.feed_manager.state = self.original_state
+
+    def use_route_index(self, index):
+        state = self.original_state
+        cta_app.feed_manager.state = FeedState(state.feed, **dict(state.parts, route_index=index))
+
+    def test_routes_list(self):
+        response = self.client.get("/api/routes")
+        self.assertEqual(response.status_code, 200)
+        routes = response.get_json()
+        self.assertEqual(len(routes), len(cta_app.routes))
+        self.assertEqual(set(routes[0]), {"route_id", "line", "short_name", "long_name", "type", "color",
+                                          "text_color"})
+        etag = response.headers["ETag"]
+        self.assertEqual(self.client.get("/api/routes", headers={"If-None-Match": etag}).status_code, 304)
+
+    def test_gtfs_routes_is_geojson(self):
+        data = self.client.get("/api/gtfs_routes").get_json()
+        self.assertEqual(data["type"], "FeatureCollection")
+        for feature in data["features"]:
+            self.assertIn("color", feature["properties"]["route"])
+
+    def test_route_stops(self):
+        feed, stop_ids = line_feed()
+        self.use_route_index(RouteIndex(feed))
+        first = cta_app.stops[stop_ids[0]]
+        response = self.client.get(f"/api/route_stops?route_id=Red&lat={first['stop_lat']}&lng={first['stop_lon']}")
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual([s["stop_id"] for s in data], stop_ids)
+        self.assertEqual(set(data[0]), {"stop_id", "stop_name", "lat", "lon", "distance"})
+        again = self.client.get(f"/api/route_stops?route_id=Red&lat={first['stop_lat']}&lng={first['stop_lon']}",
+                                headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(again.status_code, 304)
+        for limit in (0, -5):
+            clamped = self.client.get(f"/api/route_stops?route_id=Red&lat={first['stop_lat']}"
+                                      f"&lng={first['stop_lon']}&limit={limit}")
+            self.assertEqual([s["stop_id"] for s in clamped.get_json()], stop_ids[:1])
+
+    def test_route_stops_errors(self):
+        self.assertEqual(self.client.get("/api/route_stops?route_id=nope&lat=41.8&lng=-87.6").status_code, 404)
+        self.assertEqual(self.client.get("/api/route_stops?route_id=Red").status_code, 400)
+        for lat, lng in (("nan", "-87.6"), ("41.8", "inf"), ("91", "-87.6"), ("41.8", "-181")):
+            response = self.client.get(f"/api/route_stops?route_id=Red&lat={lat}&lng={lng}")
+            self.assertEqual(response.status_code, 400)
+
+    def test_route_stops_without_stop_times(self):
+        self.use_route_index(RouteIndex(Feed(cta_app.stops, cta_app.routes, cta_app.feed.shapes, "v",
+                                             cta_app.feed.last_modified)))
+        response = self.client.get("/api/route_stops?route_id=Red&lat=41.8&lng=-87.6")
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("error", response.get_json())
+
+
+class RouteSnapshotTestCase(unittest.TestCase):
+    def test_patterns_survive_snapshot(self):
+        feed_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(feed_dir, "stops.txt"), "w") as f:
+                f.write("stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,"
+                        "wheelchair_boarding\n30001,30001,A,,41.9,-87.6,0,,1\n")
+            for name, body in (("trips.txt", TRIPS_CSV), ("stop_times.txt", STOP_TIMES_CSV)):
+                with open(os.path.join(feed_dir, name), "w") as f:
+                    f.write(body)
+            parsed = load_feed(feed_dir, use_snapshot=False)
+            load_feed(feed_dir)
+            mapped = load_feed(feed_dir)
+            self.assertEqual(mapped.route_patterns, parsed.route_patterns)
+            self.assertEqual(mapped.route_shapes, parsed.route_shapes)
+        finally:
+            shutil.rmtree(feed_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
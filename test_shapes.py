@@ -0,0 +1,167 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import app as cta_app
+from feed_manager import FeedState
+from gtfs import Feed, parse_route_shapes
+from shapes import (douglas_peucker, ingest_shapes, level_for_zoom, simplify_levels,
+                    tolerance_for_zoom)
+
+
+def reference_douglas_peucker(points, tolerance):
+    # Textbook recursive version to check the iterative one against.
+    if len(points) < 3:
+        return list(range(len(points)))
+    (x0, y0), (x1, y1) = points[0], points[-1]
+    norm = math.hypot(x1 - x0, y1 - y0)
+    best, best_i = -1.0, 0
+    for i, (x, y) in enumerate(points[1:-1], 1):
+        if norm == 0:
+            d = math.hypot(x - x0, y - y0)
+        else:
+            d = abs((x - x0) * (y1 - y0) - (y - y0) * (x1 - x0)) / norm
+        if d > best:
+            best, best_i = d, i
+    if best <= tolerance:
+        return [0, len(points) - 1]
+    left = reference_douglas_peucker(points[:best_i + 1], tolerance)
+    right = reference_douglas_peucker(points[best_i:], tolerance)
+    return left + [best_i + i for i in right[1:]]
+
+
+def write_shapes(path, rows):
+    with open(path, "w") as f:
+        f.write("shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n")
+        for shape_id, lat, lon, seq in rows:
+            f.write(f"{shape_id},{lat},{lon},{seq},0\n")
+
+
+class DouglasPeuckerTestCase(unittest.TestCase):
+    def test_straight_line_collapses_to_endpoints(self):
+        x = np.linspace(0, 100, 50)
+        self.assertEqual(douglas_peucker(x, x * 2, 0.01).tolist(), [0, 49])
+
+    def test_keeps_corners(self):
+        x = np.array([0, 1, 2, 3, 3, 3, 3], dtype=float)
+        y = np.array([0, 0, 0, 0, 1, 2, 3], dtype=float)
+        self.assertEqual(douglas_peucker(x, y, 0.1).tolist(), [0, 3, 6])
+
+    def test_matches_recursive_reference(self):
+        rng = np.random.default_rng(3)
+        x = np.cumsum(rng.uniform(0, 10, 400))
+        y = np.cumsum(rng.normal(0, 5, 400))
+        for tolerance in (0.5, 5, 50):
+            expected = reference_douglas_peucker(list(zip(x.tolist(), y.tolist())), tolerance)
+            self.assertEqual(douglas_peucker(x, y, tolerance).tolist(), expected)
+
+    def test_levels_get_coarser_at_lower_zoom(self):
+        rng = np.random.default_rng(4)
+        lat = 41.88 + np.cumsum(rng.normal(0, 0.0002, 2000))
+        lon = -87.63 + np.cumsum(rng.normal(0, 0.0002, 2000))
+        levels = simplify_levels(lat, lon, (10, 13, 16))
+        self.assertLess(len(levels[10]), len(levels[13]))
+        self.assertLess(len(levels[13]), len(levels[16]))
+        self.assertLess(len(levels[16]), 2000)
+        self.assertGreater(tolerance_for_zoom(10, 41.88), tolerance_for_zoom(16, 41.88))
+
+    def test_level_for_zoom(self):
+        self.assertEqual(level_for_zoom(5), 10)
+        self.assertEqual(level_for_zoom(11), 13)
+        self.assertEqual(level_for_zoom(16), 16)
+        self.assertIsNone(level_for_zoom(17))
+        self.assertIsNone(level_for_zoom(None))
+
+
+class IngestShapesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "shapes.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_orders_points_by_sequence(self):
+        write_shapes(self.path, [("A", 41.3, -87.3, 3), ("A", 41.1, -87.1, 1), ("A", 41.2, -87.2, 2),
+                                 ("B", 41.5, -87.5, 1)])
+        shapes = ingest_shapes(self.path)
+        self.assertEqual(len(shapes), 2)
+        self.assertEqual(shapes.coordinates("A"), [[-87.1, 41.1], [-87.2, 41.2], [-87.3, 41.3]])
+        self.assertEqual(shapes.coordinates("B", zoom=10), [[-87.5, 41.5]])
+
+    def test_merges_split_shape(self):
+        write_shapes(self.path, [("A", 41.1, -87.1, 1), ("A", 41.3, -87.3, 3), ("B", 41.5, -87.5, 1),
+                                 ("A", 41.2, -87.2, 2)])
+        shapes = ingest_shapes(self.path)
+        self.assertEqual(len(shapes), 2)
+        self.assertEqual(shapes.coordinates("A"), [[-87.1, 41.1], [-87.2, 41.2], [-87.3, 41.3]])
+
+    def test_simplified_levels_are_subsets(self):
+        rows = [("A", 41.88 + 0.001 * i, -87.63 + 0.0001 * (i % 7), i) for i in range(300)]
+        write_shapes(self.path, rows)
+        shapes = ingest_shapes(self.path)
+        full = shapes.coordinates("A")
+        coarse = shapes.coordinates("A", zoom=10)
+        self.assertLess(len(coarse), len(full))
+        self.assertEqual(coarse[0], full[0])
+        self.assertEqual(coarse[-1], full[-1])
+        self.assertTrue(all(point in full for point in coarse))
+
+    def test_route_shapes_from_trips(self):
+        path = os.path.join(self.dir, "trips.txt")
+        with open(path, "w") as f:
+            f.write("route_id,service_id,trip_id,direction_id,shape_id\n"
+                    "Red,1,t1,0,S1\nRed,1,t2,1,S2\nRed,1,t3,0,S1\n22,1,t4,0,S3\n")
+        self.assertEqual(parse_route_shapes(path), {"Red": ("S1", "S2"), "22": ("S3",)})
+
+
+class ShapeEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "shapes.txt")
+        write_shapes(path, [("S1", 41.88 + 0.001 * i, -87.63 + 0.0001 * (i % 7), i) for i in range(300)])
+        self.original_state = cta_app.feed_manager.state
+        original = self.original_state.feed
+        feed = Feed(original.stops, original.routes, ingest_shapes(path), "test-version", original.last_modified,
+                    {"Red": ("S1",)})
+        cta_app.feed_manager.state = FeedState(feed, **self.original_state.parts)
+        self.client = cta_app.app.test_client()
+
+    def tearDown(self):
+        cta_app.feed_manager.state = self.original_state
+        shutil.rmtree(self.dir)
+
+    def test_shape_detail_follows_zoom(self):
+        full = self.client.get("/api/shape/S1").get_json()
+        coarse = self.client.get("/api/shape/S1?zoom=10").get_json()
+        self.assertEqual(full["geometry"]["type"], "LineString")
+        self.assertEqual(len(full["geometry"]["coordinates"]), 300)
+        self.assertLess(len(coarse["geometry"]["coordinates"]), 300)
+
+    def test_shape_revalidates_with_etag(self):
+        response = self.client.get("/api/shape/S1?zoom=12")
+        etag = response.headers["ETag"]
+        self.assertIn("test-version", etag)
+        again = self.client.get("/api/shape/S1?zoom=12", headers={"If-None-Match": etag})
+        self.assertEqual(again.status_code, 304)
+        # Zooms served from the same level share a cache entry.
+        same_level = self.client.get("/api/shape/S1?zoom=11", headers={"If-None-Match": etag})
+        self.assertEqual(same_level.status_code, 304)
+
+    def test_route_shape(self):
+        data = self.client.get("/api/route_shape?route_id=Red&zoom=13").get_json()
+        self.assertEqual(data["type"], "FeatureCollection")
+        self.assertEqual([f["properties"]["shape_id"] for f in data["features"]], ["S1"])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get("/api/shape/nope").status_code, 404)
+        self.assertEqual(self.client.get("/api/shape/S1?zoom=x").status_code, 400)
+        self.assertEqual(self.client.get("/api/route_shape?route_id=nope").status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
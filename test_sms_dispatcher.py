@@ -0,0 +1,254 @@
+import base64
+import socketserver
+import threading
+import time
+import unittest
+from unittest import mock
+
+import phone
+import sms_dispatcher
+from sms_dispatcher import (OutgoingSMS, PooledConnection, RateLimiter, SMSDispatcher, SMTPPool, SMTPSettings,
+                            parse_rates)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough ESMTP for smtplib: EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, NOOP, RSET, QUIT."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        if server.connect_delay:
+            time.sleep(server.connect_delay)
+        self.reply("220 fake ESMTP")
+        session_messages = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-fake\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "AUTH":
+                parts = command.split()
+                if parts[1].upper() == "PLAIN":
+                    user = base64.b64decode(parts[2]).split(b"\0")[1].decode()
+                else:
+                    self.reply("334 VXNlcm5hbWU6")
+                    user = base64.b64decode(self.rfile.readline().strip()).decode()
+                    self.reply("334 UGFzc3dvcmQ6")
+                    self.rfile.readline()
+                with server.lock:
+                    server.logins.append(user)
+                self.reply("235 ok")
+            elif verb == "MAIL":
+                if server.drop_after and session_messages >= server.drop_after:
+                    # Server-side session limit: hang up without a reply.
+                    return
+                self.reply("250 ok")
+            elif verb == "RCPT":
+                if "reject" in command:
+                    self.reply("550 no such user")
+                else:
+                    self.reply("250 ok")
+            elif verb == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b".\r\n", b""):
+                        break
+                    data.append(chunk)
+                if server.send_delay:
+                    time.sleep(server.send_delay)
+                session_messages += 1
+                with server.lock:
+                    server.messages.append(b"".join(data).decode())
+                    drop = server.drop_in_data and len(server.messages) == server.drop_in_data
+                if drop:
+                    # Accepted, but the connection dies before the reply.
+                    return
+                self.reply("250 queued")
+            elif verb in ("NOOP", "RSET"):
+                self.reply("250 ok")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 unknown command")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay=0.0, send_delay=0.0, drop_after=None, drop_in_data=None):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = []
+        self.messages = []
+        self.connect_delay = connect_delay
+        self.send_delay = send_delay
+        self.drop_after = drop_after
+        self.drop_in_data = drop_in_data
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def settings(self):
+        return SMTPSettings("127.0.0.1", self.server_address[1], username="alerts", password="secret",
+                            sender="alerts@example.com", use_ssl=False, timeout=5)
+
+
+def make_messages(n, carrier="att"):
+    return [OutgoingSMS(f"312555{i:04d}@txt.att.net", carrier, "Transit Alert", f"message {i}")
+            for i in range(n)]
+
+
+class SMSDispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def dispatcher(self, **kwargs):
+        kwargs.setdefault("default_rate", 0)
+        dispatcher = SMSDispatcher(self.server.settings(), **kwargs)
+        self.addCleanup(dispatcher.close)
+        return dispatcher
+
+    def test_batches_share_one_authenticated_connection(self):
+        dispatcher = self.dispatcher(pool_size=1, batch_size=10)
+        errors = dispatcher.send_many(make_messages(30))
+        self.assertEqual(errors, [None] * 30)
+        self.assertEqual(len(self.server.messages), 30)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.logins, ["alerts"])
+        stats = dispatcher.stats()
+        self.assertEqual((stats["sent"], stats["batches"], stats["connections"]), (30, 3, 1))
+
+    def test_connections_are_reused_across_calls(self):
+        dispatcher = self.dispatcher(pool_size=2)
+        for message in make_messages(5):
+            dispatcher.send(message)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 5)
+
+    def test_concurrency_is_bounded_by_pool_size(self):
+        self.server.send_delay = 0.01
+        dispatcher = self.dispatcher(pool_size=3, batch_size=5)
+        errors = dispatcher.send_many(make_messages(60))
+        self.assertEqual(errors, [None] * 60)
+        self.assertLessEqual(self.server.connections, 3)
+        self.assertGreater(self.server.connections, 1)
+
+    def test_results_keep_message_order(self):
+        messages = make_messages(12)
+        messages[7] = OutgoingSMS("reject@txt.att.net", "att", "Transit Alert", "bounced")
+        dispatcher = self.dispatcher(pool_size=2, batch_size=4)
+        errors = dispatcher.send_many(messages)
+        self.assertIsNotNone(errors[7])
+        self.assertEqual(errors[:7] + errors[8:], [None] * 11)
+        # A refused recipient doesn't cost the connection.
+        self.assertEqual(dispatcher.stats()["reconnects"], 0)
+        self.assertEqual(dispatcher.stats()["failed"], 1)
+
+    def test_reconnects_when_server_drops_the_session(self):
+        self.server.drop_after = 4
+        dispatcher = self.dispatcher(pool_size=1, batch_size=10)
+        errors = dispatcher.send_many(make_messages(10))
+        self.assertEqual(errors, [None] * 10)
+        self.assertEqual(len(self.server.messages), 10)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(dispatcher.stats()["reconnects"], 2)
+
+    def test_message_is_not_resent_after_a_drop_in_data(self):
+        self.server.drop_in_data = 3
+        dispatcher = self.dispatcher(pool_size=1, batch_size=5)
+        errors = dispatcher.send_many(make_messages(5))
+        self.assertIsNotNone(errors[2])
+        self.assertEqual(errors[:2] + errors[3:], [None] * 4)
+        # The server got message 2 once; the rest went over a new connection.
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_failed_health_check_closes_the_socket(self):
+        pool = SMTPPool(self.server.settings(), max_idle=0)
+        conn = PooledConnection(pool)
+        client = conn.client = mock.Mock()
+        client.noop.side_effect = OSError("reset")
+        client.quit.side_effect = OSError("reset")
+        pool._idle.put(conn)
+        self.assertIs(pool._checkout(), conn)
+        self.assertIsNone(conn.client)
+        client.close.assert_called_once_with()
+
+    def test_connection_retired_after_max_messages(self):
+        dispatcher = self.dispatcher(pool_size=1, batch_size=3, max_messages=3)
+        dispatcher.send_many(make_messages(9))
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(dispatcher.stats()["reconnects"], 0)
+
+    def test_unreachable_server_reports_every_message(self):
+        self.server.stop()
+        dispatcher = self.dispatcher(pool_size=1)
+        errors = dispatcher.send_many(make_messages(2))
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all(isinstance(e, OSError) for e in errors))
+        self.server = FakeSMTPServer().start()
+
+    def test_send_sms_via_email_uses_pooled_dispatcher(self):
+        settings = self.server.settings()
+        config = {"MAIL_SERVER": settings.host, "MAIL_PORT": settings.port, "MAIL_USE_SSL": False,
+                  "MAIL_USERNAME": "alerts", "MAIL_PASSWORD": "secret",
+                  "MAIL_DEFAULT_SENDER": "alerts@example.com"}
+        with mock.patch.dict(sms_dispatcher._dispatchers, clear=True):
+            for _ in range(3):
+                phone.send_sms_via_email("(312) 555-1234", "ATT", "Code", "123456", config)
+            sms_dispatcher._dispatchers.popitem()[1].close()
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertIn("To: 3125551234@txt.att.net", self.server.messages[0])
+        with self.assertRaises(ValueError):
+            phone.send_sms_via_email("3125551234", "pigeon", "Code", "1", config)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_throttles_each_carrier_separately(self):
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter({"att": 2.0}, default_rate=10.0, burst=2, clock=lambda: now[0], sleep=sleep)
+        # The burst goes straight through, then att is held to 2/s.
+        self.assertEqual([limiter.acquire("att") for _ in range(2)], [0.0, 0.0])
+        self.assertEqual(limiter.acquire("att"), 0.5)
+        self.assertEqual(limiter.acquire("verizon"), 0.0)
+        self.assertEqual(waits, [0.5])
+
+    def test_zero_rate_is_unlimited(self):
+        limiter = RateLimiter({"att": 0}, sleep=self.fail)
+        for _ in range(100):
+            limiter.acquire("att")
+
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates("att=1, Verizon=0.5,bogus"), {"att": 1.0, "verizon": 0.5})
+        self.assertEqual(parse_rates(None), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
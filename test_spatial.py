@@ -0,0 +1,60 @@
+import random
+import unittest
+from app import stops, get_closest_stop
+from spatial import StopIndex, haversine
+
+
+def linear_closest_stop(lat, lng, stops_dict):
+    closest_stop = None
+    min_distance = float("inf")
+    for stop in stops_dict.values():
+        d = haversine(lat, lng, stop["stop_lat"], stop["stop_lon"])
+        if d < min_distance:
+            min_distance = d
+            closest_stop = stop
+    return closest_stop
+
+
+class StopIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        self.points = [(rng.uniform(41.64, 42.07), rng.uniform(-87.94, -87.52)) for _ in range(50)]
+        self.index = StopIndex(stops)
+
+    def test_closest_matches_linear_scan(self):
+        for lat, lng in self.points:
+            self.assertIs(get_closest_stop(lat, lng, stops), linear_closest_stop(lat, lng, stops))
+
+    def test_closest_prefers_first_stop_on_ties(self):
+        index = StopIndex({
+            "a": {"stop_id": "a", "stop_lat": 41.9, "stop_lon": -87.6},
+            "b": {"stop_id": "b", "stop_lat": 41.9, "stop_lon": -87.6},
+        })
+        self.assertEqual(index.closest(41.91, -87.61)["stop_id"], "a")
+
+    def test_nearest_returns_k_sorted(self):
+        lat, lng = self.points[0]
+        results = self.index.nearest(lat, lng, k=5)
+        self.assertEqual(len(results), 5)
+        distances = [d for _, d in results]
+        self.assertEqual(distances, sorted(distances))
+        expected = sorted(haversine(lat, lng, s["stop_lat"], s["stop_lon"]) for s in stops.values())[:5]
+        for got, want in zip(distances, expected):
+            self.assertAlmostEqual(got, want, places=9)
+
+    def test_within_radius_matches_brute_force(self):
+        lat, lng = 41.8781, -87.6298
+        found = {s["stop_id"] for s, _ in self.index.within_radius(lat, lng, 0.5)}
+        expected = {s["stop_id"] for s in stops.values()
+                    if haversine(lat, lng, s["stop_lat"], s["stop_lon"]) <= 0.5}
+        self.assertTrue(expected)
+        self.assertEqual(found, expected)
+
+    def test_empty_index(self):
+        index = StopIndex({})
+        self.assertIsNone(index.closest(41.9, -87.6))
+        self.assertEqual(index.nearest(41.9, -87.6, k=3), [])
+        self.assertEqual(index.within_radius(41.9, -87.6, 1), [])
+
+if __name__ == '__main__':
+    unittest.main()
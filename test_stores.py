@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from stores import MemoryStore
+
+
+class MemoryStoreTestCase(unittest.TestCase):
+    def test_add_only_when_free(self):
+        store = MemoryStore()
+        self.assertTrue(store.add("k", "a", 60))
+        self.assertFalse(store.add("k", "b", 60))
+        self.assertEqual(store.get("k"), "a")
+
+    def test_delete_with_value_is_compare_and_delete(self):
+        store = MemoryStore()
+        store.set("k", "a", 60)
+        store.delete("k", "b")
+        self.assertEqual(store.get("k"), "a")
+        store.delete("k", "a")
+        self.assertIsNone(store.get("k"))
+
+    def test_expiry_and_ttl(self):
+        store = MemoryStore()
+        store.set("k", 1, 0.01)
+        self.assertLessEqual(store.ttl("k"), 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(store.get("k"))
+        self.assertIsNone(store.ttl("k"))
+        self.assertTrue(store.add("k", 2, 60))
+
+    def test_writes_evict_expired_then_least_recently_used(self):
+        store = MemoryStore(max_entries=2)
+        store.set("old", 0, 0.01)
+        time.sleep(0.02)
+        store.set("a", 1, 60)
+        self.assertEqual(len(store), 1)
+        store.set("b", 2, 60)
+        store.get("a")
+        store.set("c", 3, 60)
+        self.assertIsNone(store.get("b"))
+        self.assertEqual((store.get("a"), store.get("c")), (1, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+import app as cta_app
+from cta_client import Prediction
+from subscriptions import DatabaseSubscriptions, Subscription, SubscriptionIndex, soonest_arrivals
+
+
+def subscription(user_id, threshold=5):
+    return Subscription(user_id, f"312555{user_id:04d}", "att", threshold)
+
+
+class SubscriptionIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def ids(self, stop_id, line):
+        return sorted(s.user_id for s in self.index.backend.get(stop_id, line))
+
+    def test_subscribers_by_stop_and_line(self):
+        self.index.subscribe(subscription(1), "1106", ["22", "Red"])
+        self.index.subscribe(subscription(2), "1106", ["22"])
+        self.index.subscribe(subscription(3), "4002", ["22"])
+        self.assertEqual(self.ids("1106", "22"), [1, 2])
+        self.assertEqual(self.ids("1106", "Red"), [1])
+        self.assertEqual(self.ids("4002", "Red"), [])
+        self.assertEqual(sorted(self.index.stop_ids()), ["1106", "4002"])
+
+    def test_subscribe_replaces_previous_entries(self):
+        self.index.subscribe(subscription(1), "1106", ["22", "Red"])
+        self.index.subscribe(subscription(1, threshold=10), "4002", ["Blue"])
+        self.assertEqual(self.ids("1106", "22"), [])
+        self.assertEqual(self.index.stop_ids(), ["4002"])
+        self.assertEqual(self.index.backend.get("4002", "Blue")[0].threshold, 10)
+
+    def test_unsubscribe_drops_empty_stops(self):
+        self.index.subscribe(subscription(1), "1106", ["22", "22"])
+        self.index.unsubscribe(1)
+        self.index.unsubscribe(99)
+        self.assertEqual(self.index.stop_ids(), [])
+        self.assertEqual(len(self.index.backend), 0)
+
+    def test_match_applies_each_threshold(self):
+        self.index.subscribe(subscription(1, threshold=5), "1106", ["22", "Red"])
+        self.index.subscribe(subscription(2, threshold=15), "1106", ["Red"])
+        matches = self.index.match_stops({"1106": {"22": 3, "Red": 12, "Blue": 1}})
+        self.assertEqual(sorted((s.user_id, line, arrival) for _, s, line, arrival in matches),
+                         [(1, "22", 3), (2, "Red", 12)])
+
+    def test_match_stops_does_one_lookup(self):
+        calls = []
+
+        def lookup(stop_ids, lines):
+            calls.append((sorted(stop_ids), lines))
+            return {("1106", "22"): [subscription(1, threshold=5)], ("4002", "Red"): [subscription(2, threshold=5)]}
+
+        index = SubscriptionIndex(DatabaseSubscriptions(lookup, lambda: ["1106", "4002"]))
+        matches = index.match_stops({"1106": {"22": 3}, "4002": {"Red": 9, "22": 1}})
+        self.assertEqual([(stop_id, s.user_id, line) for stop_id, s, line, _ in matches], [("1106", 1, "22")])
+        self.assertEqual(calls, [(["1106", "4002"], ["22", "Red"])])
+        # Writes go to the user tables, not the index.
+        index.subscribe(subscription(3), "1106", ["22"])
+        self.assertFalse(index.needs_sync)
+
+    def test_soonest_arrivals(self):
+        predictions = [Prediction("22", "9"), Prediction("22", "4"), Prediction("Red", "DUE"),
+                       Prediction("8", None), Prediction("Blue", "0")]
+        self.assertEqual(soonest_arrivals(predictions), {"22": 4, "Blue": 0})
+
+
+class SyncSubscriptionTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cta_app, "subscription_index", SubscriptionIndex())
+        self.index = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_user(self, **fields):
+        user = SimpleNamespace(id=7, phone_number="3125550007", carrier="att", home_lat=41.9, home_lng=-87.6,
+                               closest_stop_id="1106", favorites=["22"], settings={"time": "8"})
+        user.__dict__.update(fields)
+        user.get_favorites = lambda: list(user.favorites)
+        user.get_notification_settings = lambda: dict(user.settings)
+        return user
+
+    def test_follows_each_kind_of_write(self):
+        user = self.make_user()
+        cta_app.sync_subscription(user)
+        self.assertEqual(self.index.backend.get("1106", "22")[0].threshold, 8)
+        # add_favorite / remove_favorite
+        user.favorites = ["Red"]
+        cta_app.sync_subscription(user)
+        self.assertEqual(self.index.backend.get("1106", "22"), [])
+        self.assertEqual(len(self.index.backend.get("1106", "Red")), 1)
+        # set_notification
+        user.settings, user.phone_number = {"time": "12"}, "3125559999"
+        cta_app.sync_subscription(user)
+        (entry,) = self.index.backend.get("1106", "Red")
+        self.assertEqual((entry.threshold, entry.phone_number), (12, "3125559999"))
+        # set_home
+        user.closest_stop_id = "4002"
+        cta_app.sync_subscription(user)
+        self.assertEqual(self.index.stop_ids(), ["4002"])
+        user.home_lat = user.home_lng = None
+        cta_app.sync_subscription(user)
+        self.assertEqual(self.index.stop_ids(), [])
+
+    def test_users_without_phone_details_are_not_indexed(self):
+        cta_app.sync_subscription(self.make_user(carrier=None))
+        self.assertEqual(self.index.stop_ids(), [])
+
+
+
+class DatabaseSubscriptionsTestCase(unittest.TestCase):
+    """The default index, read straight from the user tables."""
+
+    def setUp(self):
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        engines = cta_app.db._app_engines[cta_app.app]
+        self.addCleanup(engines.__setitem__, None, engines[None])
+        engines[None] = engine
+        self.statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: self.statements.append(args[2]))
+        self.ctx = cta_app.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+        cta_app.db.create_all()
+        # (stop, favorites, notify_minutes, carrier, has home)
+        seed = [("1106", ["22", "Red"], 8, "att", True),
+                ("1106", ["22"], None, "att", True),
+                ("4002", ["Red"], 12, "att", True),
+                ("1106", ["22"], 5, None, True),       # no carrier: can't be texted
+                ("1106", ["22"], 5, "att", False),     # no home
+                ("9999", [], 5, "att", True)]          # no favorites
+        self.ids = []
+        for n, (stop_id, favorites, minutes, carrier, has_home) in enumerate(seed):
+            user = cta_app.User(phone_number=f"31255500{n:02d}", carrier=carrier, notify_minutes=minutes,
+                                home_lat=41.88 if has_home else None, home_lng=-87.63 if has_home else None,
+                                closest_stop_id=stop_id)
+            user.set_favorites(favorites)
+            cta_app.db.session.add(user)
+            cta_app.db.session.flush()
+            self.ids.append(user.id)
+        cta_app.db.session.commit()
+        self.index = SubscriptionIndex(DatabaseSubscriptions(cta_app.lookup_subscriptions,
+                                                             cta_app.subscribed_stop_ids))
+
+    def test_subscribers_by_route(self):
+        found = cta_app.subscribers_by_route(["22", "Red", "Blue"])
+        self.assertEqual({route: sorted(user.id for user in users) for route, users in found.items()},
+                         {"22": [self.ids[0], self.ids[1], self.ids[3]], "Red": [self.ids[0], self.ids[2]],
+                          "Blue": []})
+        found = cta_app.subscribers_by_route(["22", "Red"], stop_ids=["4002"])
+        self.assertEqual({route: [user.id for user in users] for route, users in found.items()},
+                         {"22": [], "Red": [self.ids[2]]})
+
+    def test_lookup_carries_each_threshold(self):
+        found = self.index.backend.get_many(["1106", "4002"], ["22", "Red"])
+        thresholds = {key: sorted((s.user_id, s.threshold) for s in subscriptions)
+                      for key, subscriptions in found.items()}
+        self.assertEqual(thresholds, {("1106", "22"): [(self.ids[0], 8), (self.ids[1], 5)],
+                                      ("1106", "Red"): [(self.ids[0], 8)],
+                                      ("4002", "Red"): [(self.ids[2], 12)]})
+
+    def test_match_stops_is_one_query(self):
+        cta_app.db.session.expire_all()
+        del self.statements[:]
+        matches = self.index.match_stops({"1106": {"22": 6, "Red": 9}, "4002": {"Red": 9}})
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual(sorted((stop_id, s.user_id, line) for stop_id, s, line, _ in matches),
+                         [("1106", self.ids[0], "22"), ("4002", self.ids[2], "Red")])
+
+    def test_subscribed_stop_ids(self):
+        self.assertEqual(sorted(self.index.stop_ids()), ["1106", "4002"])
+
+    def test_resubscribe_users_updates_a_synced_index(self):
+        synced = SubscriptionIndex()
+        synced.mark_ready()
+        with mock.patch.object(cta_app, "subscription_index", synced):
+            cta_app.User.query.filter_by(id=self.ids[1]).update({"closest_stop_id": "4002"})
+            cta_app.db.session.commit()
+            cta_app.resubscribe_users([self.ids[1]])
+        self.assertEqual([s.user_id for s in synced.backend.get("4002", "22")], [self.ids[1]])
+        # Nothing to do when the index is the user tables themselves.
+        with mock.patch.object(cta_app, "subscription_index", self.index):
+            del self.statements[:]
+            cta_app.resubscribe_users([self.ids[1]])
+        self.assertEqual(self.statements, [])
+
+
+if __name__ == '__main__':
+    unittest.main()